@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks of db_smart_backup.sh on synthetic backup trees, no database
+# server is needed:
+#
+#   - the tree stages (get_sorted_files, walk_backup_tree, do_rotate,
+#     do_cleanup_orphans, do_verify_tree) on generated trees of --dumps
+#     dumps spread over --dbs databases and --years years,
+#   - the dump + compression pipeline (do_db_backup_) of a fake driver
+#     streaming --size bytes of zeros, random or sql like text, for each
+#     compressor backend.
+#
+#   python bench.py --dumps 1000,10000,100000 --comps xz,zstd
+#
+# Each measure is appended as a json line to --results, tagged with the
+# version of the benchmarked script, and compared to the last measure of
+# another version so that regressions are visible.
+#
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from subprocess import (
+    Popen,
+    PIPE,
+    check_output,
+    CalledProcessError,
+    STDOUT)
+
+
+J = os.path.join
+D = os.path.dirname
+CWD = os.path.abspath(D(__file__))
+CHRONOS = ('daily', 'weekly', 'monthly', 'lastsnapshots')
+TREE_STAGES = ('sort', 'walk_tree', 'rotate', 'rotate_indexed',
+               'cleanup_orphans', 'walk_tree_noop', 'verify_tree')
+COMPRESSORS = ('xz', 'gzip', 'bzip2', 'zstd', 'nocomp')
+EXTS = {'xz': '.xz', 'gzip': '.gz', 'bzip2': '.bz2', 'zstd': '.zst',
+        'nocomp': ''}
+
+COMMON = u'''
+export DB_SMART_BACKUP_AS_FUNCS=1 NO_COLORS=1
+. "{script}"
+TOP_BACKUPDIR="{top}"
+BACKUP_TYPE=bench;BACKUP_EXT=sql
+KEEP_LASTS=24;KEEP_DAYS=14;KEEP_WEEKS=8;KEEP_MONTHES=12;KEEP_LOGS=60
+OWNER="$(id -un)";GROUP="$(id -gn)";DPERM=750;FPERM=640
+CHECKSUM=sha256;VERIFY_TREE_DAYS=30;VERIFY_JOBS="{jobs}"
+COMP="{comp}";COMPS="";set_compressor
+DATE=2010-06-15;FDATE="${{DATE}}_01-02-03";YEAR=2010;DOY=166;W=24;MNUM=06
+bench_clock() {{
+    if [ x"${{EPOCHREALTIME}}" != "x" ];then
+        echo "${{EPOCHREALTIME/,/.}}"
+    else
+        date +%s.%N
+    fi
+}}
+'''
+TREE_STAGE = u'''
+case "{stage}" in
+    sort) stage() {{
+        for d in "$(get_backupdir)"/*/lastsnapshots;do
+            get_sorted_files "${{d}}" > /dev/null
+        done
+    }};;
+    # the walk of the orphans cleanup, which also fixes the permissions
+    walk_tree|walk_tree_noop) stage() {{ walk_backup_tree 1 > /dev/null; }};;
+    rotate|rotate_indexed) stage() {{ do_rotate; }};;
+    cleanup_orphans) stage() {{ do_cleanup_orphans; }};;
+    verify_tree) stage() {{ do_verify_tree; }};;
+esac
+start="$(bench_clock)"
+stage
+status="$?"
+echo "BENCH ${{start}} $(bench_clock) ${{status}}"
+'''
+COMPRESSION_STAGE = u'''
+if [ x"${{COMP}}" != "x{comp}" ];then
+    echo "BENCH missing"
+    exit 0
+fi
+PIPED_BACKUP_COMPRESSION="{piped}"
+bench_stream() {{
+    case "{kind}" in
+        zeros) head -c "{size}" /dev/zero;;
+        random) head -c "{size}" /dev/urandom;;
+        *) for i in $(seq "{chunks}");do cat "{sample}";done|head -c "{size}";;
+    esac
+}}
+bench_dump() {{
+    if [ x"${{PIPED_BACKUP_COMPRESSION}}" = "x1" ];then
+        bench_stream
+    else
+        bench_stream > "${{2}}"
+    fi
+}}
+rm -rf "$(get_backupdir)"
+start="$(bench_clock)"
+do_db_backup_ benchdb bench_dump
+end="$(bench_clock)"
+status=0
+if [ x"${{LAST_BACKUP_STATUS}}" = "xfailure" ];then
+    status=1
+fi
+out="$(get_backupdir)/benchdb/dumps/benchdb_${{FDATE}}.sql{ext}"
+echo "BENCH ${{start}} ${{end}} ${{status}} $(stat -c %s "${{out}}" 2>/dev/null || echo 0)"
+'''
+
+
+def version(script):
+    """git version of the benchmarked script."""
+    try:
+        return check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=D(os.path.abspath(script)),
+            stderr=STDOUT).decode('utf-8').strip()
+    except (CalledProcessError, OSError):
+        return u'unknown'
+
+
+def parse_size(value):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def touch(path):
+    open(path, 'w').close()
+
+
+def make_tree(top, dumps, dbs, years):
+    """Backup tree as left by link_into_dirs, nothing rotated yet:
+    ``dumps`` dumps over ``dbs`` databases, every ``years * 365 / dumps``
+    days, hard linked in each chrono directory, plus the logs."""
+    backupdir = J(top, 'bench')
+    per_db = max(1, dumps // dbs)
+    end = datetime.datetime(2010, 6, 15, 1, 2, 3)
+    step = datetime.timedelta(days=years * 365) // per_db
+    for num in range(dbs):
+        db = 'db{0}'.format(num)
+        dbdir = J(backupdir, db)
+        for d in ('dumps', '.dsb') + CHRONOS:
+            os.makedirs(J(dbdir, d))
+        for i in range(per_db):
+            dt = end - step * i
+            dump = J(dbdir, 'dumps', '{0}_{1}.sql.xz'.format(
+                db, dt.strftime('%Y-%m-%d_%H-%M-%S')))
+            touch(dump)
+            links = (
+                ('lastsnapshots', dt.strftime('%Y_%j_%Y-%m-%d_%H-%M-%S')),
+                ('daily', dt.strftime('%Y_%j_%Y-%m-%d')),
+                ('weekly', dt.strftime('%Y_%V')),
+                ('monthly', dt.strftime('%Y_%m')))
+            for chrono, name in links:
+                link = J(dbdir, chrono, '{0}_{1}.sql.xz'.format(db, name))
+                if not os.path.exists(link):
+                    os.link(dump, link)
+    os.makedirs(J(top, 'logs'))
+    for i in range(120):
+        touch(J(top, 'logs', 'db_smart_backup_{0:04d}.log'.format(i)))
+    return per_db * dbs
+
+
+def make_sample(path, size=1024 ** 2):
+    """sql like text, compressible as a real dump is."""
+    rnd = random.Random(0)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'customer', 'order', 'paid',
+             'pending', 'shipped', 'paris', 'lyon', 'berlin', 'madrid']
+    written = 0
+    with open(path, 'w') as fic:
+        while written < size:
+            line = (
+                u"INSERT INTO public.t{0} VALUES ({1}, '{2} {3}', {4}.{5:02d},"
+                u" '20{6:02d}-{7:02d}-{8:02d}');\n").format(
+                    rnd.randint(1, 9), rnd.randint(1, 10 ** 6),
+                    rnd.choice(words), rnd.choice(words),
+                    rnd.randint(0, 9999), rnd.randint(0, 99),
+                    rnd.randint(0, 15), rnd.randint(1, 12),
+                    rnd.randint(1, 28))
+            fic.write(line)
+            written += len(line)
+
+
+def run_script(script, logfile):
+    """Run a bench script, return (status, wall, cpu, fields)."""
+    before = os.times()
+    with open(logfile, 'a') as log:
+        proc = Popen(['bash', '-c', script], stdout=PIPE, stderr=log)
+        out = proc.communicate()[0].decode('utf-8', 'replace')
+    after = os.times()
+    cpu = (after[2] - before[2]) + (after[3] - before[3])
+    fields = []
+    for line in out.splitlines():
+        if line.startswith('BENCH '):
+            fields = line.split()[1:]
+    if not fields:
+        return 'failure', 0., cpu, []
+    if fields[0] == 'missing':
+        return 'missing', 0., cpu, []
+    wall = float(fields[1]) - float(fields[0])
+    status = (fields[2] == '0') and 'ok' or 'failure'
+    return status, wall, cpu, fields[3:]
+
+
+def bench_tree(args, work, scale):
+    top = J(work, 'tree{0}'.format(scale))
+    started = time.time()
+    dumps = make_tree(top, scale, args.dbs, args.years)
+    print('# generated {0} dumps in {1:.1f}s'.format(
+        dumps, time.time() - started), file=sys.stderr)
+    opts = {'script': args.script, 'top': top, 'jobs': args.jobs,
+            'comp': 'xz'}
+    for stage in args.stages:
+        script = (COMMON + TREE_STAGE).format(stage=stage, **opts)
+        status, wall, cpu, _ = run_script(script, J(work, 'bench.log'))
+        yield {'stage': stage, 'dumps': dumps, 'dbs': args.dbs,
+               'years': args.years, 'status': status,
+               'seconds': round(wall, 4), 'cpu': round(cpu, 4),
+               'rate': wall and round(dumps / wall, 1) or 0.,
+               'unit': 'dumps/s'}
+    if not args.keep:
+        shutil.rmtree(top)
+
+
+def bench_compression(args, work, sample):
+    top = J(work, 'comp')
+    runs = [(comp, kind, mode) for comp in args.comps
+            for kind in args.kinds for mode in args.modes]
+    missing = set()
+    for comp, kind, mode in runs:
+        if comp in missing:
+            continue
+        opts = {'script': args.script, 'top': top, 'comp': comp,
+                'jobs': args.jobs, 'kind': kind, 'size': args.size,
+                'sample': sample, 'ext': EXTS.get(comp, ''),
+                'chunks': args.size // os.path.getsize(sample) + 1,
+                'piped': (mode == 'piped') and '1' or ''}
+        script = (COMMON + COMPRESSION_STAGE).format(**opts)
+        best = None
+        for i in range(args.repeat):
+            run = run_script(script, J(work, 'bench.log'))
+            if best is None or run[0] != 'ok' or run[1] < best[1]:
+                best = run
+            if run[0] != 'ok':
+                break
+        status, wall, cpu, extra = best
+        if status == 'missing':
+            print('# {0} is not installed, skipped'.format(comp),
+                  file=sys.stderr)
+            missing.add(comp)
+            continue
+        zsize = extra and int(extra[0]) or 0
+        yield {'stage': 'compression', 'comp': comp, 'kind': kind,
+               'mode': mode, 'bytes': args.size, 'status': status,
+               'seconds': round(wall, 4), 'cpu': round(cpu, 4),
+               'rate': wall and round(args.size / wall / 1024 ** 2, 2) or 0.,
+               'unit': 'MiB/s',
+               'ratio': zsize and round(float(zsize) / args.size, 4) or 0.}
+    shutil.rmtree(top, ignore_errors=True)
+
+
+def key(result):
+    return tuple(result.get(k) for k in (
+        'stage', 'dumps', 'dbs', 'years', 'comp', 'kind', 'mode', 'bytes'))
+
+
+def load_results(path):
+    results = []
+    if os.path.exists(path):
+        with open(path) as fic:
+            for line in fic:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+
+def report(results, previous, threshold):
+    """Print the results against the last ones of another version,
+    return the number of regressions."""
+    last = {}
+    for result in previous:
+        last[key(result)] = result
+    regressions = 0
+    print('{0:<16} {1:<24} {2:>10} {3:>10} {4:>14} {5:>9}  {6}'.format(
+        'stage', 'scale', 'seconds', 'cpu', 'rate', 'delta', 'status'))
+    for result in results:
+        if result['stage'] == 'compression':
+            scale = '{0}/{1}/{2}'.format(
+                result['comp'], result['kind'], result['mode'])
+        else:
+            scale = '{0} dumps/{1} dbs'.format(result['dumps'], result['dbs'])
+        delta, status = '', result['status']
+        prev = last.get(key(result))
+        if prev and prev.get('seconds') and result['status'] == 'ok':
+            change = (result['seconds'] - prev['seconds']) / prev['seconds']
+            delta = '{0:+.1%}'.format(change)
+            if change > threshold:
+                status = 'REGRESSION (was {0}s with {1})'.format(
+                    prev['seconds'], prev['version'])
+                regressions += 1
+        rate = '{0} {1}'.format(result['rate'], result['unit'])
+        if result.get('ratio'):
+            rate += ' x{0:.2f}'.format(1 / result['ratio'])
+        print('{0:<16} {1:<24} {2:>10} {3:>10} {4:>14} {5:>9}  {6}'.format(
+            result['stage'], scale, result['seconds'], result['cpu'], rate,
+            delta, status))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark db_smart_backup.sh stages on synthetic trees')
+    parser.add_argument('--script', default=J(CWD, 'db_smart_backup.sh'),
+                        help='script to benchmark (default: %(default)s)')
+    parser.add_argument('--label', default=None,
+                        help='version of the results (default: git describe)')
+    parser.add_argument('--dumps', default='1000,10000',
+                        help='comma separated tree sizes, in dumps')
+    parser.add_argument('--dbs', type=int, default=10)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--stages', default=','.join(TREE_STAGES))
+    parser.add_argument('--comps', default=','.join(COMPRESSORS))
+    parser.add_argument('--kinds', default='text',
+                        help='dump streams: text, zeros, random')
+    parser.add_argument('--modes', default='piped',
+                        help='piped (dump | compressor), file or both')
+    parser.add_argument('--size', default='64m',
+                        help='bytes of each fake dump (k, m & g suffixes)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='compression runs, the best one is kept')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='VERIFY_JOBS of the verify_tree stage')
+    parser.add_argument('--no-tree', action='store_true')
+    parser.add_argument('--no-compression', action='store_true')
+    parser.add_argument('--results', default=J(CWD, 'bench_results.jsonl'))
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the work directory')
+    args = parser.parse_args(argv)
+    args.script = os.path.abspath(args.script)
+    args.size = parse_size(args.size)
+    args.stages = [s for s in args.stages.split(',') if s]
+    args.comps = [c for c in args.comps.split(',') if c]
+    args.kinds = [k for k in args.kinds.split(',') if k]
+    args.modes = [m for m in args.modes.split(',') if m]
+    label = args.label or version(args.script)
+    work = tempfile.mkdtemp(prefix='dsb_bench')
+    print('# benchmarking {0} ({1}) in {2}'.format(
+        args.script, label, work), file=sys.stderr)
+    results = []
+    try:
+        if not args.no_tree:
+            for scale in args.dumps.split(','):
+                results.extend(bench_tree(args, work, int(float(scale))))
+        if not args.no_compression:
+            sample = J(work, 'sample.sql')
+            make_sample(sample)
+            results.extend(bench_compression(args, work, sample))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+    previous = [r for r in load_results(args.results)
+                if r.get('version') != label]
+    regressions = report(results, previous, args.threshold)
+    stamp = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    with open(args.results, 'a') as fic:
+        for result in results:
+            result.update({'version': label, 'date': stamp,
+                           'host': socket.gethostname()})
+            fic.write(json.dumps(result, sort_keys=True) + '\n')
+    if regressions and args.fail_on_regression:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim:et:ft=python:sts=4:sw=4
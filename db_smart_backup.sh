@@ -3,6 +3,10 @@
 # Author: Mathieu Le Marec - Pasquet / kiorky@cryptelium.net
 
 __NAME__="db_smart_backup"
+# computed once, used by runas/db_user/runcmd_as at each call
+DSB_WHOAMI="${DSB_WHOAMI:-$(whoami)}"
+# set by activate_IO_redirection, see log_line
+DSB_LOG_DIRECT=""
 
 # even if it is not really tested, we are trying to get full posix compatibility
 # and to run on another shell than bash
@@ -23,6 +27,14 @@ generate_configuration_file() {
 
 # Choose Compression type. (gzip or bzip2 or xz or zstd)
 #COMP=bzip2
+# Compression level given to the compressor (eg: 1-9, 1-19 for zstd)
+#COMP_LEVEL=""
+# Compression threads (default: all cores for xz, zstd, pigz and pbzip2)
+#COMP_THREADS=""
+# Parallel gzip/bzip2 implementations are used when installed,
+# set to "" to use the plain gzip/bzip2
+#PIGZ="pigz"
+#PBZIP2="pbzip2"
 
 #User to run dumps dump binaries as, defaults to logged in user
 #RUNAS=postgres
@@ -44,6 +56,132 @@ generate_configuration_file() {
 # do also global backup (use by postgresql to save roles/groups and only that
 #DO_GLOBAL_BACKUP="1"
 
+# How many databases to backup at the same time (1: one after the other)
+# Each database keeps its own status, hooks and log output.
+#PARALLEL_JOBS=1
+# Order of the databases backups: "" (as listed) or "size" (the longest to
+# backup first, predicted from the previous runs durations & the sizes)
+#DB_ORDER=""
+
+# Keep each distinct dump only once: dumps are stored by content (sha256)
+# in <db>/.dsb/store and identical dumps are hard links to the same object,
+# so databases which did not change do not use more space at each run.
+# Only dumps which are the same byte for byte are deduplicated: mysql
+# (--skip-dump-date is added), redis, slapd and the postgresql plain format
+# (eg: OPT="--create -Fp"). The postgresql custom, tar and directory formats
+# (the default OPT, PG_DUMP_JOBS) record their creation time in the
+# archive, each of their dumps is stored apart.
+#DEDUP_STORE=""
+
+# Differential dumps (zstd only): a full dump is taken every DIFF_FULL_EVERY
+# runs and the dumps in between only store what changed since this full one
+# (zstd --patch-from against it), which suits text dumps taken often (eg:
+# hourly with a high KEEP_LASTS). The full dumps still needed by a kept
+# differential one are protected from the rotation in <db>/.dsb/bases.
+# Differential dumps are written to disk before being compressed, even with
+# PIPED_BACKUP_COMPRESSION, and decompressing one needs its base:
+#   zstd -d --long=31 --patch-from=<decompressed base> <dump>
+#DIFF_BACKUPS=""
+#DIFF_FULL_EVERY="24"
+
+# Seekable dumps: the dumps are compressed as independent frames of
+# SEEKABLE_FRAME_SIZE bytes (at a small cost in compression ratio) and get a
+# table of contents in <db>/.dsb/toc which maps their tables (mysqldump and
+# plain pg_dump markers) or tar members (elasticsearch, redis) to the frames
+# holding them, to restore one of them without decompressing the whole dump:
+#   db_smart_backup.sh --extract <dump> [table|member|directory/]
+# (without object, the objects of the dump are listed). The dumps stay
+# regular archives for the usual tools. pg_dump custom archives (the
+# default) are framed but not indexed, use pg_restore -l/-t on them.
+# Differential dumps are never seekable.
+#SEEKABLE_BACKUPS=""
+#SEEKABLE_FRAME_SIZE="32M"
+
+# Do not dump again a database which did not change since the last run:
+# the backup type provides a cheap fingerprint (server statistics, files
+# mtimes) and if it is the same than at the last run, the last dump is
+# linked into today's daily/weekly/monthly/lastsnapshots directories.
+# With mysql, this relies on the binary log position (any write on the
+# server thus dumps all its databases again): without binary log, mysql
+# databases are always dumped.
+#SKIP_UNCHANGED=""
+
+# Throttling, to keep dumps & compression from starving the production
+# load during business hours (the dump/compressor processes only, the
+# database server work is slowed down by the backpressure of the pipe)
+# niceness and io scheduling class[/level] (see ionice(1): idle, 2/7)
+#NICE_LEVEL=""
+#IONICE_CLASS=""
+# byte rate limit between the dump and the compressor (pv -L syntax: 20m)
+#THROTTLE_RATE=""
+#PV="pv"
+# per database and per time window overrides, space separated
+# "dbglob[@HH-HH]:key=value[,key=value]" with rate, nice, ionice and
+# threads (compressor threads) keys, the first matching rule wins:
+#THROTTLE_RULES="*@08-19:rate=20m,nice=19,ionice=idle,threads=1 bigdb:rate=50m"
+
+# Per stage metrics (wall & cpu time, bytes in/out, compression ratio of
+# discovery, dumps, compression, links, rotation & cleanup), appended at
+# the end of each run to <METRICS_DIR>/<conf>.jsonl and written to a
+# prometheus textfile collector file (default: <METRICS_DIR>/<conf>.prom)
+# Piped dumps (see PIPED_BACKUP_COMPRESSION) include their compression.
+# set METRICS_DIR to "" to disable
+#METRICS_DIR="\${TOP_BACKUPDIR}/metrics"
+#METRICS_PROM_FILE=""
+
+# Verify each new dump in background while the next databases are being
+# dumped: the dump is decompressed and checked (pg_restore -l listing,
+# mysqldump trailer, tar listing, ...), the result is kept in
+# <db>/.dsb/verify and a failed verification makes the run fail.
+#VERIFY_BACKUPS=""
+# how many verifications at the same time (default: number of cpus)
+#VERIFY_JOBS=""
+
+# Checksum of each dump, computed while it is written and recorded in
+# <db>/.dsb/checksums, any <algo>sum tool (sha256, b2, ...) can be used.
+# "db_smart_backup.sh --verify-tree /path/toconfig" audits the whole
+# TOP_BACKUPDIR against them: dumps whose size or mtime changed, or which
+# were not verified for VERIFY_TREE_DAYS days, are re-hashed (VERIFY_JOBS
+# at the same time), and the chrono links not linked to any dump and the
+# rotation index entries pointing nowhere are reported.
+# set CHECKSUM to "" to disable
+#CHECKSUM="sha256"
+#VERIFY_TREE_DAYS="30"
+
+# Offload the dumps to S3 compatible object storage while they are written:
+# the compressed stream is uploaded in S3_PART_SIZE bytes parts, S3_JOBS at
+# the same time, each one buffered in S3_BUFFER_DIR (at most S3_JOBS + 1
+# parts in memory with the default /dev/shm). Objects are named after the
+# dumps path under TOP_BACKUPDIR (dumps directories only). Interrupted
+# uploads are resumed at the end of the run and the remote dumps are
+# deleted once rotated and pruned locally, so they have the same retention.
+# eg: S3_URL="https://s3.eu-west-1.amazonaws.com/bucket/prefix"
+#S3_URL=""
+#S3_ACCESS_KEY=""
+#S3_SECRET_KEY=""
+#S3_REGION="us-east-1"
+# at least 5MiB but for the last part
+#S3_PART_SIZE="67108864"
+#S3_JOBS="4"
+#S3_BUFFER_DIR="/dev/shm"
+#S3_CURL_ARGS=""
+
+# What costs a process at each start (hostname, number of cpus) is cached
+# in STARTUP_CACHE for STARTUP_CACHE_TTL seconds ("" to disable)
+#STARTUP_CACHE="\${TOP_BACKUPDIR}/.dsb_startup_cache"
+#STARTUP_CACHE_TTL="86400"
+
+# Resident mode (--daemon): run a backup cycle every DAEMON_INTERVAL seconds
+# plus up to DAEMON_JITTER random ones, from a process which keeps the
+# configuration, the binaries and the discovered databases between cycles.
+# A cycle which is still running when the next one is due makes it skip,
+# as does a run of the same backup directory by another process (eg: cron).
+# Everything is discovered again every DAEMON_REFRESH cycles, and after a
+# failed one.
+#DAEMON_INTERVAL="3600"
+#DAEMON_JITTER="300"
+#DAEMON_REFRESH="24"
+
 # HOW MANY BACKUPS TO KEEP & LEVEL
 # How many snapshots to keep (lastlog for dump)
 # How many per day
@@ -66,6 +204,8 @@ generate_configuration_file() {
 ######## Database connection settings
 # host defaults to localhost
 # and without port we use a connection via socket
+# with postgresql, a port other than 5432 is part of the backup directory
+# (eg: postgresql/localhost_5433)
 #HOST=""
 #PORT=""
 
@@ -86,6 +226,19 @@ generate_configuration_file() {
 # ES_PASSWORD="secret"
 # path to snapshots (have to be added to path.repo in elasticsearch.yml)
 # ES_SNAPSHOTS_DIR="\${ES_SNAPSHOTS_DIR:-\${ES_TMP}/snapshots}"
+# Snapshot mode (elasticsearch >= 7.8):
+#   "": one repository per index, recreated & tarred at each backup
+#   "repository": one long lived repository (ES_REPOSITORY in
+#     ES_SNAPSHOTS_DIR) with incremental snapshots taken asynchronously
+#     (use PARALLEL_JOBS to take several at once). The dumps only contain
+#     the snapshot description and the snapshots are deleted from the
+#     repository when their dump is rotated out (only the snapshots taken
+#     by this backup, listed in <db>/.dsb/es_snapshots, never the others
+#     of the repository: SLM, other hosts...).
+# ES_SNAPSHOT_MODE=""
+# ES_REPOSITORY="dsb"
+# seconds between two checks of a running snapshot
+# ES_POLL_INTERVAL="5"
 # elasticsearch daemon user
 
 ######### Postgresql
@@ -97,6 +250,14 @@ generate_configuration_file() {
 ######## slapd
 # SLAPCAT_ARGS="\${SLAPCAT_ARGS:-""}"
 # SLAPD_DIR="\${SLAPD_DIR:-/var/lib/ldap}"
+# Export each configured database (cn=config and every suffix) on its own
+# with "slapcat -b <suffix>", so that each one has its own dumps, rotation
+# and failure status. DBNAMES & DBEXCLUDE select the suffixes, they are
+# exported in parallel (PARALLEL_JOBS, default: one job per suffix up to
+# the number of cpus). Set DO_GLOBAL_BACKUP="" to skip the monolithic export.
+# SLAPD_PER_SUFFIX=""
+# static configuration to read the suffixes from when there is no cn=config
+# SLAPD_CONF="/etc/ldap/slapd.conf"
 
 # OPT string for use with pg_dump ( see man pg_dump )
 #OPT="--create -Fc"
@@ -104,12 +265,34 @@ generate_configuration_file() {
 # OPT string for use with pg_dumpall ( see man pg_dumpall )
 #OPTALL="--globals-only"
 
+# Dump each database with that many pg_dump jobs (pg_dump -Fd -j N).
+# The dump directory is written in PG_DUMP_STAGING_DIR (which must have
+# room for a full uncompressed dump) and then packed in the usual dump
+# file: a tar of the dump directory (pg_restore -j it once extracted).
+#PG_DUMP_JOBS=1
+#PG_DUMP_STAGING_DIR="\${TMPDIR:-/tmp}"
+# OPT string for use with pg_dump in directory mode
+#OPTDIR="--create -Z0"
+
 ######## MYSQL
 #MYSQL_SOCK_PATHS=""
 #MYSQL=""
 #MYSQLDUMP=""
 # do we disable mysqldump --single-transaction0
 #MYSQLDUMP_NO_SINGLE_TRANSACTION=""
+# Dump the tables of each database with that many mysqldump processes.
+# They all start their transaction while a FLUSH TABLES WITH READ LOCK is
+# held so they share the same snapshot (without --single-transaction, the
+# lock is held during the whole dump). The parts are reassembled in one
+# dump: schema, tables data, then triggers.
+# The mysql user needs the RELOAD and PROCESS privileges, and with
+# --single-transaction, the parts sessions are found through
+# performance_schema.session_connect_attrs: without performance_schema
+# (the MariaDB default), each database is dumped by a single mysqldump.
+#MYSQLDUMP_JOBS=1
+#MYSQLDUMP_STAGING_DIR="\${TMPDIR:-/tmp}"
+# How long to wait for the global read lock and the snapshots (seconds)
+#MYSQLDUMP_LOCK_TIMEOUT=60
 # disable to enable autocommit
 #MYSQLDUMP_AUTOCOMMIT="1"
 # set to enable complete inserts (true by default, disabling enable extended inserts)
@@ -131,6 +314,20 @@ generate_configuration_file() {
 
 ######## Redis
 # REDIS_PATH="\${REDIS_PATH:-"/var/lib/redis"}"
+# How to get the data out of redis:
+#   "" (default): tar the whole REDIS_PATH
+#   "bgsave": trigger a BGSAVE, wait for LASTSAVE to move and stream
+#             only the fresh rdb file
+#   "rdb": fetch an rdb through the replication protocol
+#          (redis-cli --rdb), works against a remote server too
+# REDIS_BACKUP_MODE=""
+# REDIS_CLI="\${REDIS_CLI:-"redis-cli"}"
+# extra redis-cli arguments (eg: "-s /run/redis/redis.sock"),
+# HOST/PORT/PASSWORD are used otherwise
+# REDIS_CLI_ARGS=""
+# seconds between two polls of a running BGSAVE, and how long to wait for it
+# REDIS_POLL_INTERVAL="1"
+# REDIS_BGSAVE_TIMEOUT="3600"
 
 ######## Hooks (optionnal)
 # functions names which point to functions defined in your
@@ -184,7 +381,11 @@ EOF
 }
 
 fn_exists() {
-    echo $(LC_ALL=C;LANG=C;type ${1} 2>&1 | head -n1 | grep -q "is a function";echo $?)
+    if declare -F "${1}" >/dev/null 2>&1;then
+        echo 0
+    else
+        echo 1
+    fi
 }
 
 
@@ -192,12 +393,42 @@ print_name() {
     echo -e "[${__NAME__}]"
 }
 
+log_line() {
+    # print ${2} in color ${1} without forking: once the log file is
+    # active (see activate_IO_redirection), colored to the terminal and
+    # plain to the log file, else colored to stderr
+    if [ x"${DSB_LOG_DIRECT}" != "x" ];then
+        plain="${2}"
+        for color in "${RED}" "${YELLOW}" "${CYAN}" "${NORMAL}";do
+            if [ x"${color}" != "x" ];then
+                plain="${plain//"${color}"/}"
+            fi
+        done
+        printf "%b\n" "${1}${2}${NORMAL}" >&8
+        printf "%b\n" "${plain}" >&7
+    else
+        printf "%b\n" "${1}${2}${NORMAL}" 1>&2
+    fi
+}
+
 log() {
-    echo -e "${RED}$(print_name) ${@}${NORMAL}" 1>&2
+    log_line "${RED}" "[${__NAME__}] ${*}"
+}
+
+log_details() {
+    # log the lines of stdin (eg: one per unlinked file) with a single
+    # process; once the log file is active, they only go into it and the
+    # terminal only gets the summaries
+    if [ x"${DSB_LOG_DIRECT}" != "x" ];then
+        sed -e "s/^/[${__NAME__}]         * /" >&7
+    else
+        sed -e "s/^/$(printf "%b" "${RED}[${__NAME__}]         * ${YELLOW}")/"\
+            -e "s/\$/$(printf "%b" "${NORMAL}")/" 1>&2
+    fi
 }
 
 cyan_log() {
-    echo -e "${CYAN}${@}${NORMAL}" 1>&2
+    log_line "${CYAN}" "${*}"
 }
 
 die_() {
@@ -226,7 +457,7 @@ die_in_error() {
 }
 
 yellow_log(){
-    echo -e "${YELLOW}$(print_name) ${@}${NORMAL}" 1>&2
+    log_line "${YELLOW}" "[${__NAME__}] ${*}"
 }
 
 readable_date() {
@@ -240,7 +471,7 @@ debug() {
 }
 
 remove_files() {
-    for i in $@;do if [ -e $i ];then rm -f "$i";fi;done
+    for rfic in "$@";do if [ -e "$rfic" ];then rm -f "$rfic";fi;done
 }
 
 usage() {
@@ -250,18 +481,27 @@ usage() {
     yellow_log "        alias to --backup"
     yellow_log "     -b|--backup /path/toconfig:"
     yellow_log "        backup databases"
+    yellow_log "     -p|--prune /path/toconfig:"
+    yellow_log "        rotate and cleanup the backups"
+    yellow_log "     --verify-tree /path/toconfig:"
+    yellow_log "        audit the backups against their checksums"
+    yellow_log "     --daemon /path/toconfig:"
+    yellow_log "        stay resident and backup every DAEMON_INTERVAL seconds"
+    yellow_log "     --extract /path/to/dump [object]"
+    yellow_log "        print one table/member of a seekable dump, or list them"
     yellow_log "     --gen-config [/path/toconfig (default: ${DSB_CONF_FILE}_DEFAULT)]"
     yellow_log "        generate a new config file]"
 }
 
 runas() {
-    echo "${RUNAS:-"$(whoami)"}"
+    echo "${RUNAS:-"${DSB_WHOAMI}"}"
 }
 
 quote_all() {
+    # single quote each argument for the shell of su -c
     cmd=""
     for i in "${@}";do
-        cmd="${cmd} \"$(echo "${i}"|sed "s/\"/\"\'\"/g")\""
+        cmd="${cmd} '${i//\'/\'\\\'\'}'"
     done
     echo "${cmd}"
 }
@@ -270,11 +510,10 @@ runcmd_as() {
     cd "${RUNAS_DIR:-/}"
     bin="${1}"
     shift
-    args=$(quote_all "${@}")
-    if [ x"$(runas)" = "x" ] || [ x"$(runas)" = "x$(whoami)" ];then
+    if [ x"${RUNAS}" = "x" ] || [ x"${RUNAS}" = "x${DSB_WHOAMI}" ];then
         ${bin} "${@}"
     else
-        su ${RUNAS} -c "${bin} ${args}"
+        su ${RUNAS} -c "${bin} $(quote_all "${@}")"
     fi
 }
 
@@ -292,35 +531,101 @@ get_compressed_name() {
     fi
 }
 
+has_binary() {
+    [ x"${1}" != "x" ] && [ -e "$(command -v "${1}" 2>/dev/null)" ]
+}
+
 set_compressor() {
     for comp in ${COMP} ${COMPS};do
         c=""
         if [ x"${comp}" = "xxz" ];then
             XZ="${XZ:-xz}"
             c="${XZ}"
+            comp="xz"
         elif [ x"${comp}" = "xgz" ] || [ x"${comp}" = "xgzip" ];then
+            # prefer the parallel implementation when installed
+            if [ x"${GZIP}" = "x" ] && has_binary "${PIGZ-pigz}";then
+                GZIP="${PIGZ-pigz}"
+            fi
             GZIP="${GZIP:-gzip}"
             c="${GZIP}"
+            comp="gzip"
         elif [ x"${comp}" = "xbzip2" ] || [ x"${comp}" = "xbz2" ];then
+            if [ x"${BZIP2}" = "x" ] && has_binary "${PBZIP2-pbzip2}";then
+                BZIP2="${PBZIP2-pbzip2}"
+            fi
             BZIP2="${BZIP2:-bzip2}"
             c="${BZIP2}"
+            comp="bzip2"
         elif [ x"${comp}" = "xzstd" ] || [ x"${comp}" = "xzst" ];then
             ZSTD="${ZSTD:-zstd}"
             c="${ZSTD}"
+            comp="zstd"
         else
             c="nocomp"
         fi
         # test that the binary is present
-        if [ x"$c" != "xnocomp" ] && [ -e "$(which "$c")" ];then
-            COMP=$c
+        if [ x"$c" != "xnocomp" ] && has_binary "$c";then
+            COMP=$comp
             break
         else
             COMP="nocomp"
         fi
     done
+    set_compressor_args
     export COMP=$COMP
 }
 
+set_compressor_args() {
+    # level & threads flags for the selected compressor
+    COMP_ARGS=""
+    COMP_CMD=""
+    level=""
+    if [ x"${COMP_LEVEL}" != "x" ];then
+        level="-${COMP_LEVEL}"
+    fi
+    if [ x"${COMP}" = "xxz" ];then
+        COMP_CMD="${XZ}"
+        COMP_ARGS="${level}"
+        # multithreading appeared in xz 5.2
+        if [ x"${DSB_XZ_THREADS+set}" = "x" ];then
+            DSB_XZ_THREADS=""
+            if "${XZ}" --help 2>/dev/null|grep -q -- "--threads";then
+                DSB_XZ_THREADS="1"
+            fi
+        fi
+        if [ x"${DSB_XZ_THREADS}" != "x" ];then
+            COMP_ARGS="${COMP_ARGS} -T${COMP_THREADS:-0}"
+        fi
+    elif [ x"${COMP}" = "xgzip" ];then
+        COMP_CMD="${GZIP}"
+        COMP_ARGS="${level}"
+        if [ x"${DEDUP_STORE}" != "x" ];then
+            # no name/timestamp in the header, for identical dumps
+            COMP_ARGS="${COMP_ARGS} -n"
+        fi
+        if [ x"$(basename "${GZIP}")" = "xpigz" ] && [ x"${COMP_THREADS}" != "x" ];then
+            COMP_ARGS="${COMP_ARGS} -p ${COMP_THREADS}"
+        fi
+    elif [ x"${COMP}" = "xbzip2" ];then
+        COMP_CMD="${BZIP2}"
+        COMP_ARGS="${level}"
+        if [ x"$(basename "${BZIP2}")" = "xpbzip2" ] && [ x"${COMP_THREADS}" != "x" ];then
+            COMP_ARGS="${COMP_ARGS} -p${COMP_THREADS}"
+        fi
+    elif [ x"${COMP}" = "xzstd" ];then
+        COMP_CMD="${ZSTD}"
+        COMP_ARGS="-q ${level} -T${COMP_THREADS:-0}"
+        if [ "${COMP_LEVEL:-0}" -gt "19" ] 2>/dev/null;then
+            COMP_ARGS="--ultra ${COMP_ARGS}"
+        fi
+    fi
+    COMP_ARGS="$(echo ${COMP_ARGS})"
+    if [ x"${COMP_CMD}" != "x" ];then
+        COMP_CMD="${COMP_CMD} ${COMP_ARGS}"
+    fi
+}
+
 comp_msg() {
     sz="";s1="";s2="";ratio=""
     if [ -e "$zname" ];then
@@ -339,54 +644,166 @@ comp_msg() {
 
 cleanup_uncompressed_dump_if_ok() {
     comp_msg
-    dumpfiles=""
-    if [ x"$?" != x"0" ];then
-        dumpfiles="${zname}"
+    if [ x"${1:-0}" != x"0" ];then
+        # the compressed dump is unusable, keep the raw one if any
+        remove_files "${zname}"
+    elif [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+        remove_files "${name}"
+    fi
+}
+
+compress_stream() {
+    # compress stdin to stdout
+    if [ x"${COMP}" = "xxz" ];then
+        "${XZ}" ${COMP_ARGS} --stdout -f
+    elif [ x"${COMP}" = "xgz" ] || [ x"${COMP}" = "xgzip" ];then
+        "${GZIP}" ${COMP_ARGS} -f -c
+    elif [ x"${COMP}" = "xbzip2" ] || [ x"${COMP}" = "xbz2" ];then
+        "${BZIP2}" ${COMP_ARGS} -f -c
+    elif [ x"${COMP}" = "xzstd" ] || [ x"${COMP}" = "xzst" ];then
+        if [ x"${DIFF_REFERENCE}" != "x" ];then
+            # differential dump (see diff_base)
+            "${ZSTD}" ${COMP_ARGS} --patch-from="${DIFF_REFERENCE}"\
+                --stream-size="${DIFF_STREAM_SIZE}" -f -c
+        else
+            "${ZSTD}" ${COMP_ARGS} -f -c
+        fi
+    else
+        cat
+    fi
+}
+
+throttle_settings() {
+    # resolve the throttling of database ${1} at the current hour in
+    # DB_THROTTLE_RATE, DB_NICE_LEVEL, DB_IONICE_CLASS & DB_COMP_THREADS
+    DB_THROTTLE_RATE="${THROTTLE_RATE}"
+    DB_NICE_LEVEL="${NICE_LEVEL}"
+    DB_IONICE_CLASS="${IONICE_CLASS}"
+    DB_COMP_THREADS="${COMP_THREADS}"
+    hour="$(date +%H)"
+    hour="$((10#${hour}))"
+    # rules are globs, do not expand them against the current directory
+    set -f
+    for rule in ${THROTTLE_RULES};do
+        target="${rule%%:*}"
+        glob="${target%%@*}"
+        case "${1}" in
+            ${glob}) ;;
+            *) continue;;
+        esac
+        if [ "x${glob}" != "x${target}" ];then
+            window="${target#*@}"
+            from="$((10#${window%-*}))"
+            to="$((10#${window#*-}))"
+            if [ "${from}" -le "${to}" ];then
+                if [ "${hour}" -lt "${from}" ] || [ "${hour}" -ge "${to}" ];then
+                    continue
+                fi
+            # window over midnight (eg: 22-06)
+            elif [ "${hour}" -lt "${from}" ] && [ "${hour}" -ge "${to}" ];then
+                continue
+            fi
+        fi
+        for setting in $(echo "${rule#*:}"|sed -e "s/,/ /g");do
+            value="${setting#*=}"
+            case "${setting%%=*}" in
+                rate) DB_THROTTLE_RATE="${value}";;
+                nice) DB_NICE_LEVEL="${value}";;
+                ionice) DB_IONICE_CLASS="${value}";;
+                threads) DB_COMP_THREADS="${value}";;
+            esac
+        done
+        break
+    done
+    set +f
+}
+
+throttle_process() {
+    # apply the niceness & io class to the current (sub)shell, inherited
+    # by all the commands it then runs
+    if [ "x${DB_NICE_LEVEL}" != "x" ];then
+        renice -n "${DB_NICE_LEVEL}" -p "${BASHPID}" >/dev/null
     fi
-    if [ x"$?" = x"0" ];then
-        if [ "${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
-            dumpfiles="${name}"
+    if [ "x${DB_IONICE_CLASS}" != "x" ];then
+        level=""
+        if [ "x${DB_IONICE_CLASS}" != "x${DB_IONICE_CLASS#*/}" ];then
+            level="-n ${DB_IONICE_CLASS#*/}"
         fi
+        ionice -c "${DB_IONICE_CLASS%%/*}" ${level} -p "${BASHPID}"
+    fi
+    if [ "x${DB_COMP_THREADS}" != "x${COMP_THREADS}" ];then
+        COMP_THREADS="${DB_COMP_THREADS}"
+        set_compressor_args
+    fi
+}
+
+throttle_stream() {
+    # rate limit stdin to stdout
+    if [ "x${DB_THROTTLE_RATE}" != "x" ] && has_binary "${PV}";then
+        "${PV}" -q -L "${DB_THROTTLE_RATE}"
+    else
+        cat
+    fi
+}
+
+throttled_dump() {
+    # run the dump function & args ${@} throttled, in a subshell
+    throttle_process
+    if [ "x${DB_THROTTLE_RATE}" != "x" ] && [ "x${PIPED_BACKUP_COMPRESSION}" = "x1" ];then
+        set -o pipefail
+        "${@}" | throttle_stream
+    else
+        "${@}"
+    fi
+}
+
+checksum_stream() {
+    # copy stdin to stdout, writing its checksum to ${1}
+    if [ x"${CHECKSUM}" = "x" ] || [ x"${1}" = "x" ];then
+        cat
+    else
+        { tee /dev/fd/3 | "${CHECKSUM}sum" > "${1}"; } 3>&1
+    fi
+}
+
+compress_to() {
+    # compress stdin to ${1} (see dump_stream), checksumming the result
+    # into ${2} and offloading it (see S3_URL) on the way
+    if [ x"${S3_URL}" != "x" ];then
+        ( set -o pipefail; dump_stream "${1}" | checksum_stream "${2}"\
+            | offload_stream "${1}" > "${1}" )
+    elif [ x"${CHECKSUM}" != "x" ] && [ x"${2}" != "x" ];then
+        ( set -o pipefail; dump_stream "${1}" | checksum_stream "${2}" > "${1}" )
+    else
+        dump_stream "${1}" > "${1}"
     fi
-    remove_files "$dumpfiles"
 }
 
 do_compression() {
+    # ${3}: optional file to write the checksum of the compressed dump to
     COMPRESSED_NAME=""
     name="${1}"
     zname="${2:-$(get_compressed_name ${1})}"
-    if [ x"${COMP}" = "xxz" ];then
-        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
-            "${XZ}" --stdout -f -k "${name}" > "${zname}"
+    sumfile="${3:-}"
+    comp_status="0"
+    if [ x"${zname}" != "x${name}" ];then
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ] && [ "x${DB_THROTTLE_RATE}" != "x" ];then
+            throttle_stream < "${name}" | compress_to "${zname}" "${sumfile}"
+        elif [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            compress_to "${zname}" "${sumfile}" < "${name}"
         else
-            "${XZ}" --stdout -f -k > "${zname}"
+            compress_to "${zname}" "${sumfile}"
         fi
-        cleanup_uncompressed_dump_if_ok
-    elif [ x"${COMP}" = "xgz" ] || [ x"${COMP}" = "xgzip" ];then
-        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
-            "${GZIP}" -f -c "${name}" > "${zname}"
-        else
-            "${GZIP}" -f -c > "${zname}"
-        fi
-        cleanup_uncompressed_dump_if_ok
-    elif [ x"${COMP}" = "xbzip2" ] || [ x"${COMP}" = "xbz2" ];then
-        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
-            "${BZIP2}" -f -k -c "${name}" > "${zname}"
-        else
-            "${BZIP2}" -f -k -c > "${zname}"
-        fi
-        cleanup_uncompressed_dump_if_ok
-    elif [ x"${COMP}" = "xzstd" ] || [ x"${COMP}" = "xzst" ];then
-        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
-            "${ZSTD}" -f -c -q "${name}" > "${zname}"
-        else
-            "${ZSTD}" -f -c -q > "${zname}"
-        fi
-        cleanup_uncompressed_dump_if_ok
-    else
-        /bin/true # noop
+        comp_status="${?}"
+        cleanup_uncompressed_dump_if_ok "${comp_status}"
+    elif [ "x${PIPED_BACKUP_COMPRESSION}" = "x1" ];then
+        # no compressor, but we still have to store the stream
+        ( set -o pipefail; checksum_stream "${sumfile}" | offload_stream "${zname}" > "${zname}" )
+        comp_status="${?}"
     fi
-    if ( [ -e "${zname}" ] && [ x"${zname}" != "x${name}" ] ) || [ "${PIPED_BACKUP_COMPRESSION}" = "x1" ];then
+    if [ x"${comp_status}" != "x0" ];then
+        log "Compression error"
+    elif ( [ -e "${zname}" ] && [ x"${zname}" != "x${name}" ] ) || [ "x${PIPED_BACKUP_COMPRESSION}" = "x1" ];then
         COMPRESSED_NAME="${zname}"
     else
         if [ -e "${name}" ];then
@@ -394,11 +811,13 @@ do_compression() {
             COMPRESSED_NAME="${name}"
         else
             log "Compression error"
+            comp_status="1"
         fi
     fi
     if [ x"${COMPRESSED_NAME}" != "x" ];then
-        fix_perm "${fic}"
+        fix_perm "${COMPRESSED_NAME}"
     fi
+    return ${comp_status}
 }
 
 get_logsdir() {
@@ -406,6 +825,11 @@ get_logsdir() {
     echo "$dir"
 }
 
+get_metricsdir() {
+    # empty if the metrics are disabled
+    echo "${METRICS_DIR-${TOP_BACKUPDIR}/metrics}"
+}
+
 get_logfile() {
     filen="$(get_logsdir)/${__NAME__}_${FULL_FDATE}.log"
     echo ${filen}
@@ -421,6 +845,10 @@ get_backupdir() {
         if [ -e $host ];then
             host="localhost"
         fi
+        # each cluster of a host has its own directory (and lock)
+        if [ x"${PORT}" != "x" ] && [ x"${PORT}" != "x5432" ];then
+            host="${host}_${PORT}"
+        fi
         dir="$dir/$host"
     fi
     echo "$dir"
@@ -429,7 +857,6 @@ get_backupdir() {
 create_db_directories() {
     db="${1}"
     dbdir="$(get_backupdir)/${db}"
-    created="0"
     for d in\
         "$dbdir"\
         "$dbdir/weekly"\
@@ -437,43 +864,973 @@ create_db_directories() {
         "$dbdir/dumps"\
         "$dbdir/daily"\
         "$dbdir/lastsnapshots"\
+        "$dbdir/.dsb"\
         ;do
         if [ ! -e "$d" ];then
             mkdir -p "$d"
-            created="1"
+            fix_perm "$d"
         fi
     done
-    if [ x"${created}" = "x1" ];then
-        fix_perms
+}
+
+link_into_chrono_dir() {
+    # hard link ${2} to ${3} and remember it for the rotation index
+    chrono="${1}"
+    if [ ! -e "${3}" ];then
+        ln "${2}" "${3}"\
+            && DSB_INDEX_LINES="${DSB_INDEX_LINES}${chrono}${DSB_TAB}${3##*/}
+"
     fi
 }
 
 link_into_dirs() {
+    # ${3}: optional existing dump to link instead of the one of this run
     db="${1}"
     real_filename="${2}"
-    real_zfilename="$(get_compressed_name "${real_filename}")"
-    daily_filename="$(get_backupdir)/${db}/daily/${db}_${YEAR}_${DOY}_${DATE}.${BACKUP_EXT}"
-    lastsnapshots_filename="$(get_backupdir)/${db}/lastsnapshots/${db}_${YEAR}_${DOY}_${FDATE}.${BACKUP_EXT}"
-    weekly_filename="$(get_backupdir)/${db}/weekly/${db}_${YEAR}_${W}.${BACKUP_EXT}"
-    monthly_filename="$(get_backupdir)/${db}/monthly/${db}_${YEAR}_${MNUM}.${BACKUP_EXT}"
+    real_zfilename="${3:-$(get_compressed_name "${real_filename}")}"
+    # same format than the dump (see DB_BACKUP_EXT)
+    ext="${real_filename##*.}"
+    dbdir="$(get_backupdir)/${db}"
+    daily_filename="${dbdir}/daily/${db}_${YEAR}_${DOY}_${DATE}.${ext}"
+    lastsnapshots_filename="${dbdir}/lastsnapshots/${db}_${YEAR}_${DOY}_${FDATE}.${ext}"
+    weekly_filename="${dbdir}/weekly/${db}_${YEAR}_${W}.${ext}"
+    monthly_filename="${dbdir}/monthly/${db}_${YEAR}_${MNUM}.${ext}"
     lastsnapshots_zfilename="$(get_compressed_name "${lastsnapshots_filename}")"
     daily_zfilename="$(get_compressed_name "${daily_filename}")"
     weekly_zfilename="$(get_compressed_name "$weekly_filename")"
     monthly_zfilename="$(get_compressed_name "${monthly_filename}")"
-    if [ ! -e "${daily_zfilename}" ];then
-        ln "${real_zfilename}" "${daily_zfilename}"
+    index_fresh=""
+    if index_is_fresh "${dbdir}";then
+        index_fresh="1"
+    fi
+    DSB_INDEX_LINES=""
+    link_into_chrono_dir daily "${real_zfilename}" "${daily_zfilename}"
+    link_into_chrono_dir weekly "${real_zfilename}" "${weekly_zfilename}"
+    link_into_chrono_dir monthly "${real_zfilename}" "${monthly_zfilename}"
+    link_into_chrono_dir lastsnapshots "${real_zfilename}" "${lastsnapshots_zfilename}"
+    if [ x"${index_fresh}" != "x" ];then
+        printf "%s" "${DSB_INDEX_LINES}" | index_append "${dbdir}" "${real_zfilename}"
+    else
+        # let the next rotation rebuild it from what is on disk
+        remove_files "${dbdir}/.dsb/index"
+    fi
+}
+
+# DEDUPLICATION STORE
+# With DEDUP_STORE, each dump is addressed by its content in
+# <db>/.dsb/store/<sha256> and the file in dumps/ (thus also its chronoted
+# links) is a hard link to this object. The dumps/ & chrono directories
+# are kept as a view on top of the store; the orphans cleanup drops the
+# objects which are no longer linked from any chrono directory.
+dedup_into_store() {
+    # ${3}: optional file with the sha256 checksum computed while writing
+    store="${1}/.dsb/store"
+    zfile="${2}"
+    if [ ! -f "${zfile}" ];then
+        return 0
+    fi
+    hash=""
+    if [ x"${CHECKSUM}" = "xsha256" ] && [ -s "${3:-}" ];then
+        read hash _ < "${3}"
+    fi
+    if [ x"${hash}" = "x" ];then
+        hash="$(sha256sum "${zfile}"|awk '{print $1}')"
+    fi
+    obj="${store}/${hash}"
+    if [ ! -e "${store}" ];then
+        mkdir -p "${store}"
+    fi
+    if [ -f "${obj}" ];then
+        ln -f "${obj}" "${zfile}.dsb" && mv -f "${zfile}.dsb" "${zfile}"
+        log "    Unchanged dump, reusing ${YELLOW}${hash}${NORMAL}"
+    else
+        ln "${zfile}" "${obj}"
+    fi
+}
+
+sweep_dedup_store() {
+    # One find walk, grouped by inode: drop the store objects and their
+    # dumps/ names once no chrono directory references them anymore and,
+    # for the objects still in use, keep only the newest dumps/ name.
+    # Prints a "P<TAB>size<TAB>path" line for each removed file
+    if [ ! -d "$(get_backupdir)" ];then
+        return 0
+    fi
+    find "$(get_backupdir)" -mindepth 3 -maxdepth 4 -type f \
+        \( -path "*/.dsb/store/*" -o ! -path "*/.dsb/*" \) \
+        -printf "%i\t%s\t%P\t%p\n" 2>/dev/null|\
+        awk -F"\t" '
+        {
+            split($3, parts, "/")
+            if (parts[2] == "dumps") {
+                dumps[$1] = dumps[$1] "\n" $4
+                if ($4 > newest[$1]) { newest[$1] = $4 }
+            } else if (parts[2] == ".dsb") {
+                objects[$1] = $4
+            } else {
+                used[$1] = 1
+            }
+            sizes[$1] = $2
+        }
+        function prune(path, size) {
+            print "P\t" size "\t" path
+            print path | "xargs -r -d \"\\n\" rm -f"
+        }
+        END {
+            for (inode in objects) {
+                if (!(inode in used)) { prune(objects[inode], sizes[inode]) }
+            }
+            for (inode in dumps) {
+                n = split(substr(dumps[inode], 2), files, "\n")
+                for (i = 1; i <= n; i++) {
+                    if ((inode in used) && (files[i] == newest[inode])) {
+                        continue
+                    }
+                    prune(files[i], 0)
+                }
+            }
+        }'
+}
+
+# DIFFERENTIAL DUMPS
+# With DIFF_BACKUPS, the dumps are zstd encoded against the last full dump
+# of their database (--patch-from) until DIFF_FULL_EVERY runs. Each
+# database directory keeps:
+#   .dsb/chain: "dump name<TAB>base name<TAB>inode" for each dump, the base
+#       being "-" for the full dumps
+#   .dsb/bases/<full dump>: a hard link to each full dump still needed,
+#       which the rotation and the orphans cleanup never prune
+# sweep_diff_bases releases the bases once no kept dump needs them.
+diff_base() {
+    # print the base the next dump of ${1} should be encoded against, or
+    # nothing if it must be a full one
+    dbdir="$(get_backupdir)/${1}"
+    if [ x"${DIFF_BACKUPS}" = "x" ] || [ x"${COMP}" != "xzstd" ] ||\
+        [ ! -f "${dbdir}/.dsb/chain" ];then
+        return 0
+    fi
+    base="$(awk -F"\t" -v every="${DIFF_FULL_EVERY}" '
+        $2 == "-" { base = $1; n = 0; next }
+        { n++ }
+        END { if (base != "" && n + 1 < every + 0) { print base } }' "${dbdir}/.dsb/chain")"
+    if [ x"${base}" != "x" ] && [ -f "${dbdir}/.dsb/bases/${base}" ];then
+        echo "${dbdir}/.dsb/bases/${base}"
+    fi
+}
+
+diff_base_of() {
+    # print the base of the differential dump ${1} (in dumps/ or a chrono
+    # directory), nothing for a full dump
+    dbdir="$(dirname "$(dirname "${1}")")"
+    if [ ! -f "${dbdir}/.dsb/chain" ];then
+        return 0
+    fi
+    awk -F"\t" -v name="${1##*/}" -v ino="$(stat -c %i "${1}" 2>/dev/null)"\
+        -v bases="${dbdir}/.dsb/bases/" '
+        $1 == name || $3 == ino { base = $2 }
+        END { if (base != "" && base != "-") { print bases base } }' "${dbdir}/.dsb/chain"
+}
+
+diff_reference() {
+    # decompress the base ${1} to a temporary file for --patch-from
+    reference="$(mktemp)"
+    if [ -f "${1}" ] && decompress_stream "${1}" > "${reference}" 2>/dev/null;then
+        echo "${reference}"
+    else
+        remove_files "${reference}"
+        return 1
+    fi
+}
+
+diff_decompress() {
+    # decompress the differential dump ${1} encoded against ${2}
+    reference="$(diff_reference "${2}")" || return 1
+    "${ZSTD:-zstd}" -dcq --long=31 --patch-from="${reference}" "${1}"
+    diff_status="${?}"
+    remove_files "${reference}"
+    return ${diff_status}
+}
+
+record_chain() {
+    # add the dump ${2} of ${1} to its chain, encoded against the base
+    # ${3} or, without, as the base of the next differential dumps
+    dbdir="$(get_backupdir)/${1}"
+    if [ x"${DIFF_BACKUPS}" = "x" ] || [ x"${COMP}" != "xzstd" ] || [ ! -f "${2}" ];then
+        return 0
+    fi
+    base="-"
+    if [ x"${3}" != "x" ];then
+        base="${3##*/}"
+    else
+        if [ ! -d "${dbdir}/.dsb/bases" ];then
+            mkdir -p "${dbdir}/.dsb/bases"
+        fi
+        ln -f "${2}" "${dbdir}/.dsb/bases/${2##*/}"
+    fi
+    printf "%s\t%s\t%s\n" "${2##*/}" "${base}" "$(stat -c %i "${2}")"\
+        >> "${dbdir}/.dsb/chain"
+}
+
+sweep_diff_bases() {
+    # Forget the pruned dumps in the chains and release the bases no kept
+    # differential dump needs anymore (the current one is kept while
+    # DIFF_BACKUPS is set).
+    # Prints a "P<TAB>size<TAB>path" line for each base whose space is freed
+    for chain in "$(get_backupdir)"/*/.dsb/chain;do
+        if [ ! -f "${chain}" ];then
+            continue
+        fi
+        dbdir="${chain%/.dsb/chain}"
+        find "${dbdir}" -mindepth 2 -maxdepth 3 -type f ! -path "*/.dsb/store/*"\
+            -printf "%i\t%n\t%s\t%P\n" 2>/dev/null\
+            | awk -F"\t" -v OFS="\t" -v chain="${chain}" -v dbdir="${dbdir}"\
+                -v current="${DIFF_BACKUPS}" '
+            FNR == NR {
+                split($4, parts, "/")
+                if (parts[1] == "dumps") {
+                    dumps[parts[2]] = $1
+                } else if (parts[1] == ".dsb" && parts[2] == "bases") {
+                    bases[parts[3]] = $2 == 1 ? $3 : -1
+                } else if (parts[1] ~ /^(daily|weekly|monthly|lastsnapshots)$/) {
+                    used[$1] = 1
+                }
+                next
+            }
+            { n++; lines[n] = $0; names[n] = $1; base[n] = $2; if ($2 == "-") { last = n } }
+            END {
+                if (current != "" && last) { needed[names[last]] = 1 }
+                for (i = 1; i <= n; i++) {
+                    alive[i] = (names[i] in dumps) && (dumps[names[i]] in used)
+                    if (base[i] != "-" && (alive[i] || i > last)) { needed[base[i]] = 1 }
+                }
+                for (i = 1; i <= n; i++) {
+                    if (i >= last || alive[i] || needed[names[i]]) {
+                        print lines[i] > (chain ".tmp")
+                    }
+                }
+                for (name in bases) {
+                    if (needed[name]) { continue }
+                    if (bases[name] >= 0) { print "P", bases[name], dbdir "/.dsb/bases/" name }
+                    print dbdir "/.dsb/bases/" name | "xargs -r -d \"\\n\" rm -f"
+                }
+            }' - "${chain}"
+        if [ -f "${chain}.tmp" ];then
+            mv -f "${chain}.tmp" "${chain}"
+        else
+            remove_files "${chain}"
+        fi
+    done
+}
+
+# SEEKABLE DUMPS
+# With SEEKABLE_BACKUPS, the dumps are compressed as independent frames
+# (xz streams, zstd frames...: the decompressors read them one after the
+# other) of SEEKABLE_FRAME_SIZE uncompressed bytes, and each database
+# directory keeps a table of contents of its dumps in .dsb/toc/<dump name>
+# (tab separated lines):
+#   F, raw offset, raw size, compressed offset, compressed size: a frame
+#   O, kind, name, raw offset, raw size: an object of the dump
+# do_extract then only decompresses the frames holding an object.
+toc_path() {
+    # print the table of contents of the dump ${1} (in dumps/ or a chrono
+    # directory)
+    dbdir="$(dirname "$(dirname "${1}")")"
+    name="${1##*/}"
+    if [ ! -f "${dbdir}/.dsb/toc/${name}" ];then
+        dump="$(find "${dbdir}/dumps" -maxdepth 1 -samefile "${1}" 2>/dev/null|head -n 1)"
+        if [ x"${dump}" != "x" ];then
+            name="${dump##*/}"
+        fi
+    fi
+    echo "${dbdir}/.dsb/toc/${name}"
+}
+
+toc_objects() {
+    # print the "O" lines of the uncompressed dump on stdin, a ${1} file:
+    # the tables of the mysqldump & plain pg_dump ones (up to the next
+    # marker), the members of the tar archives
+    case "${1}" in
+        sql)
+            LC_ALL=C awk -v OFS="\t" '
+                function end_object() {
+                    if (object != "") { print "O", kind, object, start, offset - start }
+                    object = ""
+                }
+                function begin_object(k, name) {
+                    end_object(); kind = k; object = name; start = offset
+                }
+                /^-- Current Database: `/ {
+                    end_object()
+                    db = $0; sub(/^-- Current Database: `/, "", db); sub(/`[^`]*$/, "", db)
+                }
+                /^-- Table structure for table `/ {
+                    name = $0; sub(/^-- Table structure for table `/, "", name)
+                    sub(/`[^`]*$/, "", name)
+                    begin_object("table", (db != "" ? db "." : "") name)
+                }
+                /^-- Dumping (routines|events) / { end_object() }
+                /^-- (Data for )?Name: .*; Type: .*; Schema: / {
+                    name = $0; sub(/^-- (Data for )?Name: /, "", name); sub(/; Type: .*$/, "", name)
+                    type = $0; sub(/^.*; Type: /, "", type); sub(/; Schema: .*$/, "", type)
+                    schema = $0; sub(/^.*; Schema: /, "", schema); sub(/;.*$/, "", schema)
+                    begin_object(tolower(type), (schema != "-" ? schema "." : "") name)
+                }
+                { offset += length($0) + 1 }
+                END { end_object() }';;
+        tar)
+            # a member spans its header block and its data blocks
+            { tar -tvR -f - 2>/dev/null; cat > /dev/null; }\
+                | awk -v OFS="\t" '
+                /^block [0-9]+: [^*]/ {
+                    name = $0
+                    sub(/^block [0-9]+: +[^ ]+ +[^ ]+ +[0-9]+ +[^ ]+ +[^ ]+ +/, "", name)
+                    sub(/ -> .*$/, "", name)
+                    print "O", "member", name, substr($2, 1, length($2) - 1) * 512,
+                        512 + int(($5 + 511) / 512) * 512
+                }';;
+        *) cat > /dev/null;;
+    esac
+}
+
+seekable_stream() {
+    # compress stdin to stdout as independent frames, writing the table of
+    # contents of this ${2} dump to ${1}
+    workdir="$(mktemp -d)"
+    touch "${workdir}/frames"
+    mkfifo "${workdir}/raw"
+    toc_objects "${2}" < "${workdir}/raw" > "${workdir}/objects" &
+    objects_pid="${!}"
+    tee -p "${workdir}/raw" | {
+        offset="0"
+        zoffset="0"
+        while true;do
+            head -c "${SEEKABLE_FRAME_SIZE}" > "${workdir}/frame"
+            size="$(file_size "${workdir}/frame")"
+            if [ x"${size}" = "x0" ];then
+                break
+            fi
+            compress_stream < "${workdir}/frame" > "${workdir}/frame.z" || exit 1
+            zsize="$(file_size "${workdir}/frame.z")"
+            printf "F\t%s\t%s\t%s\t%s\n" "${offset}" "${size}" "${zoffset}" "${zsize}"\
+                >> "${workdir}/frames"
+            cat "${workdir}/frame.z" || exit 1
+            offset="$((offset + size))"
+            zoffset="$((zoffset + zsize))"
+        done
+    }
+    frames_status="${?}"
+    wait "${objects_pid}"
+    if [ x"${frames_status}" = "x0" ];then
+        if [ ! -d "${1%/*}" ];then
+            mkdir -p "${1%/*}"
+        fi
+        cat "${workdir}/frames" "${workdir}/objects" > "${1}.tmp" && mv -f "${1}.tmp" "${1}"
+    fi
+    rm -rf "${workdir}"
+    return ${frames_status}
+}
+
+dump_stream() {
+    # compress stdin to stdout for the dump ${1}, as seekable frames with
+    # SEEKABLE_BACKUPS (but for the differential dumps)
+    if [ x"${SEEKABLE_BACKUPS}" != "x" ] && [ x"${DIFF_REFERENCE}" = "x" ];then
+        uncompressed="${1%.*}"
+        seekable_stream "$(dirname "$(dirname "${1}")")/.dsb/toc/${1##*/}" "${uncompressed##*.}"
+    else
+        compress_stream
+    fi
+}
+
+sweep_tocs() {
+    # drop the tables of contents of the pruned dumps
+    for toc in "$(get_backupdir)"/*/.dsb/toc/*;do
+        if [ -f "${toc}" ] && [ ! -e "${toc%/.dsb/toc/*}/dumps/${toc##*/}" ];then
+            rm -f "${toc}"
+        fi
+    done
+}
+
+do_extract() {
+    # print the object ${2} of the seekable dump ${1} (or all the objects
+    # under ${2} when it ends with a /), reading & decompressing only its
+    # frames; without ${2}, list the objects of the dump
+    toc="$(toc_path "${1}")"
+    if [ ! -f "${1}" ] || [ ! -f "${toc}" ];then
+        die "${1} is not a seekable dump"
+    fi
+    if [ x"${2}" = "x" ];then
+        awk -F"\t" -v OFS="\t" '$1 == "O" { print $2, $3, $5 }' "${toc}"
+        return 0
+    fi
+    # "compressed offset<TAB>compressed size<TAB>skip<TAB>size" for each run
+    # of contiguous objects to extract
+    ranges="$(awk -F"\t" -v OFS="\t" -v object="${2}" '
+        $1 == "F" { n++; roff[n] = $2; rsize[n] = $3; zoff[n] = $4; zsize[n] = $5; next }
+        $1 == "O" && ($3 == object || (object ~ /\/$/ && index($3, object) == 1)) {
+            if (r && $4 == stop[r]) { stop[r] = $4 + $5; next }
+            r++; begin[r] = $4; stop[r] = $4 + $5
+        }
+        END {
+            for (i = 1; i <= r; i++) {
+                first = 0
+                for (f = 1; f <= n; f++) {
+                    if (roff[f] + rsize[f] <= begin[i]) { continue }
+                    if (roff[f] >= stop[i]) { break }
+                    if (!first) { first = f }
+                    last = f
+                }
+                if (first) {
+                    print zoff[first], zoff[last] + zsize[last] - zoff[first],
+                        begin[i] - roff[first], stop[i] - begin[i]
+                }
+            }
+        }' "${toc}")"
+    if [ x"${ranges}" = "x" ];then
+        die "No ${2} in ${1}"
+    fi
+    while IFS="${DSB_TAB}" read -r zoffset zsize skip size;do
+        tail -c +"$((zoffset + 1))" "${1}" | head -c "${zsize}" | decompress_pipe "${1}"\
+            | tail -c +"$((skip + 1))" | head -c "${size}"
+    done <<< "${ranges}"
+}
+
+# CHECKSUMS
+# Each database directory has a .dsb/checksums manifest with one line per
+# dump (tab separated):
+#   dump name, algorithm, checksum, size, mtime, last verification
+# The checksum is computed while the dump is compressed, the size & mtime
+# let do_verify_tree re-hash only what changed since it was recorded.
+record_checksum() {
+    # ${3}: file with the checksum computed while writing ${2}, if any
+    zfile="${2}"
+    if [ x"${CHECKSUM}" = "x" ] || [ ! -f "${zfile}" ];then
+        return 0
+    fi
+    hash=""
+    if [ -s "${3:-}" ];then
+        read hash _ < "${3}"
+    fi
+    if [ x"${hash}" = "x" ];then
+        hash="$("${CHECKSUM}sum" "${zfile}"|awk '{print $1}')"
+    fi
+    printf "%s\t%s\t%s\t%s\t%s\n" "${zfile##*/}" "${CHECKSUM}" "${hash}"\
+        "$(stat -c "%s${DSB_TAB}%Y" "${zfile}")" "$(date +%s)"\
+        >> "$(get_backupdir)/${1}/.dsb/checksums"
+}
+
+verify_tree_db() {
+    # compare the database directory ${1} with its manifest, ${3} being
+    # the audit time: the dumps to re-hash are appended to ${2}/todo and
+    # the problems to ${2}/report ("kind<TAB>path" lines)
+    dbdir="${1}"
+    manifest="${dbdir}/.dsb/checksums"
+    index="${dbdir}/.dsb/index"
+    for i in "${manifest}" "${index}";do
+        if [ ! -e "${i}" ];then
+            touch "${i}"
+        fi
+    done
+    find "${dbdir}" -mindepth 2 -maxdepth 2 -type f ! -path "${dbdir}/.dsb/*"\
+        -printf "%i\t%s\t%Ts\t%P\n" 2>/dev/null\
+        | awk -F"\t" -v OFS="\t" -v dbdir="${dbdir}" -v manifest="${manifest}"\
+            -v rindex="${index}" -v algo="${CHECKSUM}" -v now="${3}"\
+            -v maxage="$((VERIFY_TREE_DAYS * 86400))"\
+            -v todo="${2}/todo" -v report="${2}/report" '
+        FILENAME == manifest { recs[$1] = $0; next }
+        FILENAME == rindex { links[$1 "/" $3] = $4; next }
+        {
+            chrono = $4; sub(/\/.*$/, "", chrono)
+            name = substr($4, length(chrono) + 2)
+            if (chrono == "dumps") {
+                dumps[$1] = name; sizes[name] = $2; mtimes[name] = $3
+            } else {
+                chronos[$4] = $1
+            }
+            files[$4] = 1
+        }
+        END {
+            for (name in sizes) {
+                stale = !(name in recs)
+                if (!stale) {
+                    split(recs[name], r, "\t")
+                    stale = (r[2] != algo || r[4] != sizes[name]\
+                             || r[5] != mtimes[name] || now - r[6] > maxage)
+                }
+                if (stale) { print dbdir "/dumps/" name >> todo }
+            }
+            for (path in chronos) {
+                if (!(chronos[path] in dumps)) {
+                    print "L", dbdir "/" path >> report
+                }
+            }
+            for (link in links) {
+                if (!(link in files)) {
+                    print "I", dbdir "/" link >> report
+                } else if (links[link] != "-" && !(("dumps/" links[link]) in files)) {
+                    print "I", dbdir "/dumps/" links[link] >> report
+                }
+            }
+        }' "${manifest}" "${index}" -
+}
+
+verify_tree_manifest() {
+    # rewrite the manifest of ${1} with the checksums of ${2}/hashes made
+    # at ${3}, reporting the dumps which do not match their recorded one
+    dbdir="${1}"
+    manifest="${dbdir}/.dsb/checksums"
+    find "${dbdir}/dumps" -mindepth 1 -maxdepth 1 -type f\
+        -printf "%f\t%s\t%Ts\n" 2>/dev/null\
+        | awk -F"\t" -v OFS="\t" -v dbdir="${dbdir}" -v manifest="${manifest}"\
+            -v hashes="${2}/hashes" -v algo="${CHECKSUM}" -v now="${3}"\
+            -v report="${2}/report" '
+        FILENAME == manifest { recs[$1] = $0; next }
+        FILENAME == hashes {
+            # "checksum  path" lines of all the databases
+            path = substr($0, index($0, " ") + 2)
+            if (substr(path, 1, length(dbdir) + 7) == dbdir "/dumps/") {
+                hashed[substr(path, length(dbdir) + 8)] = substr($0, 1, index($0, " ") - 1)
+            }
+            next
+        }
+        {
+            name = $1; rec = recs[name]
+            if (name in hashed) {
+                split(rec, r, "\t")
+                if (rec != "" && r[2] == algo && r[3] != hashed[name]) {
+                    print "C", dbdir "/dumps/" name >> report
+                } else {
+                    if (rec == "" || r[2] != algo) {
+                        print "N", dbdir "/dumps/" name >> report
+                    }
+                    rec = name OFS algo OFS hashed[name] OFS $2 OFS $3 OFS now
+                }
+            }
+            if (rec != "") { print rec }
+        }' "${manifest}" "${2}/hashes" - > "${manifest}.tmp"\
+        && mv -f "${manifest}.tmp" "${manifest}"
+}
+
+do_verify_tree() {
+    # audit every database directory of TOP_BACKUPDIR against its
+    # checksums manifest, the dumps are re-hashed in parallel
+    log_rule
+    debug "do_verify_tree"
+    if [ x"${CHECKSUM}" = "x" ];then
+        cyan_log "CHECKSUM is disabled, nothing to verify against"
+        return 1
+    fi
+    log "Auditing the backups of ${YELLOW}${TOP_BACKUPDIR}${NORMAL}"
+    metric_start
+    work="$(mktemp -d)"
+    touch "${work}/todo" "${work}/report"
+    dbdirs="$(find "${TOP_BACKUPDIR}" -mindepth 2 -type d -name .dsb -prune 2>/dev/null\
+        | sed -e "s|/\.dsb$||")"
+    now="$(date +%s)"
+    while read dbdir;do
+        if [ x"${dbdir}" != "x" ];then
+            verify_tree_db "${dbdir}" "${work}" "${now}"
+        fi
+    done <<< "${dbdirs}"
+    xargs -r -d "\n" -n 16 -P "${VERIFY_JOBS:-1}" "${CHECKSUM}sum"\
+        < "${work}/todo" > "${work}/hashes" 2>/dev/null
+    while read dbdir;do
+        if [ x"${dbdir}" != "x" ];then
+            verify_tree_manifest "${dbdir}" "${work}" "${now}"
+        fi
+    done <<< "${dbdirs}"
+    bytes="$(tr "\n" "\0" < "${work}/todo"|du -cb --files0-from=- 2>/dev/null|tail -n 1|cut -f1)"
+    awk -F"\t" '
+        $1 == "C" { c++; print "Checksum mismatch: " $2 }
+        $1 == "L" { l++; print "Not linked to any dump: " $2 }
+        $1 == "I" { i++; print "Rotation index entry pointing nowhere: " $2 }
+        $1 == "N" { n++ }
+        END {
+            printf "%d corrupted dumps, %d chrono files not linked to any dump, " \
+                "%d index entries pointing nowhere, %d new checksums\n", c, l, i, n
+        }' "${work}/report" > "${work}/summary"
+    sed -e '$d' "${work}/summary" | log_details
+    log " Re-hashed $(wc -l < "${work}/todo") dumps of $(echo "${dbdirs}"|grep -c .) databases"
+    log " $(tail -n 1 "${work}/summary")"
+    status="0"
+    if grep -q "^[CLI]" "${work}/report";then
+        status="1"
+    fi
+    metric_end verify_tree "" "${bytes:-0}" 0 "$(metric_status "${status}")"
+    rm -rf "${work}"
+    write_metrics
+    return ${status}
+}
+
+# S3 OFFLOAD
+# With S3_URL, each new dump is uploaded while it is compressed (see
+# compress_to) as S3_URL/<its path under TOP_BACKUPDIR>. Each database
+# directory keeps in .dsb/offload:
+#   manifest: "dump name<TAB>key<TAB>inode" of the uploaded dumps
+#   <dump>.upload: an unfinished multipart upload, "upload id<TAB>part
+#       size" then one "part number<TAB>etag" line per uploaded part
+# The uploads done while a dump is written are only completed once the
+# dump succeeded (offload_dump), they are aborted if it failed
+# (offload_abort). offload_sync resumes the unfinished uploads and deletes
+# the remote dumps which were pruned locally.
+s3_curl() {
+    # ${1}: method, ${2}: key and query string, then extra curl arguments;
+    # the credentials are given in a config on stdin, not on the command
+    # line where ps would show them
+    method="${1}"
+    url="${S3_URL%/}/${2}"
+    shift 2
+    credentials="${S3_ACCESS_KEY}:${S3_SECRET_KEY}"
+    credentials="${credentials//\\/\\\\}"
+    credentials="${credentials//\"/\\\"}"
+    curl -sS --fail --retry 3 --aws-sigv4 "aws:amz:${S3_REGION}:s3" -K -\
+        -H "x-amz-content-sha256: UNSIGNED-PAYLOAD"\
+        -X "${method}" ${S3_CURL_ARGS} "${@}" "${url}" <<< "user = \"${credentials}\""
+}
+
+s3_key() {
+    # uri encoded object key of the local file ${1}
+    printf "%s" "${1#"${TOP_BACKUPDIR%/}/"}" | LC_ALL=C awk '
+        BEGIN { for (i = 1; i < 256; i++) { ord[sprintf("%c", i)] = i } }
+        {
+            out = ""
+            for (i = 1; i <= length($0); i++) {
+                c = substr($0, i, 1)
+                if (c ~ /[A-Za-z0-9._~\/-]/) { out = out c }
+                else { out = out sprintf("%%%02X", ord[c]) }
+            }
+            printf "%s", out
+        }'
+}
+
+offload_dir() {
+    echo "${1%/dumps/*}/.dsb/offload"
+}
+
+offload_uploaded() {
+    # is the dump ${2} in the manifest of ${1}
+    [ -f "${1}/manifest" ] && awk -F"\t" -v name="${2}"\
+        '$1 == name { found = 1 } END { exit !found }' "${1}/manifest"
+}
+
+s3_wait_jobs() {
+    # wait until less than ${1} parts are being uploaded
+    while true;do
+        s3_running=""
+        for pid in ${S3_PIDS};do
+            if kill -0 "${pid}" 2>/dev/null;then
+                s3_running="${s3_running} ${pid}"
+            else
+                wait "${pid}" 2>/dev/null
+            fi
+        done
+        S3_PIDS="${s3_running}"
+        set -- "${1}" ${S3_PIDS}
+        if [ "$((${#} - 1))" -lt "${1}" ];then
+            break
+        fi
+        wait -n 2>/dev/null || sleep 1
+    done
+}
+
+s3_put_part() {
+    # upload the part ${3} of the upload ${2} of ${1} from the buffer
+    # ${4} (removed), recording its etag in the state file ${5}
+    etag="$(s3_curl PUT "${1}?partNumber=${3}&uploadId=${2}" -T "${4}" -o /dev/null -D -\
+        | tr -d "\r" | awk 'tolower($1) == "etag:" { print $2 }')"
+    rm -f "${4}"
+    if [ x"${etag}" != "x" ];then
+        printf "%s\t%s\n" "${3}" "${etag}" >> "${5}"
+    fi
+}
+
+s3_upload_parts() {
+    # upload the parts ${4} (numbers) of ${6} bytes of the file ${3} for
+    # the upload ${2} of ${1}, S3_JOBS at the same time
+    buf="$(mktemp -d "${S3_BUFFER_DIR}/dsb_s3.XXXXXX")" || return 1
+    S3_PIDS=""
+    for part in ${4};do
+        s3_wait_jobs "${S3_JOBS}"
+        tail -c +"$(( (part - 1) * ${6} + 1 ))" "${3}" | head -c "${6}" > "${buf}/${part}"
+        s3_put_part "${1}" "${2}" "${part}" "${buf}/${part}" "${5}" &
+        S3_PIDS="${S3_PIDS} ${!}"
+    done
+    s3_wait_jobs 1
+    rm -rf "${buf}"
+}
+
+s3_complete() {
+    # complete the upload ${2} of ${1} if the ${4} parts are in ${3}
+    awk -F"\t" -v n="${4}" '
+        NR > 1 && $2 != "" { etag[$1] = $2 }
+        END {
+            for (i = 1; i <= n; i++) { if (!(i in etag)) { exit 1 } }
+            printf "<CompleteMultipartUpload>"
+            for (i = 1; i <= n; i++) {
+                printf "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>", i, etag[i]
+            }
+            print "</CompleteMultipartUpload>"
+        }' "${3}" > "${3}.xml"\
+        && s3_curl POST "${1}?uploadId=${2}" -H "Content-Type: application/xml"\
+            --data-binary "@${3}.xml" | grep -q "<CompleteMultipartUploadResult"
+    status="${?}"
+    remove_files "${3}.xml"
+    return ${status}
+}
+
+s3_upload() {
+    # upload stdin as the dump ${1}, in one request if it fits in a part;
+    # with ${2} (the dump is being written), a small dump is left to
+    # offload_dump and a multipart upload is not completed
+    key="$(s3_key "${1}")"
+    dir="$(offload_dir "${1}")"
+    state="${dir}/${1##*/}.upload"
+    if [ ! -d "${dir}" ];then
+        mkdir -p "${dir}"
+    fi
+    first="$(mktemp "${S3_BUFFER_DIR}/dsb_s3.XXXXXX")" || return 1
+    head -c "${S3_PART_SIZE}" > "${first}"
+    status="1"
+    if [ "$(file_size "${first}")" -lt "${S3_PART_SIZE}" ];then
+        if [ x"${2}" = "x" ];then
+            s3_curl PUT "${key}" -T "${first}" -o /dev/null
+            status="${?}"
+        fi
+        rm -f "${first}"
+    else
+        upload_id="$(s3_curl POST "${key}?uploads"\
+            | sed -n -e "s|.*<UploadId>\(.*\)</UploadId>.*|\1|p")"
+        if [ x"${upload_id}" != "x" ];then
+            printf "%s\t%s\n" "${upload_id}" "${S3_PART_SIZE}" > "${state}"
+            S3_PIDS=""
+            s3_put_part "${key}" "${upload_id}" 1 "${first}" "${state}"
+            # the stream length is unknown, read parts until its end
+            part="1"
+            while true;do
+                part="$((part + 1))"
+                next="$(mktemp "${S3_BUFFER_DIR}/dsb_s3.XXXXXX")"
+                head -c "${S3_PART_SIZE}" > "${next}"
+                if [ ! -s "${next}" ];then
+                    rm -f "${next}"
+                    break
+                fi
+                s3_wait_jobs "${S3_JOBS}"
+                s3_put_part "${key}" "${upload_id}" "${part}" "${next}" "${state}" &
+                S3_PIDS="${S3_PIDS} ${!}"
+            done
+            s3_wait_jobs 1
+            if [ x"${2}" = "x" ] && s3_complete "${key}" "${upload_id}" "${state}" "$((part - 1))";then
+                status="0"
+                rm -f "${state}"
+            fi
+        fi
+        remove_files "${first}"
+    fi
+    if [ x"${status}" = "x0" ];then
+        offload_record "${1}" "${key}"
+    fi
+    return ${status}
+}
+
+offload_record() {
+    # add the dump ${1} uploaded as ${2} to the manifest, with its inode
+    # which is also the one of its chrono links
+    printf "%s\t%s\t%s\n" "${1##*/}" "${2}" "$(stat -c %i "${1}" 2>/dev/null)"\
+        >> "$(offload_dir "${1}")/manifest"
+}
+
+s3_resume() {
+    # upload the missing parts of the unfinished upload ${2} of ${1}
+    key="$(s3_key "${1}")"
+    IFS="${DSB_TAB}" read -r upload_id part_size < "${2}"
+    size="$(file_size "${1}")"
+    parts="$(( (size + part_size - 1) / part_size ))"
+    missing="$(awk -F"\t" -v n="${parts}" '
+        NR > 1 { uploaded[$1] = 1 }
+        END { for (i = 1; i <= n; i++) { if (!(i in uploaded)) { print i } } }' "${2}")"
+    s3_upload_parts "${key}" "${upload_id}" "${1}" "${missing}" "${2}" "${part_size}"
+    if s3_complete "${key}" "${upload_id}" "${2}" "${parts}";then
+        rm -f "${2}"
+        offload_record "${1}" "${key}"
+        return 0
+    fi
+    return 1
+}
+
+offload_stream() {
+    # copy stdin to stdout, uploading it as the dump ${1} on the way; a
+    # failed upload never fails the dump, it is resumed by offload_sync
+    if [ x"${S3_URL}" = "x" ] || [ x"${1%/dumps/*}" = x"${1}" ];then
+        cat
+    else
+        { tee -p /dev/fd/3 | { s3_upload "${1}" stream; cat > /dev/null; }; } 3>&1
     fi
-    if [ ! -e "${weekly_zfilename}" ];then
-        ln "${real_zfilename}" "${weekly_zfilename}"
+}
+
+offload_dump() {
+    # complete the upload of the dump ${2} of ${1} started while it was
+    # written, or upload it from the file
+    dir="$(offload_dir "${2}")"
+    name="${2##*/}"
+    if [ -e "${dir}/${name}.upload" ];then
+        s3_resume "${2}" "${dir}/${name}.upload"
+    elif ! offload_uploaded "${dir}" "${name}";then
+        metric_start
+        s3_upload "${2}" < "${2}"
+        offload_status="${?}"
+        metric_end offload "${1}" "$(file_size "${2}")" 0 "$(metric_status "${offload_status}")"
     fi
-    if [ ! -e "${monthly_zfilename}" ];then
-        ln "${real_zfilename}" "${monthly_zfilename}"
+    if offload_uploaded "${dir}" "${name}";then
+        log "    Offloaded to ${YELLOW}${S3_URL%/}/$(s3_key "${2}")${NORMAL}"
+    else
+        log "${CYAN}    Offload of ${name} failed, it will be resumed${NORMAL}"
     fi
-    if [ ! -e "${lastsnapshots_zfilename}" ];then
-        ln "${real_zfilename}" "${lastsnapshots_zfilename}"
+}
+
+offload_abort() {
+    # abort the upload of the failed dump ${1} started while it was written
+    state="$(offload_dir "${1}")/${1##*/}.upload"
+    if [ -f "${state}" ];then
+        IFS="${DSB_TAB}" read -r upload_id _ < "${state}"
+        s3_curl DELETE "$(s3_key "${1}")?uploadId=${upload_id}" -o /dev/null
+        rm -f "${state}"
     fi
 }
 
+offload_sync() {
+    # resume the unfinished uploads and delete the remote copies of the
+    # dumps which were pruned locally: no longer in dumps/ nor linked from
+    # a chrono directory (with DEDUP_STORE, the dumps/ name of a dump may
+    # be swept while the chrono links still hold its inode)
+    log_rule
+    log "Synchronizing the offloaded dumps with ${YELLOW}${S3_URL}${NORMAL}"
+    report="$(mktemp)"
+    for dir in "$(get_backupdir)"/*/.dsb/offload;do
+        if [ ! -d "${dir}" ];then
+            continue
+        fi
+        dbdir="${dir%/.dsb/offload}"
+        dumps="${dbdir}/dumps"
+        for state in "${dir}"/*.upload;do
+            if [ ! -f "${state}" ];then
+                continue
+            fi
+            zfile="${dumps}/$(basename "${state}" .upload)"
+            if [ ! -f "${zfile}" ];then
+                # pruned before it could be uploaded
+                offload_abort "${zfile}"
+            elif s3_resume "${zfile}" "${state}";then
+                printf "R\t%s\n" "${zfile}" >> "${report}"
+            else
+                printf "F\t%s\n" "${zfile}" >> "${report}"
+            fi
+        done
+        if [ -f "${dir}/manifest" ];then
+            linked="$(find "${dbdir}/daily" "${dbdir}/weekly" "${dbdir}/monthly"\
+                "${dbdir}/lastsnapshots" -maxdepth 1 -type f -printf "%i\n" 2>/dev/null)"
+            while IFS="${DSB_TAB}" read -r name key inode;do
+                if [ -f "${dumps}/${name}" ] || ( [ x"${inode}" != "x" ] &&\
+                    printf "%s\n" "${linked}"|grep -qxF -- "${inode}" );then
+                    printf "%s\t%s\t%s\n" "${name}" "${key}" "${inode}"
+                elif s3_curl DELETE "${key}" -o /dev/null;then
+                    printf "D\t%s\n" "${key}" >> "${report}"
+                else
+                    # retried at the next run
+                    printf "%s\t%s\t%s\n" "${name}" "${key}" "${inode}"
+                    printf "F\t%s\n" "${key}" >> "${report}"
+                fi
+            done < "${dir}/manifest" > "${dir}/manifest.tmp"
+            mv -f "${dir}/manifest.tmp" "${dir}/manifest"
+        fi
+    done
+    awk -F"\t" '
+        $1 == "R" { r++; print "Resumed upload of " $2 }
+        $1 == "D" { d++; print "Deleted remote " $2 }
+        $1 == "F" { f++; print "Failed to synchronize " $2 }
+        END { printf "Resumed %d uploads, deleted %d remote dumps, %d failures\n", r, d, f }'\
+        "${report}" > "${report}.log"
+    sed -e '$d' "${report}.log" | log_details
+    log " $(tail -n 1 "${report}.log")"
+    if grep -q "^F" "${report}";then
+        DSB_BACKUP_IN_FAILURE="y"
+    fi
+    remove_files "${report}" "${report}.log"
+}
+
+# ROTATION INDEX
+# Each database directory has a .dsb/index file which contains one line per
+# chronoted hard link (tab separated):
+#   chrono dir, sort key, link name, dump name, size, compressor, dump date
+# link_into_dirs appends to it and do_rotate uses it to know what to prune
+# without listing and sorting the chrono directories at each run.
+# The index is rebuilt from the disk if missing or older than a chrono dir.
+DSB_TAB="	"
+DSB_AWK_SORTKEY='
+function sortkey(s) {
+    # zero pad numbers to sort db_2001_1_2 & db_2001_01_03 alike
+    while (match(s, /_[0-9][^0-9]/)) {
+        s = substr(s, 1, RSTART) "0" substr(s, RSTART + 1)
+    }
+    return s
+}
+function compressor(s) {
+    if (s ~ /\.xz$/) { return "xz" }
+    if (s ~ /\.gz$/) { return "gzip" }
+    if (s ~ /\.bz2$/) { return "bzip2" }
+    if (s ~ /\.zst$/) { return "zstd" }
+    return "nocomp"
+}
+'
+
+index_is_fresh() {
+    index="${1}/.dsb/index"
+    if [ ! -e "${index}" ];then
+        return 1
+    fi
+    for chronodir in monthly weekly daily lastsnapshots;do
+        if [ "${1}/${chronodir}" -nt "${index}" ];then
+            return 1
+        fi
+    done
+    return 0
+}
+
+index_append() {
+    # stdin: "chrono<TAB>link name" lines for the dump ${2}
+    size="$(stat -c %s "${2}" 2>/dev/null)"
+    LC_ALL=C awk -F"${DSB_TAB}" -v OFS="${DSB_TAB}"\
+        -v dump="${2##*/}" -v size="${size:-0}" -v stamp="${FDATE}"\
+        "${DSB_AWK_SORTKEY}"'
+        NF > 1 { print $1, sortkey($2), $2, dump, size, compressor(dump), stamp }'\
+        >> "${1}/.dsb/index"
+}
+
+index_rebuild() {
+    index="${1}/.dsb/index"
+    if [ ! -e "${1}/.dsb" ];then
+        mkdir -p "${1}/.dsb"
+    fi
+    find "${1}" -mindepth 2 -maxdepth 2 -type f\
+        -printf "%P\t%i\t%s\t%TY-%Tm-%Td_%TH-%TM-%TS\n" 2>/dev/null\
+        | LC_ALL=C awk -F"${DSB_TAB}" -v OFS="${DSB_TAB}" "${DSB_AWK_SORTKEY}"'
+            {
+                chrono = $1; sub(/\/.*$/, "", chrono)
+                name = substr($1, length(chrono) + 2)
+                if (chrono == "dumps") { dumps[$2] = name; next }
+                if (chrono !~ /^(daily|weekly|monthly|lastsnapshots)$/) { next }
+                n++; lines[n] = chrono OFS sortkey(name) OFS name
+                inodes[n] = $2; sizes[n] = $3; stamps[n] = $4
+                sub(/\.[0-9]*$/, "", stamps[n])
+            }
+            END {
+                for (i = 1; i <= n; i++) {
+                    dump = "-"
+                    if (inodes[i] in dumps) { dump = dumps[inodes[i]] }
+                    print lines[i], dump, sizes[i], compressor(lines[i]), stamps[i]
+                }
+            }' > "${index}.tmp"\
+        && mv -f "${index}.tmp" "${index}"
+}
+
 dummy_callee_for_tests() {
     echo "here"
 }
@@ -483,51 +1840,467 @@ dummy_for_tests() {
 }
 
 remove_backup_status_files() {
-    remove_files "$statusfile" "$statusfile.c"
+    remove_files "$statusfile" "$statusfile.c" "$statusfile.sum"
 }
 
 do_db_backup_() {
     LAST_BACKUP_STATUS=""
     db="${1}"
     fun_="${2}"
+    ext="${3:-${BACKUP_EXT}}"
     create_db_directories "${db}"
-    real_filename="$(get_backupdir)/${db}/dumps/${db}_${FDATE}.${BACKUP_EXT}"
+    real_filename="$(get_backupdir)/${db}/dumps/${db}_${FDATE}.${ext}"
     zreal_filename="$(get_compressed_name "${real_filename}")"
-    statusfile=$(mktemp)
-    remove_backup_status_files
     adb="${YELLOW}${db}${NORMAL} "
     if [ x"${db}" = x"${GLOBAL_SUBDIR}" ];then
         adb=""
     fi
+    fingerprint=""
+    if [ x"${SKIP_UNCHANGED}" != "x" ] &&\
+        [ x"$(fn_exists "${BACKUP_TYPE}_fingerprint")" = "x0" ];then
+        fingerprint="$("${BACKUP_TYPE}_fingerprint" "${db}" 2>/dev/null)"
+        last_dump="$(unchanged_dump "${db}" "${fingerprint}" "${zreal_filename}")"
+        if [ x"${last_dump}" != "x" ];then
+            log "Database ${adb}${RED}did not change, reusing: ${YELLOW}${last_dump}${NORMAL}"
+            link_into_dirs "${db}" "${real_filename}" "${last_dump}"
+            return
+        fi
+    fi
+    statusfile=$(mktemp)
+    remove_backup_status_files
     log "Dumping database ${adb}${RED}to maybe uncompressed dump: ${YELLOW}${real_filename}${NORMAL}"
+    diff_against="$(diff_base "${db}")"
+    DIFF_REFERENCE=""
+    if [ x"${diff_against}" != "x" ];then
+        DIFF_REFERENCE="$(diff_reference "${diff_against}")"
+    fi
+    diff_piped="${PIPED_BACKUP_COMPRESSION}"
+    if [ x"${DIFF_REFERENCE}" != "x" ];then
+        log "    Differential dump against ${YELLOW}${diff_against##*/}${NORMAL}"
+        # zstd needs the size of what it encodes against a reference
+        PIPED_BACKUP_COMPRESSION=""
+    else
+        diff_against=""
+    fi
+    throttle_settings "${db}"
+    if [ "x${DB_THROTTLE_RATE}${DB_NICE_LEVEL}${DB_IONICE_CLASS}" != "x" ]\
+        || [ "x${DB_COMP_THREADS}" != "x${COMP_THREADS}" ];then
+        log "    Throttling: ${YELLOW}rate=${DB_THROTTLE_RATE:-none} nice=${DB_NICE_LEVEL:-none} ionice=${DB_IONICE_CLASS:-none} threads=${DB_COMP_THREADS:-auto}${NORMAL}"
+    fi
+    started="${SECONDS}"
+    metric_start
+    dump_status="0"
     if [ "x${PIPED_BACKUP_COMPRESSION}" = "x1" ];then
         # ensure backup + compression is atomic with the absence of +o pipefail in old posix shells
-        ( $fun_ "${db}" "${real_filename}" && touch "$statusfile" ) \
-            | ( do_compression "${real_filename}" "${zreal_filename}" && touch "$statusfile.c" )
+        ( throttled_dump $fun_ "${db}" "${real_filename}" && touch "$statusfile" ) \
+            | count_stream "$statusfile.bytes" \
+            | ( throttle_process; do_compression "${real_filename}" "${zreal_filename}" "$statusfile.sum"\
+                && touch "$statusfile.c" )
 
         if [ "x$?" != "x0" ] || ! ( [ -e "$statusfile" ] && [ -e "$statusfile.c" ] );then
             remove_backup_status_files
             LAST_BACKUP_STATUS="failure"
-            log "${CYAN}    Backup of ${db} failed !!!${NORMAL}"
+            dump_status="1"
         fi
+        raw_size="0"
+        if [ -f "$statusfile.bytes" ];then
+            read raw_size < "$statusfile.bytes"
+        fi
+        remove_files "$statusfile.bytes"
+        # the compression ran along, it is part of the dump stage
+        metric_end dump "${db}" "${raw_size}" "$(file_size "${zreal_filename}")"\
+            "${LAST_BACKUP_STATUS:-ok}"
     else
-        $fun_ "${db}" "${real_filename}"
+        ( throttled_dump $fun_ "${db}" "${real_filename}" )
+        dump_status="${?}"
+        raw_size="$(file_size "${real_filename}")"
+        DIFF_STREAM_SIZE="${raw_size}"
+        metric_end dump "${db}" 0 "${raw_size}" "$(metric_status "${dump_status}")"
     fi
-    if [ x"$?" != "x0" ];then
+    if [ x"${dump_status}" != "x0" ];then
         LAST_BACKUP_STATUS="failure"
         log "${CYAN}    Backup of ${db} failed !!!${NORMAL}"
     else
+        comp_status="0"
         if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
-            do_compression "${real_filename}" "${zreal_filename}"
+            metric_start
+            ( throttle_process; do_compression "${real_filename}" "${zreal_filename}" "$statusfile.sum" )
+            comp_status="${?}"
+            metric_end compression "${db}" "${raw_size}" "$(file_size "${zreal_filename}")"\
+                "$(metric_status "${comp_status}")"
+        fi
+        if [ x"${comp_status}" != "x0" ];then
+            LAST_BACKUP_STATUS="failure"
+            log "${CYAN}    Compression of ${db} failed !!!${NORMAL}"
+        else
+            if [ x"${DEDUP_STORE}" != "x" ];then
+                dedup_into_store "$(get_backupdir)/${db}" "${zreal_filename}" "$statusfile.sum"
+            fi
+            record_checksum "${db}" "${zreal_filename}" "$statusfile.sum"
+            record_chain "${db}" "${zreal_filename}" "${diff_against}"
+            if [ x"${S3_URL}" != "x" ];then
+                offload_dump "${db}" "${zreal_filename}"
+            fi
+            metric_start
+            link_into_dirs "${db}" "${real_filename}"
+            metric_end link "${db}"
+            if [ x"${fingerprint}" != "x" ];then
+                printf "%s\n%s\n" "${fingerprint}" "${zreal_filename}"\
+                    > "$(get_backupdir)/${db}/.dsb/fingerprint"
+            fi
+            record_duration "${db}" "$((SECONDS - started))"
+            log_throughput "$((SECONDS - started))" "${zreal_filename}" "${real_filename}"
+            if [ x"${VERIFY_BACKUPS}" != "x" ];then
+                start_verification "${db}" "${zreal_filename}"
+            fi
         fi
-        link_into_dirs "${db}" "${real_filename}"
+    fi
+    if [ x"${LAST_BACKUP_STATUS}" = "xfailure" ] && [ x"${S3_URL}" != "x" ];then
+        offload_abort "${zreal_filename}"
+    fi
+    PIPED_BACKUP_COMPRESSION="${diff_piped}"
+    if [ x"${DIFF_REFERENCE}" != "x" ];then
+        remove_files "${DIFF_REFERENCE}"
+        DIFF_REFERENCE=""
+    fi
+    remove_backup_status_files
+}
+
+decompress_pipe() {
+    # decompress stdin to stdout, compressed as the extension of ${1} tells
+    case "${1}" in
+        *.xz) "${XZ:-xz}" -dc;;
+        *.zst) "${ZSTD:-zstd}" -dcq;;
+        *.gz) "${GZIP:-gzip}" -dc;;
+        *.bz2) "${BZIP2:-bzip2}" -dc;;
+        *) cat;;
+    esac
+}
+
+decompress_stream() {
+    # decompress ${1} to stdout, from its extension
+    case "${1}" in
+        *.zst)
+            base="$(diff_base_of "${1}")"
+            if [ x"${base}" != "x" ];then
+                diff_decompress "${1}" "${base}"
+                return ${?}
+            fi;;
+    esac
+    decompress_pipe "${1}" < "${1}"
+}
+
+verify_stream() {
+    # check the decompressed dump ${2} of ${1} on stdin, the backup type
+    # can provide ${BACKUP_TYPE}_verify, tar archives are listed, else we
+    # only check that it decompresses
+    uncompressed="${2%.xz}"
+    uncompressed="${uncompressed%.zst}"
+    uncompressed="${uncompressed%.gz}"
+    uncompressed="${uncompressed%.bz2}"
+    if [ x"${uncompressed##*.}" = "xtar" ];then
+        tar tf - > /dev/null
+    elif [ x"$(fn_exists "${BACKUP_TYPE}_verify")" = "x0" ];then
+        "${BACKUP_TYPE}_verify" "${1}" "${uncompressed##*.}"
+    else
+        cat > /dev/null
+    fi
+}
+
+verify_slot() {
+    # take one of the VERIFY_JOBS slots on fd 4, waiting for one if they
+    # are all in use
+    slots="${VERIFY_JOBS:-1}"
+    for i in $(seq "${slots}");do
+        exec 4>> "${DSB_RUN_DIR}/verify.slot.${i}"
+        if flock -n 4;then
+            return 0
+        fi
+    done
+    exec 4>> "${DSB_RUN_DIR}/verify.slot.$((RANDOM % slots + 1))"
+    flock 4
+}
+
+verify_dump() {
+    # verify the dump ${2} of ${1}, and record the result in its
+    # metadata (.dsb/verify: file, status, date, seconds) and in ${3}
+    # for the main process (file and metrics line)
+    renice -n 10 -p "${BASHPID}" >/dev/null 2>&1
+    verify_slot
+    DSB_METRICS=""
+    metric_start
+    ( set -o pipefail; decompress_stream "${2}" | verify_stream "${1}" "${2}" ) 2>/dev/null
+    status="$(metric_status "${?}")"
+    metric_end verify "${1}" "$(file_size "${2}")" 0 "${status}"
+    verify_file="$(get_backupdir)/${1}/.dsb/verify"
+    {
+        tail -n 999 "${verify_file}" 2>/dev/null
+        printf "%s\t%s\t%s\t%s\n" "${2##*/}" "${status}" "${FDATE}"\
+            "$(echo "${DSB_METRICS}"|awk -F"\t" '{ printf "%.1f", $4 - $3 }')"
+    } > "${verify_file}.tmp"
+    mv -f "${verify_file}.tmp" "${verify_file}"
+    printf "%s\n%s" "${2}" "${DSB_METRICS}" > "${3}.tmp"
+    mv -f "${3}.tmp" "${3}"
+}
+
+start_verification() {
+    # verify ${2} in background, without blocking the next dumps. Each
+    # verification holds a shared lock on verify.lock which lets
+    # wait_for_verifications wait for all of them, even those started
+    # by the parallel backup jobs
+    ensure_rundir
+    mkdir -p "${DSB_RUN_DIR}/verify"
+    result="$(mktemp "${DSB_RUN_DIR}/verify/XXXXXX")"
+    exec 5>> "${DSB_RUN_DIR}/verify.lock"
+    flock -s 5
+    verify_dump "${1}" "${2}" "${result}.result" </dev/null >/dev/null 2>&1 &
+    exec 5>&-
+    remove_files "${result}"
+}
+
+wait_for_verifications() {
+    if [ x"${DSB_RUN_DIR}" = "x" ] || [ ! -d "${DSB_RUN_DIR}/verify" ];then
+        return 0
+    fi
+    log_rule
+    log "Waiting for the dumps verifications"
+    flock -x "${DSB_RUN_DIR}/verify.lock" true
+    for result in "${DSB_RUN_DIR}/verify/"*.result;do
+        if [ ! -f "${result}" ];then
+            continue
+        fi
+        { read -r file; IFS= read -r metric; } < "${result}"
+        DSB_METRICS="${DSB_METRICS}${metric}
+"
+        if [ x"${metric##*${DSB_TAB}}" = "xok" ];then
+            log "    Verified ${YELLOW}${file}${NORMAL}"
+        else
+            log "${CYAN}    Verification of ${file} failed !!!${NORMAL}"
+            DSB_BACKUP_IN_FAILURE="y"
+        fi
+        remove_files "${result}"
+    done
+}
+
+record_duration() {
+    # keep how long the backup of ${1} took (${2}s) and its size for the
+    # next runs predictions (see order_databases)
+    printf "%s\t%s\n" "${2}" "$(db_size "${1}")"\
+        > "$(get_backupdir)/${1}/.dsb/duration"
+    predicted="$(echo "${DSB_PREDICTIONS}"|awk -F"\t" -v db="${1}" '$1 == db { print $2 }')"
+    if [ x"${predicted}" != "x" ];then
+        log "    Backup of ${1} took ${YELLOW}${2}s${NORMAL}${RED} (predicted: ${predicted}s)${NORMAL}"
+    fi
+}
+
+log_throughput() {
+    # log the bytes per second of the last backup, which took ${1}s, from
+    # its compressed ${2} and, if still there, uncompressed ${3} sizes
+    sizes=""
+    for i in "${2}" "${3}";do
+        if [ -f "${i}" ];then
+            sizes="${sizes} $(stat -c %s "${i}")"
+        fi
+    done
+    log "    Throughput: ${YELLOW}$(echo "${1}${sizes}"|awk '
+        function human(n) {
+            split("B KiB MiB GiB TiB", units, " ")
+            for (u = 1; n >= 1024 && u < 5; u++) { n /= 1024 }
+            return sprintf("%.1f %s", n, units[u])
+        }
+        {
+            secs = ($1 > 0) ? $1 : 1
+            msg = human($2 / secs) "/s compressed"
+            if (NF > 2) { msg = msg ", " human($3 / secs) "/s raw" }
+            print msg
+        }')${NORMAL}"
+}
+
+metrics_clock() {
+    # wall clock seconds & cpu ticks used by this shell and its reaped
+    # children, in DSB_CLOCK_WALL & DSB_CLOCK_CPU without forking
+    DSB_CLOCK_WALL="${EPOCHREALTIME/,/.}"
+    if [ x"${DSB_CLOCK_WALL}" = "x" ];then
+        DSB_CLOCK_WALL="$(date +%s.%N)"
+    fi
+    DSB_CLOCK_CPU="0"
+    if [ -r /proc/self/stat ];then
+        read -r _ _ _ _ _ _ _ _ _ _ _ _ _ utime stime cutime cstime _ < /proc/self/stat
+        DSB_CLOCK_CPU="$((utime + stime + cutime + cstime))"
     fi
 }
 
+metric_start() {
+    # stages do not nest, one start point is enough
+    metrics_clock
+    DSB_METRIC_START="${DSB_CLOCK_WALL}${DSB_TAB}${DSB_CLOCK_CPU}"
+}
+
+metric_end() {
+    # record stage ${1} of database ${2} (bytes in ${3}, out ${4}, status
+    # ${5}) since metric_start in DSB_METRICS, one line per stage:
+    # stage db start wall_secs cpu_ticks bytes_in bytes_out status
+    metrics_clock
+    DSB_METRICS="${DSB_METRICS}${1}${DSB_TAB}${2}${DSB_TAB}${DSB_METRIC_START%%${DSB_TAB}*}${DSB_TAB}${DSB_CLOCK_WALL}${DSB_TAB}$((DSB_CLOCK_CPU - ${DSB_METRIC_START#*${DSB_TAB}}))${DSB_TAB}${3:-0}${DSB_TAB}${4:-0}${DSB_TAB}${5:-ok}
+"
+}
+
+metric_status() {
+    if [ x"${1}" = "x0" ];then
+        echo ok
+    else
+        echo failure
+    fi
+}
+
+count_stream() {
+    # copy stdin to stdout, writing the number of bytes to ${1}
+    if [ x"$(get_metricsdir)" = "x" ];then
+        cat
+    else
+        { tee /dev/fd/3 | wc -c > "${1}"; } 3>&1
+    fi
+}
+
+file_size() {
+    if [ -f "${1}" ];then
+        stat -c %s "${1}"
+    else
+        echo 0
+    fi
+}
+
+write_metrics() {
+    # append this run metrics as json lines and atomically replace the
+    # prometheus textfile collector file
+    metricsdir="$(get_metricsdir)"
+    if [ x"${metricsdir}" = "x" ] || [ x"${DSB_METRICS}" = "x" ];then
+        return 0
+    fi
+    name="${DSB_CONF_FILE##*/}"
+    name="$(echo "${name%.*}"|sed -e "s/[^A-Za-z0-9_.-]/_/g")"
+    name="${name:-${__NAME__}}"
+    prom="${METRICS_PROM_FILE:-${metricsdir}/${name}.prom}"
+    mkdir -p "${metricsdir}" "$(dirname "${prom}")"
+    printf "%s" "${DSB_METRICS}" | LC_ALL=C awk -F"\t"\
+        -v jsonl="${metricsdir}/${name}.jsonl.$$"\
+        -v prom="${prom}.$$"\
+        -v run="${FULL_FDATE}" -v conf="${name}" -v type="${BACKUP_TYPE}"\
+        -v ticks="$(getconf CLK_TCK 2>/dev/null || echo 100)" '
+        function esc(v) { gsub(/\\/, "\\\\", v); gsub(/"/, "\\\"", v); return v }
+        function metric(n, help, kind) {
+            print "# HELP dsb_" n " " help > prom
+            print "# TYPE dsb_" n " " kind > prom
+        }
+        {
+            wall = $4 - $3; cpu = $5 / ticks
+            ratio = ($6 > 0 && $7 > 0 && $1 ~ /^(dump|compression)$/) ? $7 / $6 : 0
+            printf "{\"run\": \"%s\", \"conf\": \"%s\", \"type\": \"%s\", " \
+                "\"stage\": \"%s\", \"db\": \"%s\", \"start\": %.6f, " \
+                "\"wall_seconds\": %.6f, \"cpu_seconds\": %.2f, " \
+                "\"bytes_in\": %.0f, \"bytes_out\": %.0f, \"ratio\": %.4f, " \
+                "\"status\": \"%s\"}\n", esc(run), esc(conf), esc(type),
+                esc($1), esc($2), $3, wall, cpu, $6, $7, ratio, esc($8) > jsonl
+            n++
+            labels[n] = sprintf("conf=\"%s\",type=\"%s\",stage=\"%s\",db=\"%s\"",
+                esc(conf), esc(type), esc($1), esc($2))
+            v_wall[n] = wall; v_cpu[n] = cpu; v_in[n] = $6; v_out[n] = $7
+            v_ratio[n] = ratio; v_ok[n] = ($8 == "ok")
+            if ($4 > end) { end = $4 }
+        }
+        END {
+            metric("stage_wall_seconds", "Wall time of the backup stage.", "gauge")
+            for (i = 1; i <= n; i++) { printf "dsb_stage_wall_seconds{%s} %.6f\n", labels[i], v_wall[i] > prom }
+            metric("stage_cpu_seconds", "CPU time of the backup stage.", "gauge")
+            for (i = 1; i <= n; i++) { printf "dsb_stage_cpu_seconds{%s} %.2f\n", labels[i], v_cpu[i] > prom }
+            metric("stage_bytes_in", "Bytes read by the backup stage.", "gauge")
+            for (i = 1; i <= n; i++) { printf "dsb_stage_bytes_in{%s} %.0f\n", labels[i], v_in[i] > prom }
+            metric("stage_bytes_out", "Bytes written by the backup stage.", "gauge")
+            for (i = 1; i <= n; i++) { printf "dsb_stage_bytes_out{%s} %.0f\n", labels[i], v_out[i] > prom }
+            metric("stage_compression_ratio", "Compressed / uncompressed size.", "gauge")
+            for (i = 1; i <= n; i++) { printf "dsb_stage_compression_ratio{%s} %.4f\n", labels[i], v_ratio[i] > prom }
+            metric("stage_success", "1 if the backup stage succeeded.", "gauge")
+            for (i = 1; i <= n; i++) { printf "dsb_stage_success{%s} %d\n", labels[i], v_ok[i] > prom }
+            metric("last_run_timestamp_seconds", "End of the last run.", "gauge")
+            printf "dsb_last_run_timestamp_seconds{conf=\"%s\",type=\"%s\"} %.3f\n",
+                esc(conf), esc(type), end > prom
+        }'
+    # one append for the whole run, one rename for the collector
+    cat "${metricsdir}/${name}.jsonl.$$" >> "${metricsdir}/${name}.jsonl"
+    remove_files "${metricsdir}/${name}.jsonl.$$"
+    mv -f "${prom}.$$" "${prom}"
+}
+
+order_databases() {
+    # Longest processing time first: sort BACKUP_DB_NAMES by predicted
+    # duration, the last duration (scaled by the size change) if known,
+    # else the size at the throughput observed on the other databases.
+    # Predictions are kept in DSB_PREDICTIONS (db<TAB>seconds)
+    lines=""
+    for edb in ${BACKUP_DB_NAMES};do
+        db="$(echo "${edb}"|sed 's/%/ /g')"
+        last_duration="";last_size=""
+        duration_file="$(get_backupdir)/${db}/.dsb/duration"
+        if [ -f "${duration_file}" ];then
+            IFS="${DSB_TAB}" read -r last_duration last_size < "${duration_file}"
+        fi
+        lines="${lines}${edb}${DSB_TAB}${db}${DSB_TAB}$(db_size "${db}")${DSB_TAB}${last_duration}${DSB_TAB}${last_size}
+"
+    done
+    DSB_PREDICTIONS="$(printf "%s" "${lines}"|awk -F"\t" -v OFS="\t" '
+        {
+            edb[NR] = $1; db[NR] = $2; size[NR] = $3
+            duration[NR] = $4; last_size[NR] = $5
+            if ($4 != "" && $5 > 0) { known_size += $5; known_duration += $4 }
+        }
+        END {
+            # bytes per second, defaults to 50MB/s without any history
+            rate = 50 * 1024 * 1024
+            if (known_size > 0 && known_duration > 0) {
+                rate = known_size / known_duration
+            }
+            for (i = 1; i <= NR; i++) {
+                if (duration[i] != "") {
+                    predicted = duration[i]
+                    if (size[i] > 0 && last_size[i] > 0) {
+                        predicted = duration[i] * size[i] / last_size[i]
+                    }
+                } else {
+                    predicted = size[i] / rate
+                }
+                printf "%s\t%d\t%s\n", db[i], predicted + 0.5, edb[i]
+            }
+        }'|LC_ALL=C sort -t "${DSB_TAB}" -k2,2nr -s)"
+    BACKUP_DB_NAMES="$(echo "${DSB_PREDICTIONS}"|awk -F"\t" '{ printf "%s ", $3 }')"
+    log "Backup order (predicted duration):"
+    echo "${DSB_PREDICTIONS}"|while IFS="${DSB_TAB}" read -r db predicted edb;do
+        log "    ${YELLOW}${db}${NORMAL}${RED}: ${predicted}s${NORMAL}"
+    done
+}
+
+unchanged_dump() {
+    # print the last dump of ${1} if it was taken with the same
+    # fingerprint (${2}) & compression (${3}) and still exists
+    cache="$(get_backupdir)/${1}/.dsb/fingerprint"
+    if [ x"${2}" = "x" ] || [ ! -f "${cache}" ];then
+        return 0
+    fi
+    { read -r last_fingerprint; read -r last_dump; } < "${cache}"
+    if [ x"${last_fingerprint}" = x"${2}" ] && [ -f "${last_dump}" ] &&\
+        [ x"${last_dump##*.}" = x"${3##*.}" ];then
+        echo "${last_dump}"
+    fi
+}
+
+files_fingerprint() {
+    # names, sizes & mtimes of all the files in ${1}
+    find "${1}" -type f -printf "%P %s %T@\n" | LC_ALL=C sort | md5sum | awk '{print $1}'
+}
+
 do_db_backup() {
     db="`echo ${1} | sed 's/%/ /g'`"
     fun_="${BACKUP_TYPE}_dump"
-    do_db_backup_ "${db}" "$fun_"
+    do_db_backup_ "${db}" "$fun_" "${DB_BACKUP_EXT}"
 }
 
 do_global_backup() {
@@ -542,12 +2315,18 @@ do_global_backup() {
 activate_IO_redirection() {
     if [ x"${DSB_ACTITED_RIO}" = x"" ];then
         DSB_ACTITED_RIO="1"
-        logdir="$(dirname $(get_logfile))"
+        DSB_LOGFILE="$(get_logfile)"
+        logdir="$(dirname "${DSB_LOGFILE}")"
         if [ ! -e "${logdir}" ];then
             mkdir -p "${logdir}"
         fi
-        touch "$(get_logfile)"
-        exec 1> >(tee -a "$(get_logfile)") 2>&1
+        touch "${DSB_LOGFILE}"
+        # our own messages are written directly: colored to the terminal
+        # (fd 8) and plain to the log file (fd 7), see log_line.
+        # The output of the commands we run goes to both through tee.
+        exec 8>&1 7>>"${DSB_LOGFILE}"
+        exec 1> >(tee -a "${DSB_LOGFILE}") 2>&1
+        DSB_LOG_DIRECT="1"
     fi
 }
 
@@ -575,6 +2354,15 @@ do_pre_backup() {
     log "Log: ${YELLOW}'$(get_logfile)'"
     log "Backup Start Time: ${YELLOW}$(readable_date)${NORMAL}"
     log "Backup of database compression://type@server: ${YELLOW}${comp_msg}://${BACKUP_TYPE}@${HOST}${NORMAL}"
+    if [ x"${COMP_CMD}" != "x" ];then
+        log "Compressor: ${YELLOW}${COMP_CMD}${NORMAL}"
+    fi
+    if [ x"${DSB_DISCOVERY}" != "x" ];then
+        log "Server version: ${YELLOW}$(discovered_version)${NORMAL}"
+    fi
+    if [ "x${BACKUP_TYPE}" = "xpostgresql" ] && [ "${PG_DUMP_JOBS:-1}" -gt "1" ];then
+        log "pg_dump jobs: ${YELLOW}${PG_DUMP_JOBS}${NORMAL}${RED} (staging: ${PG_DUMP_STAGING_DIR})${NORMAL}"
+    fi
     log_rule
 }
 
@@ -592,23 +2380,49 @@ fix_perm() {
     fi
 }
 
-fix_perms() {
-    debug "fix_perms"
-    find  "${TOP_BACKUPDIR}" -type d -print|\
-        while read fic
-        do
-            fix_perm "${fic}"
-        done
-    find  "${TOP_BACKUPDIR}" -type f -print|\
-        while read fic
-        do
-            fix_perm "${fic}"
-        done
+walk_backup_tree() {
+    # One find walk over the whole backup tree which fixes ownership and
+    # mode in bulk (only on entries which are wrong) and, if ${1} is set,
+    # prunes the orphaned dumps on the way.
+    # It prints a report: "P<TAB>size<TAB>path" for each pruned file,
+    # "O<TAB>path" / "M<TAB>path" for each ownership / mode fix.
+    prune="${1:-}"
+    owner="${OWNER:-"root"}"
+    group="${GROUP:-"root"}"
+    dperm="${DPERM:-"750"}"
+    fperm="${FPERM:-"640"}"
+    if [ ! -d "${TOP_BACKUPDIR}" ];then
+        return 0
+    fi
+    set --
+    if [ x"${prune}" != "x" ];then
+        # prune all files in dumps dirs which have no more any
+        # hardlinks in chronoted directories (weekly, monthly, daily)
+        set -- \( -path "$(get_backupdir)/*" ! -path "*/.dsb/*" \
+            -type f -links 1 \
+            -fprintf /dev/stdout "P\t%s\t%p\n" -delete \) -o
+    fi
+    # unknown owner/group would make find abort, probe it once
+    if find / -maxdepth 0 -user "${owner}" -group "${group}" >/dev/null 2>&1;then
+        set -- "$@" \( \( \( ! -user "${owner}" -o ! -group "${group}" \) \
+            -fprintf /dev/stdout "O\t%p\n" \
+            -exec chown "${owner}:${group}" {} + \) ,
+    else
+        set -- "$@" \(
+        yellow_log "Invalid owner ${owner}:${group}, ownership is not fixed"
+    fi
+    set -- "$@" \( -type d ! -perm "${dperm}" \
+            -fprintf /dev/stdout "M\t%p\n" -exec chmod "${dperm}" {} + \) , \
+        \( -type f ! -perm "${fperm}" \
+            -fprintf /dev/stdout "M\t%p\n" -exec chmod "${fperm}" {} + \) \)
+    find "${TOP_BACKUPDIR}" "$@" 2>/dev/null
 }
 
-
 wrap_log() {
-    echo -e "$("$@"|sed "s/^/$(echo -e "${NORMAL}${RED}")$(print_name)     $(echo -e "${NORMAL}${YELLOW}")/g"|sed "s/\t/    /g"|sed "s/  +/   /g")${NORMAL}"
+    # log the output of the command ${@}
+    "$@" | while IFS= read -r line;do
+        log "    ${YELLOW}${line//${DSB_TAB}/    }"
+    done
 }
 
 do_post_backup() {
@@ -621,30 +2435,78 @@ do_post_backup() {
     log_rule
     log "Backup end time: ${YELLOW}$(readable_date)${NORMAL}"
     log_rule
+    write_metrics
     deactivate_IO_redirection
-    sanitize_log
 }
 
-sanitize_log() {
-    sed -i -e "s/\x1B\[[0-9;]*[JKmsu]//g" "$(get_logfile)"
+get_sorted_files() {
+    ls -1 "${1}" 2>/dev/null\
+        | LC_ALL=C awk -v OFS="${DSB_TAB}" "${DSB_AWK_SORTKEY}"'{ print sortkey($0), $0 }'\
+        | LC_ALL=C sort -t "${DSB_TAB}" -r\
+        | cut -f2-
 }
 
-get_sorted_files() {
-    files="$(ls -1 "${1}" 2>/dev/null)"
-    sep="____----____----____"
-    echo -e "${files}"|while read fic;do
-        key=""
-        oldkey="${fic}"
-        while true;do
-            key="$(echo "${oldkey}"|sed -e "s/_\([0-9][^0-9]\)/_0\1/g")"
-            if [ x"${key}" != x"${oldkey}" ];then
-                oldkey="${key}"
-            else
-                break
-            fi
-        done
-        echo "${key}${sep}${fic}"
-    done | sort -n -r | awk -F"$sep" '{print $2}'
+unlink_expired() {
+    # remove the files listed on stdin, relative to the ${1} directory,
+    # and log them in bulk with a summary
+    expired="$(cat)"
+    if [ x"${expired}" = "x" ];then
+        return 0
+    fi
+    printf "%s\n" "${expired}" | sed -e "s/^/Unlinking /" | log_details
+    printf "%s\n" "${expired}" | ( cd "${1}" && xargs -r -d "\n" rm -f 2>/dev/null )
+    log "       Unlinked ${YELLOW}$(printf "%s\n" "${expired}"|awk -F/ '
+        { n++; if (NF > 1) { per[$1]++ } }
+        END {
+            msg = n " files"
+            sep = " ("
+            for (d in per) { msg = msg sep d ": " per[d]; sep = ", " }
+            if (sep == ", ") { msg = msg ")" }
+            print msg
+        }')${NORMAL}"
+}
+
+rotate_dir() {
+    # keep only the ${2} most recent files of the ${1} directory
+    get_sorted_files "${1}" | awk -v keep="${2}" 'NR > keep + 0'\
+        | unlink_expired "${1}"
+}
+
+rotate_db_dir() {
+    # prune the chrono dirs of a database using its rotation index,
+    # this costs only the number of expired entries
+    index="${1}/.dsb/index"
+    if ! index_is_fresh "${1}";then
+        debug "rebuilding rotation index of ${1}"
+        index_rebuild "${1}"
+    fi
+    if [ ! -e "${index}" ];then
+        log "       * Cannot build the rotation index: ${YELLOW}${index}${NORMAL}"
+        return 1
+    fi
+    : > "${index}.expired"
+    LC_ALL=C sort -t "${DSB_TAB}" -k1,1 -k2,2r -k3,3r "${index}"\
+        | LC_ALL=C awk -F"${DSB_TAB}"\
+            -v expired="${index}.expired"\
+            -v monthly="${KEEP_MONTHES:-2}"\
+            -v weekly="${KEEP_WEEKS:-2}"\
+            -v daily="${KEEP_DAYS:-2}"\
+            -v lastsnapshots="${KEEP_LASTS:-2}" '
+            BEGIN {
+                keep["monthly"] = monthly; keep["weekly"] = weekly
+                keep["daily"] = daily; keep["lastsnapshots"] = lastsnapshots
+            }
+            seen[$1 FS $3]++ { next }
+            {
+                to_keep = ($1 in keep) ? keep[$1] : 65535
+                if (++count[$1] > to_keep + 0) { print $1 "/" $3 > expired }
+                else { print }
+            }' > "${index}.tmp"
+    unlink_expired "${1}" < "${index}.expired"
+    mv -f "${index}.tmp" "${index}"
+    # the index must stay newer than the chrono dirs we just modified
+    touch "${index}"
+    remove_files "${index}.expired"
 }
 
 do_rotate() {
@@ -660,43 +2522,15 @@ do_rotate() {
     # or ./TOPDIR/logs for logs
     ls -1d "${TOP_BACKUPDIR}" "$(get_backupdir)"/*|while read nsubdir;do
         # ./TOPDIR/HOSTNAME/DBNAME/${monthly,weekly,daily,dumps}
-        suf=""
         if [ x"$nsubdir" = "x${TOP_BACKUPDIR}" ];then
-            subdirs="logs"
-            suf="/logs"
-        else
-            subdirs="monthly weekly daily lastsnapshots"
-        fi
-        log "   - Operating in: ${YELLOW}'${nsubdir}${suf}'${NORMAL}"
-        for chronodir in ${subdirs};do
-            subdir="${nsubdir}/${chronodir}"
-            if [ -d "${subdir}" ];then
-                if [ x"${chronodir}" = "xlogs" ];then
-                    to_keep=${KEEP_LOGS:-60}
-                elif [ x"${chronodir}" = "xweekly" ];then
-                    to_keep=${KEEP_WEEKS:-2}
-                elif [ x"${chronodir}" = "xmonthly" ];then
-                    to_keep=${KEEP_MONTHES:-2}
-                elif [ x"${chronodir}" = "xdaily" ];then
-                    to_keep=${KEEP_DAYS:-2}
-                elif [ x"${chronodir}" = "xlastsnapshots" ];then
-                    to_keep=${KEEP_LASTS:-2}
-                else
-                    to_keep="65535" # int limit
-                fi
-                i=0
-                get_sorted_files "${subdir}" | while read nfic;do
-                    dfic="${subdir}/${nfic}"
-                    i="$((${i}+1))"
-                    if [ "${i}" -gt "${to_keep}" ] &&\
-                        [ -e "${dfic}" ] &&\
-                        [ ! -d ${dfic} ];then
-                        log "       * Unlinking ${YELLOW}${dfic}${NORMAL}"
-                        remove_files "${dfic}"
-                    fi
-                done
+            log "   - Operating in: ${YELLOW}'${nsubdir}/logs'${NORMAL}"
+            if [ -d "${nsubdir}/logs" ];then
+                rotate_dir "${nsubdir}/logs" "${KEEP_LOGS:-60}"
             fi
-        done
+        elif [ -d "${nsubdir}" ];then
+            log "   - Operating in: ${YELLOW}'${nsubdir}'${NORMAL}"
+            rotate_db_dir "${nsubdir}"
+        fi
     done
 }
 
@@ -713,20 +2547,36 @@ handle_hook_error() {
 }
 
 do_prune() {
+    metric_start
     do_rotate
+    metric_end rotate
     do_hook "Postrotate command output" "post_rotate_hook"
+    metric_start
     do_cleanup_orphans
+    metric_end cleanup_orphans
+    if [ x"$(fn_exists "${BACKUP_TYPE}_prune")" = "x0" ];then
+        "${BACKUP_TYPE}_prune"
+    fi
+    if [ x"${S3_URL}" != "x" ];then
+        metric_start
+        offload_sync
+        metric_end offload_sync
+    fi
     do_hook "Postcleanup command output" "post_cleanup_hook"
-    fix_perms
     do_post_backup
     do_hook "Postbackup command output" "post_backup_hook"
 }
 
 handle_exit() {
     DSB_RETURN_CODE="${DSB_RETURN_CODE:-$?}"
+    if [ x"${DSB_IN_JOB}" != "x" ];then
+        # backup jobs only report to the main process which does the rest
+        exit "${DSB_RETURN_CODE}"
+    fi
     if [ x"${DSB_BACKUP_STARTED}" != "x" ];then
         debug "handle_exit"
         DSB_HOOK_NO_TRAP="1"
+        kill_backup_jobs
         do_prune
         if [ x"$DSB_RETURN_CODE" != "x0" ];then
             log "WARNING, this script did not behaved correctly, check the log: $(get_logfile)"
@@ -740,6 +2590,7 @@ handle_exit() {
             DSB_RETURN_CODE="${DSB_BACKUP_FAILED}"
         fi
     fi
+    cleanup_rundir
     exit "${DSB_RETURN_CODE}"
 }
 
@@ -752,14 +2603,36 @@ do_cleanup_orphans() {
     log_rule
     debug "do_cleanup_orphans"
     log "Cleaning orphaned dumps:"
-    # prune all files in dumps dirs which have no more any
-    # hardlinks in chronoted directories (weekly, monthly, daily)
-    find "$(get_backupdir)" -type f -links 1 -print 2>/dev/null|\
-        while read fic
-        do
-            log "       * Pruning ${YELLOW}${fic}${NORMAL}"
-            remove_files "${fic}"
-        done
+    report="$(mktemp)"
+    # not piped: the walk metric is recorded in this shell
+    {
+        # release the unneeded bases first for their dumps to be pruned
+        sweep_diff_bases
+        if [ x"${DEDUP_STORE}" != "x" ];then
+            sweep_dedup_store
+        fi
+        # this walk is also what fixes the permissions
+        metric_start
+        walk_backup_tree 1
+        metric_end fix_perms
+        sweep_tocs
+    } > "${report}.walk"
+    awk -F"\t" '
+        $1 == "P" { pruned++; bytes += $2; print "Pruning " $3 }
+        $1 == "O" { owned++ }
+        $1 == "M" { moded++ }
+        END {
+            split("B KiB MiB GiB TiB", units, " ")
+            u = 1
+            while (bytes >= 1024 && u < 5) { bytes /= 1024; u++ }
+            printf "Pruned %d orphaned dumps (%.1f %s reclaimed), " \
+                "fixed ownership of %d and mode of %d entries\n",
+                pruned, bytes, units[u], owned, moded
+        }' "${report}.walk" > "${report}"
+    # the pruned files in bulk, then the summary (last line)
+    sed -e '$d' "${report}" | log_details
+    log " $(tail -n 1 "${report}")"
+    remove_files "${report}" "${report}.walk"
 }
 
 do_hook() {
@@ -781,6 +2654,115 @@ do_hook() {
     fi
 }
 
+do_db_backup_and_hooks() {
+    do_db_backup "${1}"
+    if [ x"${LAST_BACKUP_STATUS}" = "xfailure" ];then
+        do_hook "Postdbbackup: ${db}  command output" "post_db_backup_hook"
+        DSB_BACKUP_IN_FAILURE="y"
+    else
+        do_hook "Postdbbackup: ${db}(failure)  command output" "post_db_backup_failure_hook"
+    fi
+}
+
+ensure_rundir() {
+    # scratch directory for the current run, removed at exit
+    if [ x"${DSB_RUN_DIR}" = "x" ] || [ ! -d "${DSB_RUN_DIR}" ];then
+        DSB_RUN_DIR="$(mktemp -d)"
+    fi
+}
+
+cleanup_rundir() {
+    if [ x"${DSB_RUN_DIR}" != "x" ] && [ -d "${DSB_RUN_DIR}" ];then
+        rm -rf "${DSB_RUN_DIR}"
+    fi
+    DSB_RUN_DIR=""
+}
+
+run_db_backup_job() {
+    # executed in background, the main process collects the status
+    # and the log output once the job is finished
+    jobid="${1}"
+    DSB_IN_JOB="1"
+    # everything goes to the job log, replayed by the main process
+    DSB_LOG_DIRECT=""
+    DSB_BACKUP_IN_FAILURE=""
+    DSB_METRICS=""
+    do_db_backup_and_hooks "${2}"
+    printf "%s" "${DSB_METRICS}" > "${DSB_RUN_DIR}/${jobid}.metrics"
+    if [ x"${DSB_BACKUP_IN_FAILURE}" = "x" ];then
+        echo "ok" > "${DSB_RUN_DIR}/${jobid}.status"
+    fi
+}
+
+replay_job_log() {
+    if [ x"${DSB_LOG_DIRECT}" != "x" ];then
+        cat "${1}" >&8
+        sed -e "s/\x1B\[[0-9;]*[JKmsu]//g" "${1}" >&7
+    else
+        cat "${1}"
+    fi
+}
+
+reap_backup_jobs() {
+    running=""
+    for job in ${DSB_JOBS};do
+        pid="${job%%:*}"
+        jobid="${job#*:}"
+        if kill -0 "${pid}" 2>/dev/null;then
+            running="${running} ${job}"
+        else
+            wait "${pid}" 2>/dev/null
+            if [ -e "${DSB_RUN_DIR}/${jobid}.log" ];then
+                replay_job_log "${DSB_RUN_DIR}/${jobid}.log"
+            fi
+            if [ -s "${DSB_RUN_DIR}/${jobid}.metrics" ];then
+                DSB_METRICS="${DSB_METRICS}$(cat "${DSB_RUN_DIR}/${jobid}.metrics")
+"
+            fi
+            job_status=""
+            if [ -e "${DSB_RUN_DIR}/${jobid}.status" ];then
+                read job_status < "${DSB_RUN_DIR}/${jobid}.status"
+            fi
+            # a job which died before reporting is a failed one
+            if [ x"${job_status}" != "xok" ];then
+                DSB_BACKUP_IN_FAILURE="y"
+            fi
+            remove_files "${DSB_RUN_DIR}/${jobid}.log" "${DSB_RUN_DIR}/${jobid}.status"\
+                "${DSB_RUN_DIR}/${jobid}.metrics"
+        fi
+    done
+    DSB_JOBS="${running}"
+}
+
+wait_any_job() {
+    if [ "${BASH_VERSINFO:-0}" -gt "4" ] ||\
+        ( [ "${BASH_VERSINFO:-0}" = "4" ] && [ "${BASH_VERSINFO[1]:-0}" -ge "3" ] );then
+        wait -n 2>/dev/null
+    else
+        sleep 1
+    fi
+}
+
+wait_for_backup_jobs() {
+    # wait until less than ${1} backup jobs are running
+    max_jobs="${1}"
+    while true;do
+        reap_backup_jobs
+        set -- ${DSB_JOBS}
+        if [ "${#}" -lt "${max_jobs}" ];then
+            break
+        fi
+        wait_any_job
+    done
+}
+
+kill_backup_jobs() {
+    for job in ${DSB_JOBS};do
+        kill "${job%%:*}" 2>/dev/null
+    done
+    wait_for_backup_jobs 1
+}
+
 do_backup() {
     debug "do_backup"
     if [ x"${BACKUP_TYPE}" = "x" ];then
@@ -803,17 +2785,110 @@ do_backup() {
     if [ "x${BACKUP_DB_NAMES}" != "x" ];then
         log_rule
         log "DATABASES BACKUP"
+        if [ "${PARALLEL_JOBS:-1}" -gt "1" ];then
+            log "Running up to ${YELLOW}${PARALLEL_JOBS}${NORMAL}${RED} backups at the same time"
+            ensure_rundir
+        fi
+        if [ x"${DB_ORDER}" = "xsize" ];then
+            order_databases
+        fi
         log_rule
         for db in ${BACKUP_DB_NAMES};do
-            do_db_backup $db
-            if [ x"${LAST_BACKUP_STATUS}" = "xfailure" ];then
-                do_hook "Postdbbackup: ${db}  command output" "post_db_backup_hook"
-                DSB_BACKUP_IN_FAILURE="y"
+            if [ "${PARALLEL_JOBS:-1}" -gt "1" ];then
+                wait_for_backup_jobs "${PARALLEL_JOBS}"
+                DSB_JOB_COUNTER="$((${DSB_JOB_COUNTER:-0}+1))"
+                run_db_backup_job "${DSB_JOB_COUNTER}" "${db}"\
+                    > "${DSB_RUN_DIR}/${DSB_JOB_COUNTER}.log" 2>&1 &
+                DSB_JOBS="${DSB_JOBS} ${!}:${DSB_JOB_COUNTER}"
             else
-                do_hook "Postdbbackup: ${db}(failure)  command output" "post_db_backup_failure_hook"
+                do_db_backup_and_hooks "${db}"
             fi
         done
+        wait_for_backup_jobs 1
+    fi
+    wait_for_verifications
+}
+
+# RESIDENT MODE
+# With --daemon, the configuration is loaded and the databases discovered
+# once, then each cycle runs in a subshell of the daemon: it inherits this
+# warm state and only computes its dates and opens its own log file. The
+# rotation index stays on disk (see ROTATION INDEX), it is incremental.
+# Runs of the same backup directory are serialized by a lock on
+# $(get_backupdir)/.dsb_lock, which a daemon cycle never waits for.
+backup_lock() {
+    # take the lock of the backup directory on fd 6, ${1}: "-n" to fail
+    # instead of waiting for it
+    if ! has_binary flock;then
+        return 0
+    fi
+    if [ ! -d "$(get_backupdir)" ];then
+        mkdir -p "$(get_backupdir)"
+    fi
+    exec 6>> "$(get_backupdir)/.dsb_lock"
+    flock ${1:-} 6
+}
+
+daemon_cycle() {
+    # a backup and prune cycle, in a subshell with its own dates & log
+    (
+        set_dates
+        if [ x"${DSB_ACTITED_RIO}" != "x" ];then
+            exec 1>&8 2>&8 7>&-
+            DSB_ACTITED_RIO=""
+            DSB_LOG_DIRECT=""
+        fi
+        if ! backup_lock -n;then
+            log "Another backup of ${YELLOW}$(get_backupdir)${NORMAL}${RED} is running, skipping this cycle"
+            exit 0
+        fi
+        activate_IO_redirection
+        do_trap
+        do_backup
+        die_in_error "end_of_scripts"
+    )
+}
+
+do_daemon() {
+    # run daemon_cycle on schedule: the next cycle is due DAEMON_INTERVAL
+    # seconds after the previous one was, plus a jitter. The slots missed
+    # by a long cycle are skipped, then everything is reloaded by executing
+    # this script again every DAEMON_REFRESH cycles or after a failure
+    log_rule
+    log "Running as a daemon: a backup every ${YELLOW}${DAEMON_INTERVAL}s${NORMAL}${RED} (jitter: ${DAEMON_JITTER}s)${NORMAL}"
+    if [ "${DAEMON_INTERVAL}" -lt "1" ];then
+        DAEMON_INTERVAL="1"
     fi
+    cycles="0"
+    due="${DSB_DAEMON_DUE:-${SECONDS}}"
+    while true;do
+        due_in="$((due - SECONDS))"
+        if [ "${due_in}" -gt "0" ];then
+            # in background for the signals to be handled while waiting
+            sleep "${due_in}" &
+            wait "${!}"
+        fi
+        started="${SECONDS}"
+        daemon_cycle
+        cycle_status="${?}"
+        cycles="$((cycles + 1))"
+        slot="${due}"
+        missed="-1"
+        while [ "${due}" -le "${SECONDS}" ];do
+            due="$((slot + DAEMON_INTERVAL + RANDOM % (DAEMON_JITTER + 1)))"
+            slot="$((slot + DAEMON_INTERVAL))"
+            missed="$((missed + 1))"
+        done
+        log "Cycle ${cycles} took ${YELLOW}$((SECONDS - started))s${NORMAL}${RED} (status: ${cycle_status}), next one in ${YELLOW}$((due - SECONDS))s${NORMAL}"
+        if [ "${missed}" -gt "0" ];then
+            yellow_log "Skipped ${missed} cycles which were due while this one was running"
+        fi
+        if [ x"${cycle_status}" != "x0" ] || [ "${cycles}" -ge "${DAEMON_REFRESH}" ];then
+            log "Reloading the configuration and discovering the databases again"
+            # the schedule survives the reload
+            DSB_DAEMON_DUE="$((due - SECONDS))" exec "${0}" --daemon "${DSB_CONF_FILE}"
+        fi
+    done
 }
 
 mark_run_rotate() {
@@ -826,6 +2901,22 @@ mark_run_backup() {
     DO_BACKUP="1"
 }
 
+mark_run_verify_tree() {
+    DSB_CONF_FILE="${1}"
+    DO_VERIFY_TREE="1"
+}
+
+mark_run_daemon() {
+    DSB_CONF_FILE="${1}"
+    DO_DAEMON="1"
+}
+
+mark_run_extract() {
+    DO_EXTRACT="1"
+    EXTRACT_DUMP="${1}"
+    EXTRACT_OBJECT="${2}"
+}
+
 verify_backup_type() {
     for typ_ in _dump _dumpall;do
         if [ x"$(fn_exists ${BACKUP_TYPE}${typ_})" != "x0" ];then
@@ -835,7 +2926,7 @@ verify_backup_type() {
 }
 
 db_user() {
-    echo "${DBUSER:-${RUNAS:-$(whoami)}}"
+    echo "${DBUSER:-${RUNAS:-${DSB_WHOAMI}}}"
 }
 
 set_colors() {
@@ -851,6 +2942,47 @@ set_colors() {
     fi
 }
 
+set_dates() {
+    # all the dates of the run, from a single date call
+    IFS="${DSB_TAB}" read -r DSB_NOW DATE FDATE FULL_FDATE DOY DOW DNOW DOM M YEAR MNUM W\
+        <<< "$(date +"%s${DSB_TAB}%Y-%m-%d${DSB_TAB}%Y-%m-%d_%H-%M-%S${DSB_TAB}%Y-%m-%d_%H-%M-%S.%N${DSB_TAB}%j${DSB_TAB}%A${DSB_TAB}%u${DSB_TAB}%d${DSB_TAB}%B${DSB_TAB}%Y${DSB_TAB}%m${DSB_TAB}%V")"
+    # DATE: 2002-09-21, FDATE: 2002-09-21_01-02-03, FULL_FDATE: with the ns,
+    # DOY: day of the year (001..366), DOW: Monday, DNOW: 1 (Monday) to 7,
+    # DOM: day of the month, M: January, MNUM: 01, W: ISO week number
+}
+
+startup_cache_load() {
+    # set DSB_HOSTNAME & DSB_NPROC from STARTUP_CACHE ("name<TAB>value"
+    # lines, read, never sourced) if it is younger than STARTUP_CACHE_TTL,
+    # else compute and save them
+    DSB_HOSTNAME=""
+    DSB_NPROC=""
+    stamp="0"
+    if [ x"${STARTUP_CACHE}" != "x" ] && [ -f "${STARTUP_CACHE}" ];then
+        while IFS="${DSB_TAB}" read -r name value;do
+            case "${name}" in
+                stamp) stamp="${value}";;
+                hostname) DSB_HOSTNAME="${value}";;
+                nproc) DSB_NPROC="${value}";;
+            esac
+        done < "${STARTUP_CACHE}"
+    fi
+    if [ "$((${DSB_NOW:-0} - ${stamp:-0}))" -lt "${STARTUP_CACHE_TTL}" ] 2>/dev/null &&\
+        [ x"${DSB_HOSTNAME}" != "x" ] && [ x"${DSB_NPROC}" != "x" ];then
+        return 0
+    fi
+    DSB_HOSTNAME="$(hostname -f 2>/dev/null)"
+    if [ x"${DSB_HOSTNAME}" = x"" ]; then
+        DSB_HOSTNAME="$(hostname -s 2>/dev/null)"
+    fi
+    DSB_NPROC="$(nproc 2>/dev/null || echo 1)"
+    if [ x"${STARTUP_CACHE}" != "x" ] && [ -d "${STARTUP_CACHE%/*}" ];then
+        printf "stamp\t%s\nhostname\t%s\nnproc\t%s\n" "${DSB_NOW}" "${DSB_HOSTNAME}" "${DSB_NPROC}"\
+            > "${STARTUP_CACHE}.tmp" 2>/dev/null\
+            && mv -f "${STARTUP_CACHE}.tmp" "${STARTUP_CACHE}"
+    fi
+}
+
 set_vars() {
     debug "set_vars"
     args=${@}
@@ -878,6 +3010,12 @@ set_vars() {
                 mark_run_rotate ${2};sh="2"
             elif [ x"${1}" = "x-b" ] || [ x"${1}" = "x--backup" ];then
                 mark_run_backup ${2};sh="2"
+            elif [ x"${1}" = "x--verify-tree" ];then
+                mark_run_verify_tree ${2};sh="2"
+            elif [ x"${1}" = "x--daemon" ];then
+                mark_run_daemon ${2};sh="2"
+            elif [ x"${1}" = "x--extract" ];then
+                mark_run_extract "${2}" "${3}";sh="3"
             else
                 if [ x"${DB_SMART_BACKUP_AS_FUNCS}" = "x" ];then
                     usage
@@ -901,6 +3039,8 @@ set_vars() {
     ######## Backup settings
     NO_COLOR="${NO_COLOR:-}"
     COMP=${COMP:-xz}
+    COMP_LEVEL="${COMP_LEVEL:-}"
+    COMP_THREADS="${COMP_THREADS:-}"
     BACKUP_TYPE=${BACKUP_TYPE:-}
     TOP_BACKUPDIR="${TOP_BACKUPDIR:-/var/db_smart_backup}"
     DEFAULT_DO_GLOBAL_BACKUP="1"
@@ -913,6 +3053,37 @@ set_vars() {
     KEEP_WEEKS="${KEEP_WEEKS:-8}"
     KEEP_MONTHES="${KEEP_MONTHES:-12}"
     KEEP_LOGS="${KEEP_LOGS:-60}"
+    PARALLEL_JOBS="${PARALLEL_JOBS:-1}"
+    DB_ORDER="${DB_ORDER:-}"
+    DEDUP_STORE="${DEDUP_STORE:-}"
+    DIFF_BACKUPS="${DIFF_BACKUPS:-}"
+    DIFF_FULL_EVERY="${DIFF_FULL_EVERY:-24}"
+    SEEKABLE_BACKUPS="${SEEKABLE_BACKUPS:-}"
+    SEEKABLE_FRAME_SIZE="${SEEKABLE_FRAME_SIZE:-32M}"
+    SKIP_UNCHANGED="${SKIP_UNCHANGED:-}"
+    NICE_LEVEL="${NICE_LEVEL:-}"
+    IONICE_CLASS="${IONICE_CLASS:-}"
+    THROTTLE_RATE="${THROTTLE_RATE:-}"
+    THROTTLE_RULES="${THROTTLE_RULES:-}"
+    PV="${PV:-pv}"
+    METRICS_PROM_FILE="${METRICS_PROM_FILE:-}"
+    VERIFY_BACKUPS="${VERIFY_BACKUPS:-}"
+    VERIFY_JOBS="${VERIFY_JOBS:-}"
+    CHECKSUM="${CHECKSUM-sha256}"
+    VERIFY_TREE_DAYS="${VERIFY_TREE_DAYS:-30}"
+    S3_URL="${S3_URL:-}"
+    S3_ACCESS_KEY="${S3_ACCESS_KEY:-}"
+    S3_SECRET_KEY="${S3_SECRET_KEY:-}"
+    S3_REGION="${S3_REGION:-us-east-1}"
+    S3_PART_SIZE="${S3_PART_SIZE:-67108864}"
+    S3_JOBS="${S3_JOBS:-4}"
+    S3_BUFFER_DIR="${S3_BUFFER_DIR:-$(if [ -w /dev/shm ];then echo /dev/shm;else echo "${TMPDIR:-/tmp}";fi)}"
+    S3_CURL_ARGS="${S3_CURL_ARGS:-}"
+    STARTUP_CACHE_TTL="${STARTUP_CACHE_TTL:-86400}"
+    DAEMON_INTERVAL="${DAEMON_INTERVAL:-3600}"
+    DAEMON_JITTER="${DAEMON_JITTER:-300}"
+    DAEMON_REFRESH="${DAEMON_REFRESH:-24}"
+    DSB_METRICS=""
     DPERM="${DPERM:-"750"}"
     FPERM="${FPERM:-"640"}"
     OWNER="${OWNER:-"root"}"
@@ -927,37 +3098,36 @@ set_vars() {
     DBNAMES="${DBNAMES:-all}"
     DBEXCLUDE="${DBEXCLUDE:-}"
 
-    ######## hostname
-    GET_HOSTNAME=`hostname -f`
-    if [ x"${GET_HOSTNAME}" = x"" ]; then
-        GET_HOSTNAME=`hostname -s`
-    fi
-
     ######## Mail setup
     MAILCONTENT="${MAILCONTENT:-stdout}"
     MAXATTSIZE="${MAXATTSIZE:-4000}"
     MAILADDR="${MAILADDR:-root@localhost}"
 
-    MAIL_SERVERNAME="${MAIL_SERVERNAME:-${GET_HOSTNAME}}"
-
     ######### Postgresql
-    PSQL="${PSQL:-"$(which psql 2>/dev/null)"}"
-    PG_DUMP="${PG_DUMP:-"$(which pg_dump 2>/dev/null)"}"
-    PG_DUMPALL="${PG_DUMPALL:-"$(which pg_dumpall 2>/dev/null)"}"
+    PSQL="${PSQL:-"$(type -P psql)"}"
+    PG_DUMP="${PG_DUMP:-"$(type -P pg_dump)"}"
+    PG_DUMPALL="${PG_DUMPALL:-"$(type -P pg_dumpall)"}"
+    PG_RESTORE="${PG_RESTORE:-"$(type -P pg_restore)"}"
     OPT="${OPT:-"--create -Fc -Z0"}"
     OPTALL="${OPTALL:-"--globals-only"}"
+    OPTDIR="${OPTDIR:-"--create -Z0"}"
+    PG_DUMP_JOBS="${PG_DUMP_JOBS:-1}"
+    PG_DUMP_STAGING_DIR="${PG_DUMP_STAGING_DIR:-${TMPDIR:-/tmp}}"
 
     ######### MYSQL
     MYSQL_USE_SSL="${MYSQL_USE_SSL:-}"
     MYSQL_SOCK_PATHS="${MYSQL_SOCK_PATHS:-"/var/run/mysqld/mysqld.sock"}"
-    MYSQL="${MYSQL:-$(which mysql 2>/dev/null)}"
-    MYSQLDUMP="${MYSQLDUMP:-$(which mysqldump 2>/dev/null)}"
+    MYSQL="${MYSQL:-$(type -P mysql)}"
+    MYSQLDUMP="${MYSQLDUMP:-$(type -P mysqldump)}"
     MYSQLDUMP_NO_SINGLE_TRANSACTION="${MYSQLDUMP_NO_SINGLE_TRANSACTION:-}"
     MYSQLDUMP_AUTOCOMMIT="${MYSQLDUMP_AUTOCOMMIT:-1}"
     MYSQLDUMP_COMPLETEINSERTS="${MYSQLDUMP_COMPLETEINSERTS:-1}"
     MYSQLDUMP_LOCKTABLES="${MYSQLDUMP_LOCKTABLES:-}"
     MYSQLDUMP_DEBUG="${MYSQLDUMP_DEBUG:-}"
     MYSQLDUMP_NOROUTINES="${MYSQLDUMP_NOROUTINES:-}"
+    MYSQLDUMP_JOBS="${MYSQLDUMP_JOBS:-1}"
+    MYSQLDUMP_STAGING_DIR="${MYSQLDUMP_STAGING_DIR:-${TMPDIR:-/tmp}}"
+    MYSQLDUMP_LOCK_TIMEOUT="${MYSQLDUMP_LOCK_TIMEOUT:-60}"
     # mongodb
     MONGODB_PATH="${MONGODB_PATH:-"/var/lib/mongodb"}"
     MONGODB_USER="${MONGODB_USER:-"${DBUSER}"}"
@@ -966,6 +3136,8 @@ set_vars() {
     # slapd
     SLAPCAT_ARGS="${SLAPCAT_ARGS:-""}"
     SLAPD_DIR="${SLAPD_DIR:-/var/lib/ldap}"
+    SLAPD_PER_SUFFIX="${SLAPD_PER_SUFFIX:-}"
+    SLAPD_CONF="${SLAPD_CONF:-/etc/ldap/slapd.conf}"
 
     ######## Hooks
     pre_backup_hook="${pre_backup_hook:-}"
@@ -978,17 +3150,7 @@ set_vars() {
     COMP="${COMP-"${COMPS}"}"
     GLOBAL_SUBDIR="__GLOBAL__"
     PATH=$PATH:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
-    DATE=`date +%Y-%m-%d` # Datestamp e.g 2002-09-21
-    FDATE=`date +%Y-%m-%d_%H-%M-%S` # Datestamp e.g 2002-09-21
-    FULL_FDATE=`date +%Y-%m-%d_%H-%M-%S.%N` # Datestamp e.g 2002-09-21
-    DOY=`date +%j`  # Day of the YEAR 0..366
-    DOW=`date +%A`  # Day of the week e.g. Monday
-    DNOW=`date +%u` # Day number of the week 1 to 7 where 1 represents Monday
-    DOM=`date +%d`  # Date of the Month e.g. 27
-    M=`date +%B`    # Month e.g January
-    YEAR=`date +%Y` # Datestamp e.g 2002-09-21
-    MNUM=`date +%m` # Month e.g 1
-    W=`date +%V`    # Week Number e.g 37
+    set_dates
     DSB_BACKUPFILES="" # thh: added for later mailing
     DSB_RETURN_CODE=""
     DSB_GLOBAL_BACKUP_FAILED="3"
@@ -997,28 +3159,57 @@ set_vars() {
     if [ -e "${DSB_CONF_FILE}" ];then
         . "${DSB_CONF_FILE}"
     fi
+    ######## hostname & cpus, cached in the backup directory
+    STARTUP_CACHE="${STARTUP_CACHE-${TOP_BACKUPDIR}/.dsb_startup_cache}"
+    startup_cache_load
+    GET_HOSTNAME="${GET_HOSTNAME:-${DSB_HOSTNAME}}"
+    MAIL_SERVERNAME="${MAIL_SERVERNAME:-${GET_HOSTNAME}}"
+    VERIFY_JOBS="${VERIFY_JOBS:-${DSB_NPROC}}"
 
-    DEFAULT_PIPED_BACKUP_COMPRESSION="$(if ( echo $BACKUP_TYPE|grep -Eq "^ldap|slapd|mysql|post" );then echo 1;fi)"
+    DEFAULT_PIPED_BACKUP_COMPRESSION="$(if ( echo $BACKUP_TYPE|grep -Eq "^ldap|slapd|mysql|post|mongodb|redis|^es$" );then echo 1;fi)"
     export PIPED_BACKUP_COMPRESSION="${PIPED_BACKUP_COMPRESSION-${DEFAULT_PIPED_BACKUP_COMPRESSION}}"
 
-    activate_IO_redirection
+    # the extracted objects go to stdout, the messages to stderr only
+    if [ x"${DO_EXTRACT}" = "x" ];then
+        activate_IO_redirection
+    fi
     set_compressor
 
-    if [ x"${BACKUP_TYPE}" != "x" ];then
+    # the audit only needs the backup tree, not the database server
+    if [ x"${BACKUP_TYPE}" != "x" ] && [ x"${DO_VERIFY_TREE}" = "x" ] &&\
+        [ x"${DO_EXTRACT}" = "x" ];then
         verify_backup_type
         if [ x"$(fn_exists "${BACKUP_TYPE}_set_connection_vars")" = "x0" ];then
             "${BACKUP_TYPE}_set_connection_vars"
         fi
-        "${BACKUP_TYPE}_check_connectivity"
-        if [ x"$(fn_exists "${BACKUP_TYPE}_get_all_databases")" = "x0" ];then
-            ALL_DBNAMES="$(${BACKUP_TYPE}_get_all_databases)"
+        metric_start
+        if discover_server;then
+            # connectivity, databases & sizes in one round trip
+            ALL_DBNAMES="$(discovered_databases)"
+            metric_end discovery
+        else
+            "${BACKUP_TYPE}_check_connectivity"
+            metric_end connectivity
+            metric_start
+            if [ x"$(fn_exists "${BACKUP_TYPE}_get_all_databases")" = "x0" ];then
+                ALL_DBNAMES="$(${BACKUP_TYPE}_get_all_databases)"
+            fi
+            metric_end discovery
         fi
         if [ x"$(fn_exists "${BACKUP_TYPE}_set_vars")" = "x0" ];then
             "${BACKUP_TYPE}_set_vars"
         fi
     fi
-    if [ "x${BACKUP_TYPE}" = "xmongodb" ]\
-       || [ "x${BACKUP_TYPE}" = "xes" ]\
+    if [ "x${BACKUP_TYPE}" = "xmongodb" ];then
+        # mongodump --archive
+        BACKUP_EXT="archive"
+    elif [ "x${BACKUP_TYPE}" = "xes" ] && [ "x${ES_SNAPSHOT_MODE}" = "xrepository" ];then
+        # the snapshot description, data stays in the repository
+        BACKUP_EXT="snapshot"
+    elif [ "x${BACKUP_TYPE}" = "xredis" ] && [ "x${REDIS_BACKUP_MODE}" != "x" ];then
+        # a single rdb file
+        BACKUP_EXT="rdb"
+    elif [ "x${BACKUP_TYPE}" = "xes" ]\
        || [ "x${BACKUP_TYPE}" = "xredis" ];then
         BACKUP_EXT="tar"
     elif [ "x${BACKUP_TYPE}" = "xslapd" ];then
@@ -1026,6 +3217,11 @@ set_vars() {
     else
         BACKUP_EXT="sql"
     fi
+    # per database dumps may not have the same format than the global one
+    DB_BACKUP_EXT="${BACKUP_EXT}"
+    if [ "x${BACKUP_TYPE}" = "xpostgresql" ] && [ "${PG_DUMP_JOBS}" -gt "1" ];then
+        DB_BACKUP_EXT="tar"
+    fi
 
     BACKUP_DB_NAMES="${DBNAMES}"
     # Re source to reoverride any core overriden variable
@@ -1057,6 +3253,37 @@ set_vars() {
     ###
 }
 
+# SERVER DISCOVERY
+# A backup type can provide ${BACKUP_TYPE}_discover which prints, from a
+# single query, tab separated lines:
+#   version <TAB> server version
+#   db <TAB> database name <TAB> size in bytes
+# The result is kept in DSB_DISCOVERY for the whole run.
+discover_server() {
+    DSB_DISCOVERY=""
+    if [ x"$(fn_exists "${BACKUP_TYPE}_discover")" != "x0" ];then
+        return 1
+    fi
+    DSB_DISCOVERY="$("${BACKUP_TYPE}_discover" 2>/dev/null)"
+    if [ x"$?" != "x0" ] || ! echo "${DSB_DISCOVERY}"|grep -q "^version${DSB_TAB}";then
+        DSB_DISCOVERY=""
+        return 1
+    fi
+}
+
+discovered_databases() {
+    echo "${DSB_DISCOVERY}"|awk -F"\t" '$1 == "db" { print $2 }'
+}
+
+discovered_version() {
+    echo "${DSB_DISCOVERY}"|awk -F"\t" '$1 == "version" { print $2 }'
+}
+
+db_size() {
+    # size of ${1} in bytes if known
+    echo "${DSB_DISCOVERY}"|awk -F"\t" -v db="${1}" '$1 == "db" && $2 == db { print $3 }'
+}
+
 do_main() {
     if [ x"${1#--/}" = "x" ];then
         set_colors
@@ -1071,11 +3298,20 @@ do_main() {
         elif [ x"${DSB_GENERATE_CONFIG}" != "x" ];then
             generate_configuration_file
             die_in_error "end_of_scripts"
-        elif [ "x${DO_BACKUP}" != "x" ] || [ "x${DO_PRUNE}" != "x" ] ;then
+        elif [ "x${DO_EXTRACT}" != "x" ];then
+            do_extract "${EXTRACT_DUMP}" "${EXTRACT_OBJECT}"
+        elif [ "x${DO_BACKUP}" != "x" ] || [ "x${DO_PRUNE}" != "x" ]\
+            || [ "x${DO_VERIFY_TREE}" != "x" ] || [ "x${DO_DAEMON}" != "x" ];then
             if [ -e "${DSB_CONF_FILE}" ];then
-                if [ "x${DO_PRUNE}" != "x" ];then
+                if [ "x${DO_VERIFY_TREE}" != "x" ];then
+                    func=do_verify_tree
+                elif [ "x${DO_DAEMON}" != "x" ];then
+                    func=do_daemon
+                elif [ "x${DO_PRUNE}" != "x" ];then
+                    backup_lock
                     func=do_prune
                 else
+                    backup_lock
                     func=do_backup
                 fi
                 ${func}
@@ -1126,6 +3362,15 @@ postgresql_set_vars() {
     if [ x"${DBNAMES}" = "xall" ]; then
         die "${BACKUP_TYPE}: could not get all databases"
     fi
+    if [ x"${DEDUP_STORE}" != "x" ];then
+        case " ${OPT} " in
+            *" -F"[cdt]*|*" -F "[cdt]*|*" --format="[cdt]*) plain="";;
+            *) plain="1";;
+        esac
+        if [ x"${plain}" = "x" ] || [ "${PG_DUMP_JOBS:-1}" -gt "1" ];then
+            log "${CYAN}DEDUP_STORE: the postgresql archive formats record their creation time, only plain dumps (OPT=\"--create -Fp\") are deduplicated${NORMAL}"
+        fi
+    fi
     for i in "psql::${PSQL}" "pg_dumpall::${PG_DUMPALL}" "pg_dump::${PG_DUMP}";do
         var="$(echo ${i}|awk -F:: '{print $1}')"
         bin="$(echo ${i}|awk -F:: '{print $2}')"
@@ -1142,10 +3387,38 @@ postgresql_check_connectivity() {
     die_in_error "Cant connect to postgresql server with ${pgu} as ${who}, did you configured \$RUNAS("$(runas)") in $DSB_CONF_FILE"
 }
 
+postgresql_discover() {
+    echo "select 'version', current_setting('server_version'), ''
+          union all
+          select 'db', datname,
+              case when has_database_privilege(datname, 'CONNECT')
+              then pg_database_size(datname) else 0 end
+          from pg_database where datname <> 'template0'"\
+        | LANG=C LC_ALL=C psql_ --username="$(db_user)" -At -F "${DSB_TAB}" -d postgres
+}
+
 postgresql_get_all_databases() {
     LANG=C LC_ALL=C psql_ --username="$(db_user)"  -l -A -F: | sed -ne "/:/ { /Name:Owner/d; /template0/d; s/:.*$//; p }"
 }
 
+postgresql_fingerprint() {
+    if [ x"${1}" = x"${GLOBAL_SUBDIR}" ];then
+        # roles, memberships, settings & tablespaces
+        echo "select md5(
+            coalesce((select string_agg(a::text, ',' order by a.oid) from pg_authid a), '')
+            || coalesce((select string_agg(m::text, ',' order by m::text) from pg_auth_members m), '')
+            || coalesce((select string_agg(s::text, ',' order by s::text) from pg_db_role_setting s), '')
+            || coalesce((select string_agg(t::text, ',' order by t.oid) from pg_tablespace t), ''))"\
+            | psql_ --username="$(db_user)" -At -d postgres
+    else
+        # tuples counters also count the catalogs, thus DDL
+        echo "select tup_inserted, tup_updated, tup_deleted, stats_reset,
+              pg_postmaster_start_time()
+              from pg_stat_database where datname = :'db'"\
+            | psql_ --username="$(db_user)" -At -v db="${1}" -d postgres
+    fi
+}
+
 postgresql_dumpall() {
     if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
         pg_dumpall_ --username="$(db_user)" $OPTALL > "${2}"
@@ -1154,7 +3427,23 @@ postgresql_dumpall() {
     fi
 }
 
+postgresql_verify() {
+    if [ x"${1}" = x"${GLOBAL_SUBDIR}" ];then
+        # plain sql from pg_dumpall
+        tail -c 4096 | grep -q "dump complete"
+    elif [ x"${PG_RESTORE}" != "x" ];then
+        # list the custom format table of contents, read the rest
+        "${PG_RESTORE}" -l > /dev/null && cat > /dev/null
+    else
+        cat > /dev/null
+    fi
+}
+
 postgresql_dump() {
+    if [ "${PG_DUMP_JOBS:-1}" -gt "1" ];then
+        postgresql_dump_dir "${@}"
+        return $?
+    fi
     if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
         pg_dump_ --username="$(db_user)" $OPT "${1}" > "${2}"
     else
@@ -1162,14 +3451,37 @@ postgresql_dump() {
     fi
 }
 
+postgresql_dump_dir() {
+    # tables are dumped in parallel (pg_dump -Fd -j) in a staging directory
+    # which is then packed in a tar, compressed like any other dump
+    staging="$(mktemp -d "${PG_DUMP_STAGING_DIR}/dsb_pgdump.XXXXXX")"
+    if [ x"$?" != "x0" ];then
+        log "${CYAN}    Cannot create a staging directory in ${PG_DUMP_STAGING_DIR}${NORMAL}"
+        return 1
+    fi
+    chown "$(runas)" "${staging}"
+    pg_dump_ --username="$(db_user)" -Fd -j "${PG_DUMP_JOBS}" $OPTDIR -f "${staging}/dump" "${1}"
+    ret="$?"
+    if [ x"${ret}" = "x0" ];then
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            tar cf "${2}" -C "${staging}/dump" .
+        else
+            tar cf - -C "${staging}/dump" .
+        fi
+        ret="$?"
+    fi
+    rm -rf "${staging}"
+    return "${ret}"
+}
+
 #################### MYSQL
 # REAL API IS HERE
 mysql__() {
-    runcmd_as "${MYSQL}"    $(mysql_common_args) "${@}"
+    runcmd_as "${MYSQL}"    ${MYSQL_COMMON_ARGS-$(mysql_common_args)} "${@}"
 }
 
 mysqldump__() {
-    runcmd_as "${MYSQLDUMP}" $(mysql_common_args) "${@}"
+    runcmd_as "${MYSQLDUMP}" ${MYSQL_COMMON_ARGS-$(mysql_common_args)} "${@}"
 }
 
 mysqldump_() {
@@ -1197,6 +3509,7 @@ mysql_set_connection_vars() {
     else
         MYSQL_UNIX_PORT=
     fi
+    MYSQL_COMMON_ARGS="$(mysql_common_args)"
 }
 
 mysql_set_vars() {
@@ -1220,6 +3533,10 @@ mysql_set_vars() {
     if [ x"${MYSQLDUMP_NOROUTINES}" = x"" ];then
         MYSQLDUMP_OPTS_COMMON="${MYSQLDUMP_OPTS_COMMON} --routines"
     fi
+    if [ x"${DEDUP_STORE}" != x"" ];then
+        # the dump date would make each dump unique
+        MYSQLDUMP_OPTS_COMMON="${MYSQLDUMP_OPTS_COMMON} --skip-dump-date"
+    fi
     MYSQLDUMP_OPTS_COMMON="${MYSQLDUMP_OPTS_COMMON} --quote-names --opt"
     MYSQLDUMP_OPTS="${MYSQLDUMP_OPTS:-"${MYSQLDUMP_OPTS_COMMON}"}"
     MYSQLDUMP_ALL_OPTS="${MYSQLDUMP_ALL_OPTS:-"${MYSQLDUMP_OPTS_COMMON} --all-databases --no-data"}"
@@ -1247,7 +3564,7 @@ mysql_common_args() {
         args="${args} --ssl"
     fi
     if [ x"${MYSQL_UNIX_PORT}" = "x" ];then
-        args="--host=$MYSQL_HOST --port=$MYSQL_TCP_PORT"
+        args="${args} --host=$MYSQL_HOST --port=$MYSQL_TCP_PORT"
     fi
     echo "${args}"
 }
@@ -1259,6 +3576,17 @@ mysql_check_connectivity() {
     die_in_error "Cant connect to mysql server with ${mysqlu} as ${who}, did you configured \$RUNAS \$PASSWORD \$DBUSER in $DSB_CONF_FILE"
 }
 
+mysql_discover() {
+    echo "SELECT 'version', VERSION(), ''
+          UNION ALL
+          SELECT 'db', s.SCHEMA_NAME,
+              COALESCE(SUM(t.DATA_LENGTH + t.INDEX_LENGTH), 0)
+          FROM SCHEMATA s LEFT JOIN TABLES t ON t.TABLE_SCHEMA = s.SCHEMA_NAME
+          WHERE s.SCHEMA_NAME NOT IN ('performance_schema', 'information_schema')
+          GROUP BY s.SCHEMA_NAME;"\
+        | mysql_ -N --raw information_schema
+}
+
 mysql_get_all_databases() {
     echo "select schema_name from SCHEMATA;"|mysql_ -N information_schema 2>/dev/null \
         | grep -v performance_schema \
@@ -1266,6 +3594,41 @@ mysql_get_all_databases() {
     die_in_error "Could not get mysql databases"
 }
 
+mysql_fingerprint() {
+    if [ x"${1}" = x"${GLOBAL_SUBDIR}" ];then
+        return 0
+    fi
+    # InnoDB does not persist UPDATE_TIME and only estimates TABLE_ROWS, an
+    # in place UPDATE may not show in information_schema: the binary log
+    # position does, without binary log we cannot tell (no fingerprint)
+    binlog="$( { echo "SHOW MASTER STATUS;"|mysql_ -N 2>/dev/null\
+        || echo "SHOW BINARY LOG STATUS;"|mysql_ -N 2>/dev/null; }\
+        |awk -F"\t" 'NF >= 2 { print $1 ":" $2; exit }')"
+    if [ x"${binlog}" = "x" ];then
+        return 0
+    fi
+    db="$(mysql_sql_quote "${1}")"
+    # mysql 8 caches the tables statistics for one day by default,
+    # the /*!80000 */ statement fails harmlessly elsewhere (--force)
+    schema="$(echo "/*!80000 SET SESSION information_schema_stats_expiry=0 */;
+    SET SESSION group_concat_max_len=4294967295;
+    SELECT MD5(CONCAT_WS('|',
+      (SELECT GROUP_CONCAT(CONCAT_WS(',', TABLE_NAME, ENGINE, CREATE_TIME,
+         UPDATE_TIME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, AUTO_INCREMENT,
+         CHECKSUM) ORDER BY TABLE_NAME)
+       FROM TABLES WHERE TABLE_SCHEMA='${db}'),
+      (SELECT GROUP_CONCAT(MD5(VIEW_DEFINITION) ORDER BY TABLE_NAME)
+       FROM VIEWS WHERE TABLE_SCHEMA='${db}'),
+      (SELECT GROUP_CONCAT(CONCAT_WS(',', ROUTINE_NAME, LAST_ALTERED) ORDER BY ROUTINE_NAME)
+       FROM ROUTINES WHERE ROUTINE_SCHEMA='${db}'),
+      (SELECT GROUP_CONCAT(CONCAT_WS(',', TRIGGER_NAME, CREATED) ORDER BY TRIGGER_NAME)
+       FROM TRIGGERS WHERE TRIGGER_SCHEMA='${db}')));"\
+        | mysql_ -N --force information_schema 2>/dev/null)"
+    if [ x"${schema}" != "x" ];then
+        echo "${binlog} ${schema}"
+    fi
+}
+
 mysql_dumpall() {
     if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
         mysqldump_ ${MYSQLDUMP_ALL_OPTS} 2>&1 > "${2}"
@@ -1274,14 +3637,201 @@ mysql_dumpall() {
     fi
 }
 
+mysql_verify() {
+    # an interrupted mysqldump has no trailer
+    tail -c 4096 | grep -q "^-- Dump completed"
+}
+
+mysql_tracks_sessions() {
+    # can the parallel dump parts be found by their client pid
+    [ "$(echo "SELECT COUNT(*) FROM performance_schema.session_connect_attrs WHERE PROCESSLIST_ID = CONNECTION_ID() AND ATTR_NAME = '_pid';"\
+        | mysql_ -N 2>/dev/null)" -gt "0" ] 2>/dev/null
+}
+
 mysql_dump() {
-    if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+    jobs="${MYSQLDUMP_JOBS:-1}"
+    if [ "${jobs}" -gt "1" ] && [ x"${MYSQLDUMP_NO_SINGLE_TRANSACTION}" = "x" ]\
+        && ! mysql_tracks_sessions;then
+        log "${CYAN}    performance_schema is not available, ${1} is dumped by one mysqldump${NORMAL}"
+        jobs="1"
+    fi
+    if [ "${jobs}" -gt "1" ];then
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            mysql_dump_parallel "${1}" > "${2}"
+        else
+            mysql_dump_parallel "${1}"
+        fi
+    elif [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
         mysqldump_ ${MYSQLDUMP_OPTS} -B "${1}" > "${2}"
     else
         mysqldump_ ${MYSQLDUMP_OPTS} -B "${1}"
     fi
 }
 
+mysql_sql_quote() {
+    echo "${1}"|sed -e "s/\\\\/\\\\\\\\/g" -e "s/'/''/g"
+}
+
+mysql_group_tables() {
+    # split the tables of ${1} in ${3} groups of about the same size
+    # (biggest first, each in the least loaded group): ${2}/tables.<n>
+    db="$(mysql_sql_quote "${1}")"
+    echo "SELECT TABLE_NAME, COALESCE(DATA_LENGTH, 0) + COALESCE(INDEX_LENGTH, 0)
+          FROM TABLES WHERE TABLE_SCHEMA='${db}' AND TABLE_TYPE='BASE TABLE';"\
+        | mysql_ -N --raw information_schema\
+        | LC_ALL=C sort -t "${DSB_TAB}" -k2,2nr\
+        | awk -F"\t" -v groups="${3}" -v dir="${2}" '
+        {
+            g = 1
+            for (i = 2; i <= groups; i++) { if (load[i] < load[g]) { g = i } }
+            load[g] += $2
+            print $1 > (dir "/tables." g)
+        }'
+}
+
+mysql_lock_holder_query() {
+    # run ${1} in the session holding the global read lock and wait for
+    # ${2} to be printed back
+    echo "${1} SELECT '${2}';" >&9
+    waited="0"
+    while ! grep -q "^${2}\$" "${staging}/holder.out" 2>/dev/null;do
+        if grep -q "^ERROR" "${staging}/holder.out" 2>/dev/null\
+            || [ "${waited}" -ge "$((MYSQLDUMP_LOCK_TIMEOUT * 5))" ];then
+            cat "${staging}/holder.out" >&2
+            return 1
+        fi
+        sleep 0.2
+        waited="$((waited + 1))"
+    done
+}
+
+mysql_part_pids() {
+    # print the pids of the processes run by the dump parts ${@} (the
+    # mysqldump ones are children, or further down with RUNAS), comma
+    # separated
+    ps -eo pid=,ppid= | awk -v roots="${*}" '
+        BEGIN { n = split(roots, r, " "); for (i = 1; i <= n; i++) { ours[r[i]] = 1 } }
+        { parent[$1] = $2 }
+        END {
+            do {
+                changed = 0
+                for (p in parent) {
+                    if (!(p in ours) && (parent[p] in ours)) { ours[p] = 1; changed = 1 }
+                }
+            } while (changed)
+            for (p in ours) { printf "%s\047%s\047", sep, p; sep = "," }
+        }'
+}
+
+mysql_wait_snapshots() {
+    # wait for the ${1} dump parts (pids: ${2}...) to have opened their
+    # transaction: the finished parts, and the running ones whose
+    # connection (found by its client pid) has a transaction. Without
+    # performance_schema, this waits for all the parts to finish.
+    count="${1}"
+    shift
+    waited="0"
+    while [ "${waited}" -lt "$((MYSQLDUMP_LOCK_TIMEOUT * 5))" ];do
+        finished="$(ls "${staging}" | grep -c "^\(done\|failed\)\.")"
+        started="$(echo "SELECT COUNT(DISTINCT t.trx_mysql_thread_id) FROM INNODB_TRX t
+                   JOIN performance_schema.session_connect_attrs a
+                     ON a.PROCESSLIST_ID = t.trx_mysql_thread_id
+                   WHERE a.ATTR_NAME = '_pid' AND a.ATTR_VALUE IN ($(mysql_part_pids "${@}"));"\
+                   | mysql_ -N information_schema 2>/dev/null)"
+        if [ "$((${started:-0} + finished))" -ge "${count}" ];then
+            return 0
+        fi
+        sleep 0.2
+        waited="$((waited + 1))"
+    done
+    return 1
+}
+
+mysql_dump_parallel() {
+    # Dump ${1} with MYSQLDUMP_JOBS mysqldump processes, each one getting a
+    # group of tables, all started under a global read lock so that they
+    # see the same snapshot. Prints the reassembled dump on stdout.
+    mdb="${1}"
+    staging="$(mktemp -d "${MYSQLDUMP_STAGING_DIR}/dsb_mysqldump.XXXXXX")"
+    if [ x"$?" != "x0" ];then
+        log "${CYAN}    Cannot create a staging directory in ${MYSQLDUMP_STAGING_DIR}${NORMAL}"
+        return 1
+    fi
+    mysql_group_tables "${mdb}" "${staging}" "${MYSQLDUMP_JOBS}"
+    if [ x"$?" != "x0" ];then
+        rm -rf "${staging}"
+        return 1
+    fi
+    # session holding FLUSH TABLES WITH READ LOCK, fed through a fifo
+    mkfifo "${staging}/holder"
+    mysql_ -N --unbuffered information_schema < "${staging}/holder" > "${staging}/holder.out" 2>&1 &
+    holder="$!"
+    exec 9> "${staging}/holder"
+    ret="0"
+    if ! mysql_lock_holder_query "FLUSH TABLES WITH READ LOCK;" "dsb_locked";then
+        log "${CYAN}    Could not get the global read lock for ${mdb}${NORMAL}"
+        kill "${holder}" 2>/dev/null
+        ret="1"
+    fi
+    parts="0"
+    pids=""
+    if [ x"${ret}" = "x0" ];then
+        # schema (without triggers), tables data, then triggers
+        ( mysqldump_ ${MYSQLDUMP_OPTS} --no-data --skip-triggers -B "${mdb}"\
+            > "${staging}/part.0" && touch "${staging}/done.0"\
+            || touch "${staging}/failed.0" ) &
+        pids="${pids} $!"
+        for tables in "${staging}"/tables.*;do
+            if [ ! -e "${tables}" ];then
+                continue
+            fi
+            parts="$((parts + 1))"
+            set --
+            while IFS= read -r table;do
+                set -- "$@" "${table}"
+            done < "${tables}"
+            ( mysqldump_ ${MYSQLDUMP_OPTS} --no-create-info --skip-routines\
+                --skip-triggers --skip-lock-tables "${mdb}" "$@"\
+                > "${staging}/part.${parts}" && touch "${staging}/done.${parts}"\
+                || touch "${staging}/failed.${parts}" ) &
+            pids="${pids} $!"
+        done
+        parts="$((parts + 1))"
+        ( mysqldump_ ${MYSQLDUMP_OPTS} --no-data --no-create-info --skip-routines\
+            --triggers "${mdb}" > "${staging}/part.${parts}" && touch "${staging}/done.${parts}"\
+            || touch "${staging}/failed.${parts}" ) &
+        pids="${pids} $!"
+        if [ x"${MYSQLDUMP_NO_SINGLE_TRANSACTION}" = "x" ];then
+            if mysql_wait_snapshots "$((parts + 1))" ${pids};then
+                echo "UNLOCK TABLES;" >&9
+            else
+                log "${CYAN}    Could not check that all the dumps of ${mdb} share the same snapshot${NORMAL}"
+                ret="1"
+            fi
+        fi
+    fi
+    # reassemble the parts in order, each as soon as it is finished
+    part="0"
+    while [ x"${ret}" = "x0" ] && [ "${part}" -le "${parts}" ];do
+        if [ -e "${staging}/failed.${part}" ];then
+            log "${CYAN}    Part ${part} of the dump of ${mdb} failed${NORMAL}"
+            ret="1"
+        elif [ -e "${staging}/done.${part}" ];then
+            cat "${staging}/part.${part}" && rm -f "${staging}/part.${part}"
+            part="$((part + 1))"
+        else
+            sleep 0.2
+        fi
+    done
+    if [ x"${ret}" != "x0" ];then
+        kill ${pids} 2>/dev/null
+    fi
+    exec 9>&-
+    wait ${pids} "${holder}" 2>/dev/null
+    rm -rf "${staging}"
+    return "${ret}"
+}
+
 
 #################### MONGODB
 # REAL API IS HERE
@@ -1303,31 +3853,39 @@ mongodb_get_all_databases() {
 }
 
 mongodb_dumpall() {
-    DUMPDIR="${2}.dir"
-    if [ ! -e ${DUMPDIR} ];then
-        mkdir -p "${DUMPDIR}"
-    fi
+    mongo_args="${MONGODB_ARGS}"
     if [ "x${MONGODB_PASSWORD}"  != "x" ];then
-        MONGODB_ARGS="$MONGODB_ARGS -p $MONGODB_PASSWORD"
+        mongo_args="$mongo_args -p $MONGODB_PASSWORD"
     fi
     if [ "x${MONGODB_USER}"  != "x" ];then
-        MONGODB_ARGS="$MONGODB_ARGS -u $MONGODB_USER"
+        mongo_args="$mongo_args -u $MONGODB_USER"
+    fi
+    # a single archive stream, no staging directory
+    if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+        mongodump ${mongo_args} --archive="${2}"
+    else
+        mongodump ${mongo_args} --archive
     fi
-    mongodump ${MONGODB_ARGS} --out "${DUMPDIR}"\
-        && die_in_error "mongodb dump failed"
-    cd "${DUMPDIR}" &&  tar cf "${2}" .
-    die_in_error "mongodb tar failed"
-    rm -rf "${DUMPDIR}"
+    die_in_error "mongodb dump failed"
 }
 
 mongodb_dump() {
     /bin/true
 }
 
+mongodb_verify() {
+    # mongodump --archive magic number
+    [ "x$({ head -c 4 | od -An -tx1; cat > /dev/null; }|tr -d " \n")" = "x6de29981" ]
+}
+
 #################### redis
 # REAL API IS HERE
 redis_set_connection_vars() {
-    /bin/true
+    REDIS_BACKUP_MODE="${REDIS_BACKUP_MODE:-}"
+    REDIS_CLI="${REDIS_CLI:-"redis-cli"}"
+    REDIS_CLI_ARGS="${REDIS_CLI_ARGS:-}"
+    REDIS_POLL_INTERVAL="${REDIS_POLL_INTERVAL:-1}"
+    REDIS_BGSAVE_TIMEOUT="${REDIS_BGSAVE_TIMEOUT:-3600}"
 }
 
 redis_set_vars() {
@@ -1335,15 +3893,34 @@ redis_set_vars() {
     export REDIS_PATH="${REDIS_PATH:-"/var/lib/redis"}"
 }
 
+redis_cli() {
+    if [ "x${REDIS_CLI_ARGS}" = "x" ];then
+        if [ "x${HOST}" != "x" ];then
+            set -- -h "${HOST}" "${@}"
+        fi
+        if [ "x${PORT}" != "x" ];then
+            set -- -p "${PORT}" "${@}"
+        fi
+    fi
+    # REDISCLI_AUTH keeps the password out of the process list
+    REDISCLI_AUTH="${PASSWORD}" ${REDIS_CLI} ${REDIS_CLI_ARGS} "${@}"
+}
+
 redis_check_connectivity() {
-    if [ ! -e "${REDIS_PATH}" ];then
-        die_in_error "no redis dir"
+    if [ "x${REDIS_BACKUP_MODE}" != "x" ];then
+        if [ "x$(redis_cli PING 2>/dev/null)" != "xPONG" ];then
+            die "redis server is unreachable"
+        fi
+        return
     fi
-    if [ "x${REDIS_PATH}" != "x" ];then
-        die_in_error "redis dir is not set"
+    if [ "x${REDIS_PATH}" = "x" ];then
+        die "redis dir is not set"
+    fi
+    if [ ! -e "${REDIS_PATH}" ];then
+        die "no redis dir"
     fi
     if [ "x$(ls -1 "${REDIS_PATH}"|wc -l|sed -e"s/ //g")" = "x0" ];then
-        die_in_error "no redis rdbs in ${REDIS_PATH}"
+        die "no redis rdbs in ${REDIS_PATH}"
     fi
 }
 
@@ -1351,13 +3928,92 @@ redis_get_all_databases() {
     /bin/true
 }
 
+redis_fingerprint() {
+    # a remote server has no local files to look at
+    if [ "x${REDIS_BACKUP_MODE}" != "xrdb" ];then
+        files_fingerprint "${REDIS_PATH}"
+    fi
+}
+
+redis_rdb_path() {
+    # the server knows better where it saves, fallback on REDIS_PATH
+    # when CONFIG is renamed or disabled
+    dir="$(redis_cli CONFIG GET dir 2>/dev/null|sed -n 2p)"
+    dbfilename="$(redis_cli CONFIG GET dbfilename 2>/dev/null|sed -n 2p)"
+    echo "${dir:-${REDIS_PATH}}/${dbfilename:-dump.rdb}"
+}
+
+redis_persistence() {
+    # print "saving<TAB>rewriting the AOF<TAB>last save time<TAB>last save
+    # status" from INFO persistence
+    redis_cli INFO persistence|tr -d "\r"|awk -F: '
+        { info[$1] = $2 }
+        END {
+            print info["rdb_bgsave_in_progress"] + 0 "\t" info["aof_rewrite_in_progress"] + 0 "\t" \
+                info["rdb_last_save_time"] + 0 "\t" info["rdb_last_bgsave_status"]
+        }'
+}
+
+redis_bgsave() {
+    lastsave="$(redis_cli LASTSAVE)"
+    die_in_error "redis LASTSAVE failed"
+    # SCHEDULE postpones the save if an AOF rewrite is running
+    ret="$(redis_cli BGSAVE SCHEDULE 2>&1)"
+    case "${ret}" in
+        *ERR*) die "redis BGSAVE failed: ${ret}";;
+    esac
+    # LASTSAVE only changes when a save succeeds: wait until no save (nor
+    # the AOF rewrite a scheduled one waits for) is running, then the
+    # save is done if LASTSAVE changed, failed if its status is not ok
+    # (once it ran: the status is the one of the previous save before)
+    started=""
+    case "${ret}" in
+        *scheduled*) ;;
+        *) started="1";;
+    esac
+    deadline="$((SECONDS + REDIS_BGSAVE_TIMEOUT))"
+    while true;do
+        IFS="${DSB_TAB}" read -r saving rewriting saved status <<< "$(redis_persistence)"
+        if [ "x${saving}" = "x1" ];then
+            started="1"
+        elif [ "x${rewriting}" != "x1" ];then
+            if [ "x${saved}" != "x${lastsave}" ];then
+                break
+            elif [ "x${started}" != "x" ] && [ "x${status}" != "xok" ];then
+                die "redis BGSAVE did not succeed"
+            fi
+        fi
+        if [ "${SECONDS}" -ge "${deadline}" ];then
+            die "redis BGSAVE did not finish in ${REDIS_BGSAVE_TIMEOUT}s"
+        fi
+        sleep "${REDIS_POLL_INTERVAL}"
+    done
+    if [ "x${status}" != "xok" ];then
+        die "redis BGSAVE did not succeed"
+    fi
+}
+
 redis_dumpall() {
-    BCK_DIR="$(dirname ${2})"
-    if [ ! -e "${BCK_DIR}" ];then
-        mkdir -p "${BCK_DIR}"
+    if [ "x${REDIS_BACKUP_MODE}" = "xbgsave" ];then
+        redis_bgsave
+        # an open descriptor survives the next save renaming over the file
+        rdb="$(redis_rdb_path)"
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            cp "${rdb}" "${2}"
+        else
+            cat "${rdb}"
+        fi
+    elif [ "x${REDIS_BACKUP_MODE}" = "xrdb" ];then
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            redis_cli --rdb "${2}" 1>&2
+        else
+            redis_cli --rdb -
+        fi
+    elif [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+        tar cf "${2}" -C "${REDIS_PATH}" .
+    else
+        tar cf - -C "${REDIS_PATH}" .
     fi
-    c="${PWD}"
-    cd "${REDIS_PATH}" && tar cf "${2}" . && cd "${c}"
     die_in_error "redis $2 dump failed"
 }
 
@@ -1365,6 +4021,11 @@ redis_dump() {
     /bin/true
 }
 
+redis_verify() {
+    # tar archives are checked anyway, rdb files start with their magic
+    [ "x$({ head -c 5; cat > /dev/null; })" = "xREDIS" ]
+}
+
 #################### slapd
 # REAL API IS HERE
 slapd_set_connection_vars() {
@@ -1372,7 +4033,31 @@ slapd_set_connection_vars() {
 }
 
 slapd_set_vars() {
-    DBNAMES=""
+    if [ "x${SLAPD_PER_SUFFIX}" = "x" ];then
+        DBNAMES=""
+        return 0
+    fi
+    if [ x"${DBNAMES}" = "xall" ]; then
+        # suffixes contain "," & "=", exclude them by exact match
+        DBNAMES=""
+        for db in ${ALL_DBNAMES};do
+            case " ${DBEXCLUDE} " in
+                *" ${db} "*) ;;
+                *) DBNAMES="${DBNAMES} ${db}";;
+            esac
+        done
+    fi
+    if [ x"${DBNAMES}" = "xall" ] || [ x"${ALL_DBNAMES}" = "x" ]; then
+        die "${BACKUP_TYPE}: could not get all databases"
+    fi
+    # the suffixes are independent, export them at the same time
+    if [ "${PARALLEL_JOBS:-1}" -le "1" ];then
+        set -- ${DBNAMES}
+        PARALLEL_JOBS="${DSB_NPROC:-$(nproc 2>/dev/null || echo 1)}"
+        if [ "${#}" -lt "${PARALLEL_JOBS}" ];then
+            PARALLEL_JOBS="${#}"
+        fi
+    fi
 }
 
 slapd_check_connectivity() {
@@ -1384,8 +4069,56 @@ slapd_check_connectivity() {
     fi
 }
 
+slapd_databases() {
+    # "suffix<TAB>directory" of each exportable database, from cn=config
+    # or else from the static configuration; the config database itself
+    # has no directory ("-")
+    { slapcat ${SLAPCAT_ARGS} -n 0 2>/dev/null || cat "${SLAPD_CONF}" 2>/dev/null; }\
+        | awk -v OFS="\t" '
+        # unwrap the ldif continuation lines
+        /^ / { line = line substr($0, 2); next }
+        { parse(line); line = $0 }
+        END { parse(line); flush() }
+        function flush() {
+            if (suffix != "" && (directory != "" || suffix == "cn=config")) {
+                print suffix, (directory == "" ? "-" : directory)
+            }
+            suffix = ""; directory = ""
+        }
+        function value(s) {
+            sub(/^[^ \t]+[ \t]+/, "", s); gsub(/^"|"$/, "", s)
+            return s
+        }
+        function parse(s) {
+            if (s ~ /^dn: olcDatabase=\{0\}config,cn=config$/) {
+                flush(); suffix = "cn=config"
+            } else if (s ~ /^dn: / || s ~ /^database[ \t]/) {
+                flush()
+            } else if (s ~ /^(olcSuffix:|suffix[ \t])/) {
+                suffix = value(s)
+            } else if (s ~ /^(olcDbDirectory:|directory[ \t])/) {
+                directory = value(s)
+            }
+        }'
+}
+
 slapd_get_all_databases() {
-    /bin/true
+    if [ "x${SLAPD_PER_SUFFIX}" != "x" ];then
+        # spaces in the suffixes are encoded, see do_db_backup
+        slapd_databases|awk -F"\t" '{ gsub(/ /, "%", $1); print $1 }'
+    fi
+}
+
+slapd_fingerprint() {
+    # the files of the suffix ${1} or of all of them
+    if [ "x${SLAPD_PER_SUFFIX}" = "x" ] || [ "x${1}" = "x${GLOBAL_SUBDIR}" ];then
+        files_fingerprint "${SLAPD_DIR}"
+    else
+        dir="$(slapd_databases|awk -F"\t" -v db="${1}" '$1 == db { print $2 }')"
+        if [ -d "${dir}" ];then
+            files_fingerprint "${dir}"
+        fi
+    fi
 }
 
 slapd_dumpall() {
@@ -1402,7 +4135,16 @@ slapd_dumpall() {
 }
 
 slapd_dump() {
-    /bin/true
+    # one suffix, see SLAPD_PER_SUFFIX
+    if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+        slapcat ${SLAPCAT_ARGS} -b "${1}" > "${2}"
+    else
+        slapcat ${SLAPCAT_ARGS} -b "${1}"
+    fi
+}
+
+slapd_verify() {
+    awk 'NR == 1 && !/^dn:/ { bad = 1 } END { exit (bad || NR == 0) }'
 }
 
 # ELASTICSEARCH
@@ -1412,9 +4154,16 @@ es_set_connection_vars() {
     fi
     export ES_USER="${ES_USER:-${DBUSER}}"
     export ES_PASSWORD="${ES_PASSWORD:-${PASSWORD}}"
+    ES_SNAPSHOT_MODE="${ES_SNAPSHOT_MODE:-}"
+    ES_REPOSITORY="${ES_REPOSITORY:-dsb}"
+    ES_POLL_INTERVAL="${ES_POLL_INTERVAL:-5}"
 }
 
 es_set_vars() {
+    es_set_snapshots_dir
+    if [ "x${ES_SNAPSHOT_MODE}" = "xrepository" ];then
+        es_ensure_repository
+    fi
     export BACKUP_DB_NAMES="${BACKUP_DB_NAMES:-${DBNAMES}}"
     if [ x"${DBNAMES}" = "xall" ]; then
         DBNAMES=${ALL_DBNAMES}
@@ -1447,6 +4196,9 @@ curl_es() {
 
 es_check_connectivity() {
     curl_es 1>/dev/null || die_in_error "$ES_URI unreachable"
+}
+
+es_set_snapshots_dir() {
     if [  "x$ES_SNAPSHOTS_DIR" = "x" ];then
         ES_TMP=$(curl_es "_nodes/_local?pretty"|grep '"work" :'|awk '{print $3}'|sed -e 's/\(^[^"]*"\)\|\("[^"]*$\)//g')
         if [ "x${ES_TMP}" = "x" ];then ES_SNAPSHOTS_DIR="${TOP_BACKUPDIR}/tmp";fi
@@ -1457,6 +4209,17 @@ es_check_connectivity() {
     # set backup repository
 }
 
+es_discover() {
+    version="$(curl_es ""|jq -r .version.number)"
+    if [ x"${version}" = "x" ] || [ x"${version}" = "xnull" ];then
+        return 1
+    fi
+    # a failed listing must not look like a server without indices
+    indices="$(curl_es "_cat/indices?bytes=b&h=index,store.size" --fail)" || return 1
+    printf "version\t%s\t\n" "${version}"
+    echo "${indices}"|awk -v OFS="\t" 'NF { print "db", $1, $2 + 0 }'
+}
+
 es_get_all_databases() {
     curl_es _cat/indices|awk '{print $3}'
 }
@@ -1514,25 +4277,129 @@ es_preparerepo() {
 }
 
 
+es_tar_snapshot() {
+    # stream the snapshot repository of ${1} (repo: ${2}) to ${3}
+    # (or stdout when piped); the snapshot info goes to the log
+    directory=$(es_getworkdir ${1})
+    if [ ! -e "${directory}" ];then
+        /bin/false
+        die_in_error "ES tar: ${3} / ${1} / ${2} backup workdir ${directory} pb"
+    fi
+    if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+        tar cf "${3}" -C "${directory}" .
+    else
+        tar cf - -C "${directory}" .
+    fi
+    die_in_error "ES tar: ${3} / ${1} / ${2} failed"
+    curl_es "_snapshot/${2}/dump" >&2 && echo >&2
+}
+
+# ES_SNAPSHOT_MODE=repository
+es_ensure_repository() {
+    # create the shared repository unless it already points to its location
+    directory="$(es_getworkdir "${ES_REPOSITORY}")"
+    ret=$(curl_es "_snapshot/${ES_REPOSITORY}"\
+        |jq -r '.["'"${ES_REPOSITORY}"'"]["settings"]["location"] // empty' 2>/dev/null)
+    if [ "x${ret}" = "x${directory}" ];then
+        return 0
+    fi
+    ret=$(curl_es "_snapshot/${ES_REPOSITORY}" -XPUT\
+        -d '{"type": "fs", "settings": {"location": "'"${directory}"'", "compress": true}}')
+    if [ "x${ret}" != 'x{"acknowledged":true}' ];then
+        echo "${ret}" >&2
+        /bin/false
+        die "Cannot create repo ${ES_REPOSITORY} (${directory})"
+    fi
+}
+
+es_snapshot_name() {
+    # snapshot of the dump ${1}: its file name without extension, lowercased
+    basename "${1%.${BACKUP_EXT}}"|tr "[:upper:]" "[:lower:]"
+}
+
+es_snapshot() {
+    # start the snapshot for the dump ${1} with the settings ${2} without
+    # waiting for it, then poll its state; on success, the snapshot
+    # description is the dump
+    snapshot="$(es_snapshot_name "${1}")"
+    ret=$(curl_es "_snapshot/${ES_REPOSITORY}/${snapshot}?wait_for_completion=false" -XPUT -d "${2}")
+    if ! echo "${ret}"|grep -q '"accepted":true';then
+        echo "${ret}" >&2
+        return 1
+    fi
+    # ours to prune, even if it does not succeed
+    dsbdir="$(dirname "$(dirname "${1}")")/.dsb"
+    if [ ! -d "${dsbdir}" ];then
+        mkdir -p "${dsbdir}"
+    fi
+    echo "${snapshot}" >> "${dsbdir}/es_snapshots"
+    state="IN_PROGRESS"
+    while [ "x${state}" = "xIN_PROGRESS" ] || [ "x${state}" = "xSTARTED" ];do
+        sleep "${ES_POLL_INTERVAL}"
+        ret=$(curl_es "_snapshot/${ES_REPOSITORY}/${snapshot}")
+        state=$(echo "${ret}"|jq -r '.snapshots[0].state // empty' 2>/dev/null)
+    done
+    if [ "x${state}" != "xSUCCESS" ];then
+        echo "${ret}" >&2
+        return 1
+    fi
+    echo "${ret}"|jq '.snapshots[0]'
+}
+
+es_prune() {
+    # delete the snapshots we took (see es_snapshot) whose dumps were
+    # pruned, and forget the ones which are not in the repository anymore
+    if [ "x${ES_SNAPSHOT_MODE}" != "xrepository" ];then
+        return 0
+    fi
+    kept="$(find "$(get_backupdir)" -path "*/dumps/*.${BACKUP_EXT}*" -printf "%f\n" 2>/dev/null\
+        |sed -e "s/\.${BACKUP_EXT}.*//"|tr "[:upper:]" "[:lower:]")"
+    if [ "x${kept}" = "x" ];then
+        log "${CYAN}    No dump in $(get_backupdir), not pruning the snapshots${NORMAL}"
+        return 0
+    fi
+    snapshots="$(curl_es "_snapshot/${ES_REPOSITORY}/_all"\
+        |jq -r '.snapshots[]|.state + "\t" + .snapshot' 2>/dev/null)"
+    if [ "x${snapshots}" = "x" ];then
+        return 0
+    fi
+    done_snapshots="$(echo "${snapshots}"|awk -F"\t" '$1 != "IN_PROGRESS" { print $2 }')"
+    expired="$(cat "$(get_backupdir)"/*/.dsb/es_snapshots 2>/dev/null|sort -u\
+        |grep -vxF -e "${kept}"|grep -xF -e "${done_snapshots:-/}"|paste -sd, -)"
+    if [ "x${expired}" != "x" ];then
+        log "Deleting expired snapshots: ${YELLOW}${expired}${NORMAL}"
+        if ! curl_es "_snapshot/${ES_REPOSITORY}/${expired}" -XDELETE --fail >/dev/null;then
+            log "${CYAN}    Deleting the snapshots failed, retried at the next run${NORMAL}"
+            return 0
+        fi
+    fi
+    # keep the snapshots still in the repository but the deleted ones
+    remaining="$(echo "${snapshots}"|cut -f2|grep -vxF -e "$(echo "${expired}"|tr "," "\n")")"
+    for manifest in "$(get_backupdir)"/*/.dsb/es_snapshots;do
+        if [ -f "${manifest}" ];then
+            grep -xF -e "${remaining:-/}" "${manifest}" > "${manifest}.tmp"
+            mv -f "${manifest}.tmp" "${manifest}"
+        fi
+    done
+}
+
 es_dumpall() {
-    cwd="${PWD}"
+    if [ "x${ES_SNAPSHOT_MODE}" = "xrepository" ];then
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            es_snapshot "${2}" '{"include_global_state": true}' > "${2}"
+        else
+            es_snapshot "${2}" '{"include_global_state": true}'
+        fi
+        die_in_error "ES snapshot: ${2} failed"
+        return
+    fi
     name="$(basename $(dirname $(dirname ${2})))"
     esname="$(es_getreponame ${name})"
     es_preparerepo "${name}"
     ret=$(curl_es "_snapshot/${esname}/dump" -XDELETE)
     ret=$(curl_es "_snapshot/${esname}/dump?wait_for_completion=true" -XPUT)
     if [ "x$(echo "${ret}"|grep -q '"state":"SUCCESS"';echo ${?})" = "x0" ];then
-        directory=$(es_getworkdir ${name})
-        if [ -e "${directory}" ];then
-            cd "${directory}"
-            tar cf "${2}" .\
-                && curl_es "_snapshot/${esname}/dump"\
-                && cd "${cwd}"\
-                && echo
-            die_in_error "ES tar: ${2} / ${name} / ${esname} failed"
-        else
-            die_in_error "ES tar: ${2} / ${name} / ${esname} backup workdir ${directory}  pb"
-        fi
+        es_tar_snapshot "${name}" "${esname}" "${2}"
     else
         echo ${ret} >&2;/bin/false
         die_in_error "ES tar: ${2} / ${name} / ${esname} backup failed"
@@ -1540,7 +4407,16 @@ es_dumpall() {
 }
 
 es_dump() {
-    cwd="${PWD}"
+    if [ "x${ES_SNAPSHOT_MODE}" = "xrepository" ];then
+        settings='{"indices": "'"${1}"'", "ignore_unavailable": true, "include_global_state": false}'
+        if [ "x${PIPED_BACKUP_COMPRESSION}" != "x1" ];then
+            es_snapshot "${2}" "${settings}" > "${2}"
+        else
+            es_snapshot "${2}" "${settings}"
+        fi
+        die_in_error "ES snapshot: ${2} failed"
+        return
+    fi
     name="$(basename $(dirname $(dirname ${2})))"
     esname="$(es_getreponame ${name})"
     es_preparerepo "${name}"
@@ -1551,23 +4427,18 @@ es_dump() {
         "include_global_state": false
     }')
     if [ "x$(echo "${ret}"|grep -q '"state":"SUCCESS"';echo ${?})" = "x0" ];then
-        directory=$(es_getworkdir ${name})
-        if [ -e "${directory}" ];then
-            cd "${directory}"
-            tar cf "${2}" .\
-                && curl_es "_snapshot/${esname}/dump"\
-                && cd "${cwd}"\
-                && echo
-            die_in_error "ESs tar: ${2} / ${name} / ${esname} failed"
-        else
-            die_in_error "ESs tar: ${2} / ${name} / ${esname} backup workdir ${directory} pb"
-        fi
+        es_tar_snapshot "${name}" "${esname}" "${2}"
     else
         echo ${ret} >&2;/bin/false
         die_in_error "ESs tar: ${2} / ${name} / ${esname} backup failed"
     fi
 }
 
+es_verify() {
+    # repository snapshots descriptions, tar archives are checked anyway
+    grep -q '"state" *: *"SUCCESS"' && cat > /dev/null
+}
+
 #################### MAIN
 if [ x"${DB_SMART_BACKUP_AS_FUNCS}" = "x" ];then
     do_main "${@}"
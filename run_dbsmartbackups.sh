@@ -9,12 +9,19 @@
 # slapd: /etc/dbsmartbackup/slapd.conf
 # redis: /etc/dbsmartbackup/redis.conf
 #
+# The running instances are discovered once, then backed up concurrently
+# (up to RUN_JOBS at the same time, default: the number of cpus).
+# Each instance is protected by a lock in LOCK_DIR so that an overlapping
+# run (eg: a slow cron) skips it instead of colliding with it.
+#
 if [ -f /etc/db_smart_backup_deactivated ];then
     exit 0
 fi
 
 LOG="${LOG:-/var/log/run_dbsmartbackup.log}"
 QUIET="${QUIET:-}"
+RUN_JOBS="${RUN_JOBS:-$(nproc 2>/dev/null || echo 1)}"
+LOCK_DIR="${LOCK_DIR:-/var/run/dbsmartbackup}"
 RET=0
 for i in ${@};do
     if [ "x${i}" = "x--no-colors" ];then
@@ -23,6 +30,9 @@ for i in ${@};do
     if [ "x${i}" = "x--quiet" ];then
         QUIET="1"
     fi
+    if [ "x${i#--jobs=}" != "x${i}" ];then
+        RUN_JOBS="${i#--jobs=}"
+    fi
     if [ "x${i}" = "x--help" ] || \
        [ "x${i}" = "x--h" ]  \
         ;then
@@ -31,7 +41,7 @@ for i in ${@};do
 done
 __NAME__="RUN_DB_SMARTBACKUPS"
 if [ "x${HELP}" != "x" ];then
-    echo "${0} [--quiet] [--no-colors]"
+    echo "${0} [--quiet] [--no-colors] [--jobs=N]"
     echo "Run all found db_smart_backups configurations"
     exit 1
 fi
@@ -40,37 +50,167 @@ if [ x"${DEBUG}" != "x" ];then
 fi
 
 is_container() {
-    echo  "$(cat -e /proc/1/environ |grep container=|wc -l|sed -e "s/ //g")"
+    echo  "$(cat -e /proc/1/environ 2>/dev/null|grep container=|wc -l|sed -e "s/ //g")"
 }
 
 filter_host_pids() {
-    pids=""
-    if [ "x$(is_container)" != "x0" ];then
-        pids="${pids} $(echo "${@}")"
+    # drop the pids running in lxc containers, one grep for all of them
+    if [ "x${IS_CONTAINER}" != "x0" ] || [ "x${*}" = "x" ];then
+        echo "${@}"
     else
         for pid in ${@};do
-            if [ "x$(grep -q /lxc/ /proc/${pid}/cgroup 2>/dev/null;echo "${?}")" != "x0" ];then
-                pids="${pids} $(echo "${pid}")"
+            echo "/proc/${pid}/cgroup"
+        done | xargs grep -L /lxc/ 2>/dev/null\
+            | sed -e "s|/proc/\([0-9]*\)/cgroup|\1|"
+    fi
+}
+
+running() {
+    # pids of the processes whose command line matches ${1}, from the
+    # process list taken once at startup
+    filter_host_pids $(echo "${PROCESSES}"\
+        | awk -v re="${1}" '$0 ~ re { print $1 }')
+}
+
+discover_instances() {
+    # print one "kind[:port]" line per instance to backup
+    # try to run postgresql backup to any postgresql version if we found
+    # a running socket in the standard debian location
+    if [ -e "${DB_SMARTBACKUPS_CONFS}/postgresql.conf" ];then
+        for port in $(echo "${PG_PORTS}"|awk '{print $2}'|sort -u);do
+            if [ -e "/var/run/postgresql/.s.PGSQL.${port}" ];then
+                echo "postgresql:${port}"
             fi
-         done
+        done
+    fi
+    # try to run mysql backups if the config file is present
+    # and we found a mysqld process
+    if [ -e "${DB_SMARTBACKUPS_CONFS}/mysql.conf" ] && [ "x$(which mysql 2>/dev/null)" != "x" ] &&\
+        [ "x$(running mysqld)" != "x" ];then
+        echo "mysql"
+    fi
+    if [ -e "${DB_SMARTBACKUPS_CONFS}/redis.conf" ] && [ "x$(which redis-server 2>/dev/null)" != "x" ] &&\
+        [ "x$(running redis-server)" != "x" ];then
+        echo "redis"
+    fi
+    if [ -e "${DB_SMARTBACKUPS_CONFS}/mongod.conf" ] && [ "x$(which mongod 2>/dev/null)" != "x" ] &&\
+        [ "x$(running mongod)" != "x" ];then
+        echo "mongod"
+    fi
+    if [ -e "${DB_SMARTBACKUPS_CONFS}/slapd.conf" ] && [ "x$(running slapd)" != "x" ];then
+        echo "slapd"
+    fi
+    if [ -e "${DB_SMARTBACKUPS_CONFS}/elasticsearch.conf" ] &&\
+        [ "x$(running org.elasticsearch.bootstrap.Elasticsearch)" != "x" ];then
+        echo "elasticsearch"
     fi
-    echo "${pids}" | sed -e "s/\(^ \+\)\|\( \+$\)//g"
 }
 
-go_run_db_smart_backup() {
-    conf="${1}"
-    if [ "x${QUIET}" != "x" ];then
-        db_smart_backup.sh "${conf}" 2>&1 1>> "${LOG}"
-        if [ "x${?}" != "x0" ];then
-            RET=1
-        fi
-    else
-        db_smart_backup.sh "${conf}"
-        if [ "x${?}" != "x0" ];then
-            RET=1
+run_instance() {
+    # backup the instance ${1} (see discover_instances), in a subshell
+    kind="${1%%:*}"
+    port="${1#*:}"
+    CONF="${DB_SMARTBACKUPS_CONFS}/${kind}.conf"
+    if [ "x${kind}" = "xpostgresql" ];then
+        # search back from which config the port comes from, and the
+        # postgres version to export binaries
+        export PGVER="$(echo "${PG_PORTS}"\
+            | awk -v port="${port}" '$2 == port && $1 ~ /^\/etc\/postgresql\// {
+                n = split($1, parts, "/"); print parts[n - 2]; exit }')"
+        export PGVER="${PGVER:-9.3}"
+        export PGHOST="/var/run/postgresql"
+        export HOST="${PGHOST}"
+        export PGPORT="$port"
+        export PORT="${PGPORT}"
+        export PATH="/usr/lib/postgresql/${PGVER}/bin:${PATH}"
+        if [ "x${QUIET}" = "x" ];then
+            echo "$__NAME__: Running backup for postgresql /var/run/postgresql/.s.PGSQL.${port}: ${PGVER} (${CONF} $(which psql))"
         fi
+    elif [ "x${QUIET}" = "x" ];then
+        echo "$__NAME__: Running backup for ${kind} (${CONF})"
     fi
+    db_smart_backup.sh "${CONF}"
+}
+
+start_instance() {
+    # run ${1} in background, with its output in its own file and its
+    # status in RUN_DIR/<id>.status; an instance which is still being
+    # backed up by another run is skipped
+    id="$(echo "${1}"|sed -e "s/[^A-Za-z0-9_.-]/_/g")"
+    (
+        started="${SECONDS}"
+        if [ "x${HAS_FLOCK}" != "x" ];then
+            exec 9> "${LOCK_DIR}/${id}.lock"
+            if ! flock -n 9;then
+                printf "skipped\t0\n" > "${RUN_DIR}/${id}.status"
+                exit 0
+            fi
+        fi
+        run_instance "${1}" > "${RUN_DIR}/${id}.log" 2>&1
+        if [ "x${?}" = "x0" ];then
+            status="ok"
+        else
+            status="failure"
+        fi
+        printf "%s\t%s\n" "${status}" "$((SECONDS - started))" > "${RUN_DIR}/${id}.status"
+    ) &
+    JOBS="${JOBS} ${!}:${id}"
+}
+
+reap_instances() {
+    running=""
+    for job in ${JOBS};do
+        pid="${job%%:*}"
+        id="${job#*:}"
+        if kill -0 "${pid}" 2>/dev/null;then
+            running="${running} ${job}"
+        else
+            wait "${pid}" 2>/dev/null
+            # grouped output, in the order the instances finish
+            if [ -e "${RUN_DIR}/${id}.log" ];then
+                if [ "x${QUIET}" != "x" ];then
+                    cat "${RUN_DIR}/${id}.log" >> "${LOG}"
+                else
+                    cat "${RUN_DIR}/${id}.log"
+                fi
+            fi
+            status="failure${TAB}0"
+            if [ -e "${RUN_DIR}/${id}.status" ];then
+                read status < "${RUN_DIR}/${id}.status"
+            fi
+            if [ "x${status%%${TAB}*}" = "xfailure" ];then
+                RET=1
+            fi
+            SUMMARY="${SUMMARY}${id}${TAB}${status}
+"
+        fi
+    done
+    JOBS="${running}"
 }
+
+wait_instances() {
+    # wait until less than ${1} instances are being backed up
+    while true;do
+        reap_instances
+        set -- "${1}" ${JOBS}
+        if [ "$((${#} - 1))" -lt "${1}" ];then
+            break
+        fi
+        if [ "${BASH_VERSINFO:-0}" -gt "4" ] ||\
+            ( [ "${BASH_VERSINFO:-0}" = "4" ] && [ "${BASH_VERSINFO[1]:-0}" -ge "3" ] );then
+            wait -n 2>/dev/null
+        else
+            sleep 1
+        fi
+    done
+}
+
+TAB="$(printf "\t")"
+IS_CONTAINER="$(is_container)"
+DB_SMARTBACKUPS_CONFS="${DB_SMARTBACKUPS_CONFS:-"/etc/dbsmartbackup"}"
+# everything is discovered once: the process list and the postgresql
+# ports (as "conf<TAB>port" lines)
+PROCESSES="$(ps -eo pid=,args= 2>/dev/null)"
 if [ "x${PG_CONFS}" = "x" ];then
     # /etc/postgresql matches debia,n
     # /var/lib/pgsql matches redhat
@@ -79,85 +219,36 @@ fi
 if [ "x${PG_CONFS}" = "x" ];then
     PG_CONFS=/etc/postgresql.conf
 fi
-PORTS=$(egrep -h "^port\s=\s" ${PG_CONFS} 2>/dev/null|awk -F= '{print $2}'|awk '{print $1}'|sort -u)
-DB_SMARTBACKUPS_CONFS="${DB_SMARTBACKUPS_CONFS:-"/etc/dbsmartbackup"}"
-# try to run postgresql backup to any postgresql version if we found
-# a running socket in the standard debian location
-CONF="${DB_SMARTBACKUPS_CONFS}/postgresql.conf"
-for port in ${PORTS};do
-    socket_path="/var/run/postgresql/.s.PGSQL.$port"
-    if [ -e "${socket_path}" ];then
-        # search back from which config the port comes from
-        for i in  /etc/postgresql/*/*/post*.conf;do
-            if [ x"${port}" = x"$(egrep -h "^port\s=\s" "$i"|awk -F= '{print $2}'|awk '{print $1}')" ];then
-                # search the postgres version to export binaries
-                export PGVER="$(basename $(dirname $(dirname ${i})))"
-                export PGVER="${PGVER:-9.3}"
-                break
-            fi
-        done
-        if [ -e "${CONF}" ];then
-            export PGHOST="/var/run/postgresql"
-            export HOST="${PGHOST}"
-            export PGPORT="$port"
-            export PORT="${PGPORT}"
-            export PATH="/usr/lib/postgresql/${PGVER}/bin:${PATH}"
-            if [ "x${QUIET}" = "x" ];then
-                echo "$__NAME__: Running backup for postgresql ${socket_path}: ${VER} (${CONF} $(which psql))"
-            fi
-            go_run_db_smart_backup "${CONF}"
-            unset PGHOST HOST PGPORT PORT
-        fi
-    fi
-done
-# try to run mysql backups if the config file is present
-# and we found a mysqld process
-CONF="${DB_SMARTBACKUPS_CONFS}/mysql.conf"
-if [ "x$(which mysql 2>/dev/null)" != "x" ] && [ x"$(filter_host_pids $(ps aux|grep mysqld|grep -v grep)|wc -w)" != "x0" ] &&  [ -e "${CONF}" ];then
-    if [ "x${QUIET}" = "x" ];then
-        echo "$__NAME__: Running backup for mysql: $(mysql --version) (${CONF} $(which mysql))"
-    fi
-    go_run_db_smart_backup "${CONF}"
-fi
+PG_PORTS="$(awk '/^port[ \t]*=/ {
+    sub(/^port[ \t]*=[ \t]*/, ""); sub(/[ \t#].*/, ""); print FILENAME "\t" $0
+}' ${PG_CONFS} 2>/dev/null)"
+INSTANCES="$(discover_instances)"
 if [ x"${DEBUG}" != "x" ];then
     set +x
 fi
-# try to run redi  backups if the config file is present
-CONF="${DB_SMARTBACKUPS_CONFS}/redis.conf"
-if [ "x$(which redis-server)" != "x" ] && [ x"$(filter_host_pids $(ps aux|grep redis-server|grep -v grep)|wc -w)" != "x0" ] &&  [ -e "${CONF}" ];then
-    if [ "x${QUIET}" = "x" ];then
-        echo "$__NAME__: Running backup for redis: $(redis-server --version|head -n1) (${CONF} $(which redis-server))"
-    fi
-    go_run_db_smart_backup "${CONF}"
-fi
-# try to run mongodb backups if the config file is present
-CONF="${DB_SMARTBACKUPS_CONFS}/mongod.conf"
-if [ "x$(which mongod 2>/dev/null )" != "x" ] && [ x"$(filter_host_pids $(ps aux|grep mongod|grep -v grep)|wc -w)" != "x0" ] &&  [ -e "${CONF}" ];then
-    if [ "x${QUIET}" = "x" ];then
-        echo "$__NAME__: Running backup for mongod: $(mongod --version|head -n1) (${CONF} $(which mongod))"
-    fi
-    go_run_db_smart_backup "${CONF}"
-fi
-# try to run slapd backups if the config file is present
-# and we found a mysqld process
-CONF="${DB_SMARTBACKUPS_CONFS}/slapd.conf"
-if [ x"$(filter_host_pids $(ps aux|grep slapd|grep -v grep|awk '{print $2}')|wc -w)" != "x0" ] &&  [ -e "${CONF}" ];then
-    if [ "x${QUIET}" = "x" ];then
-        echo "$__NAME__: Running backup for slapd"
-    fi
-    go_run_db_smart_backup "${CONF}"
+HAS_FLOCK=""
+if [ "x$(which flock 2>/dev/null)" != "x" ] && mkdir -p "${LOCK_DIR}" 2>/dev/null;then
+    HAS_FLOCK="1"
 fi
-# try to run ES backups if the config file is present
-# and we found a mysqld process
-CONF="${DB_SMARTBACKUPS_CONFS}/elasticsearch.conf"
-if [ x"$(filter_host_pids $(ps aux|grep org.elasticsearch.bootstrap.Elasticsearch|grep -v grep|awk '{print $2}')|wc -w)" != "x0" ] &&  [ -e "${CONF}" ];then
-    if [ "x${QUIET}" = "x" ];then
-        echo "$__NAME__: Running backup for elasticsearch"
+RUN_DIR="$(mktemp -d)"
+trap 'rm -rf "${RUN_DIR}"' EXIT
+JOBS=""
+SUMMARY=""
+for instance in ${INSTANCES};do
+    wait_instances "${RUN_JOBS}"
+    start_instance "${instance}"
+done
+wait_instances 1
+if [ "x${SUMMARY}" != "x" ];then
+    summary="$(printf "%s" "${SUMMARY}"|awk -F"\t" '
+        { printf "%s: %-24s %-8s %ss\n", name, $1, $2, $3; count[$2]++ }
+        END { printf "%s: %d ok, %d failed, %d skipped (already running)\n",
+                name, count["ok"], count["failure"], count["skipped"] }' name="${__NAME__}")"
+    if [ "x${QUIET}" != "x" ];then
+        echo "${summary}" >> "${LOG}"
+    else
+        echo "${summary}"
     fi
-    go_run_db_smart_backup "${CONF}"
-fi
-if [ x"${DEBUG}" != "x" ];then
-    set +x
 fi
 if [ "x${QUIET}" != "x" ] && [ "x${RET}" != "x0" ];then
     cat "${LOG}"
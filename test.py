@@ -8,6 +8,11 @@ import os
 import tempfile
 import shutil
 import re
+import hashlib
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
 from subprocess import (
     Popen,
     PIPE,
@@ -73,6 +78,67 @@ do_sendmail() {{
 '''
 
 
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """In memory S3 stand-in: objects and multipart uploads, the parts
+    listed in server.fail_parts are refused once."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body='', etag=None):
+        self.send_response(code)
+        if etag:
+            self.send_header('ETag', '"{0}"'.format(etag))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        self.server.auth.append(self.headers.get('Authorization', ''))
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        return (urllib.unquote(url.path),
+                urlparse.parse_qs(url.query, keep_blank_values=True),
+                data)
+
+    def do_PUT(self):
+        key, query, data = self.parse()
+        s3 = self.server
+        if 'partNumber' in query:
+            part = int(query['partNumber'][0])
+            if part in s3.fail_parts:
+                s3.fail_parts.remove(part)
+                return self.reply(403)
+            s3.uploads[query['uploadId'][0]][part] = data
+        else:
+            s3.objects[key] = data
+        self.reply(200, etag=hashlib.md5(data).hexdigest())
+
+    def do_POST(self):
+        key, query, data = self.parse()
+        s3 = self.server
+        if 'uploads' in query:
+            upload_id = 'up{0}'.format(len(s3.uploads))
+            s3.uploads[upload_id] = {}
+            return self.reply(
+                200, '<InitiateMultipartUploadResult><UploadId>{0}'
+                '</UploadId></InitiateMultipartUploadResult>'.format(upload_id))
+        parts = s3.uploads.pop(query['uploadId'][0])
+        numbers = re.findall('<PartNumber>([0-9]+)</PartNumber>', data)
+        s3.objects[key] = ''.join(parts[int(n)] for n in numbers)
+        self.reply(200, '<CompleteMultipartUploadResult><Key>{0}</Key>'
+                   '</CompleteMultipartUploadResult>'.format(key))
+
+    def do_DELETE(self):
+        key, query, data = self.parse()
+        s3 = self.server
+        if 'uploadId' in query:
+            s3.uploads.pop(query['uploadId'][0], None)
+        else:
+            s3.deleted[key] = s3.objects.pop(key)
+        self.reply(204)
+
+
 class TestCase(unittest.TestCase):
 
     def exec_script(self,
@@ -172,6 +238,18 @@ set_compressor;echo comp:$COMP;
         self.assertEqual(
             'comp:nocomp\n', ret)
 
+    def test_compressor_args(self):
+        TEST = '''
+COMP="zstd" COMPS="zstd" ZSTD="" COMP_LEVEL=22 COMP_THREADS=4
+set_compressor;echo "comp:$COMP:$COMP_ARGS"
+COMP="gzip" COMPS="gzip" GZIP="" PIGZ="" COMP_LEVEL=1 COMP_THREADS=""
+set_compressor;echo "comp:$COMP:$COMP_ARGS"
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'comp:zstd:--ultra -q -22 -T4\n'
+            'comp:gzip:-1\n', ret)
+
     def test_Compression(self):
         TEST = '''
 XZ=/nonexist
@@ -281,6 +359,385 @@ echo $ret
         ret = self.exec_script(TEST)
         self.assertTrue('rolnam' in ret)
 
+    def test_pg_dump_jobs(self):
+        TEST = u'''
+RUNAS="$(whoami)";PG_DUMP_JOBS=2;OPTDIR="--create -Z0"
+PG_DUMP_STAGING_DIR="{dir}";PIPED_BACKUP_COMPRESSION=""
+fakepgdump() {{
+    echo "pg_dump $@"
+    while [ x"${{1}}" != "x-f" ];do shift;done
+    mkdir "${{2}}" && echo toc > "${{2}}/toc.dat" && echo t > "${{2}}/3.dat"
+}}
+PG_DUMP=fakepgdump
+postgresql_dump foo "{dir}/foo.tar"
+tar tf "{dir}/foo.tar"|sort
+ls -d "{dir}"/dsb_pgdump.* 2>/dev/null|wc -l
+'''
+        ret = self.exec_script(TEST)
+        self.assertTrue('-Fd -j 2 --create -Z0 -f ' in ret)
+        self.assertTrue(ret.endswith('./\n./3.dat\n./toc.dat\n0\n'))
+
+    def test_mysql_dump_jobs(self):
+        TEST = u'''
+RUNAS="$(whoami)";MYSQLDUMP_JOBS=2;MYSQLDUMP_LOCK_TIMEOUT=2
+MYSQLDUMP_STAGING_DIR="{dir}";MYSQLDUMP_OPTS="--single-transaction"
+fakemysql() {{
+    while read -r line;do
+        case "${{line}}" in
+            *FLUSH*) echo dsb_locked;;
+            *"PROCESSLIST_ID = CONNECTION_ID()"*) echo "${{TRACKED:-1}}";;
+            *INNODB_TRX*) echo "${{line}}" >> "{dir}/trx";echo 0;;
+            *TABLE_TYPE*) printf "t1\\t10\\nt2\\t100\\nt 3\\t80\\n";;
+            *UNLOCK*) echo unlocked >&2;;
+        esac
+    done
+}}
+fakemysqldump() {{ shift 3;echo "mysqldump $@"; }}
+MYSQL=fakemysql;MYSQLDUMP=fakemysqldump
+mysql_dump foo "{dir}/foo.sql"
+cat "{dir}/foo.sql"
+echo staging:$(ls -d "{dir}"/dsb_mysqldump.* 2>/dev/null|wc -l)
+( sleep 5; true ) &
+sleep 0.2
+child="$(ps -o pid= --ppid "$!"|tr -d " ")"
+mysql_part_pids "$!"|grep -q "'${{child}}'" && echo pids:ours
+kill "${{child}}" "$!"
+# without performance_schema, a single mysqldump
+TRACKED=0
+mysql_dump foo "{dir}/foo.sql" 2>&1|grep -o "performance_schema is not available"
+cat "{dir}/foo.sql"
+'''
+        ret = self.exec_script(TEST)
+        self.assertTrue((
+            'mysqldump --single-transaction --no-data --skip-triggers -B foo\n'
+            'mysqldump --single-transaction --no-create-info --skip-routines'
+            ' --skip-triggers --skip-lock-tables foo t2\n'
+            'mysqldump --single-transaction --no-create-info --skip-routines'
+            ' --skip-triggers --skip-lock-tables foo t 3 t1\n'
+            'mysqldump --single-transaction --no-data --no-create-info'
+            ' --skip-routines --triggers foo\n'
+            'staging:0\npids:ours\n'
+            'performance_schema is not available\n'
+            'mysqldump --single-transaction -B foo\n') in ret, ret)
+        # the parts finished before being polled count as started
+        self.assertFalse('Could not check' in ret, ret)
+
+    def test_mysql_fingerprint(self):
+        TEST = u'''
+RUNAS="$(whoami)"
+fakemysql() {{
+    case "$(cat)" in
+        *"MASTER STATUS"*) if [ x"${{POS}}" != "x" ];then
+                               printf "binlog.000001\\t${{POS}}\\t\\t\\t\\n";fi;;
+        *MD5*) echo 0123abcd;;
+    esac
+}}
+MYSQL=fakemysql
+echo "nobinlog:$(mysql_fingerprint foo)"
+POS=154
+mysql_fingerprint foo
+POS=4242
+mysql_fingerprint foo
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'nobinlog:\n'
+            'binlog.000001:154 0123abcd\n'
+            'binlog.000001:4242 0123abcd\n', ret)
+
+    def test_discover(self):
+        TEST = u'''
+postgresql_discover() {{
+    printf "version\\t15.4\\t\\ndb\\tfoo\\t100\\ndb\\tWITH SP\\t20\\n"
+}}
+discover_server && echo discovered
+discovered_databases
+echo "$(discovered_version) $(db_size foo) $(db_size "WITH SP")"
+postgresql_discover() {{ echo "ERROR"; return 1; }}
+discover_server || echo fallback
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'discovered\nfoo\nWITH SP\n15.4 100 20\nfallback\n', ret)
+
+    def test_es_discover(self):
+        TEST = u'''
+BACKUP_TYPE=es
+curl_es() {{
+    case "${{1}}" in
+        "") echo '{{"version": {{"number": "7.10.2"}}}}';;
+        _cat/indices*) if [ x"${{FAIL}}" != "x" ];then return 22;fi
+                       printf "foo 100\\nbar 20\\n";;
+    esac
+}}
+discover_server && discovered_databases
+FAIL=1
+discover_server || echo fallback
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual('foo\nbar\nfallback\n', ret)
+
+    def test_order_databases(self):
+        TEST = u'''
+DSB_DISCOVERY="$(printf "version\\t1\\t\\ndb\\ta\\t100\\ndb\\tb\\t2000\\ndb\\tc d\\t50000\\n")"
+create_db_directories b
+printf "10\\t1000\\n" > "$(get_backupdir)/b/.dsb/duration"
+BACKUP_DB_NAMES="a b c%d"
+order_databases 2>/dev/null
+echo "${{BACKUP_DB_NAMES}}"
+echo "${{DSB_PREDICTIONS}}"|cut -f1,2|tr "\\t\\n" ":,"
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual('c%d b a \nc d:500,b:20,a:1,', ret)
+
+    def test_throttle(self):
+        TEST = u'''
+date() {{ echo 09; }}
+THROTTLE_RATE=1m;NICE_LEVEL=5;COMP_THREADS=4
+THROTTLE_RULES="big*@08-19:rate=20m,threads=1 *@22-06:nice=19,ionice=idle x:rate=2k"
+for db in bigdb small x;do
+    throttle_settings $db
+    echo "$db $DB_THROTTLE_RATE $DB_NICE_LEVEL $DB_IONICE_CLASS $DB_COMP_THREADS"
+done
+date() {{ echo 23; }}
+throttle_settings small
+echo "small $DB_THROTTLE_RATE $DB_NICE_LEVEL $DB_IONICE_CLASS $DB_COMP_THREADS"
+printf '#!/bin/sh\necho "pv $*" >&2;cat\n' > "{dir}/pv";chmod +x "{dir}/pv"
+PV="{dir}/pv";DB_NICE_LEVEL="";DB_IONICE_CLASS="";DB_COMP_THREADS=4
+DB_THROTTLE_RATE=2k;PIPED_BACKUP_COMPRESSION=1
+( throttled_dump echo hello ) 2>&1
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'bigdb 20m 5  1\n'
+            'small 1m 5  4\n'
+            'x 2k 5  4\n'
+            'small 1m 19 idle 4\n'
+            'pv -q -L 2k\nhello\n', ret)
+
+    def test_metrics(self):
+        TEST = u'''
+DSB_CONF_FILE="/etc/dsb/pg main.conf";BACKUP_TYPE=postgresql;FULL_FDATE=run1
+metric_start;metric_end connectivity
+echo "$DSB_METRICS"|cut -f1,2,6-
+DSB_METRICS="$(printf "dump\\tfoo\\t10.5\\t12\\t150\\t4000\\t1000\\tok\\n")
+"
+getconf() {{ echo 100; }}
+write_metrics
+write_metrics
+wc -l < "{TOP_BACKUPDIR}/metrics/pg_main.jsonl"
+tail -n1 "{TOP_BACKUPDIR}/metrics/pg_main.jsonl"
+grep -v "^#" "{TOP_BACKUPDIR}/metrics/pg_main.prom"
+ls "{TOP_BACKUPDIR}/metrics"
+DSB_METRICS=""
+do_cleanup_orphans > /dev/null 2>&1
+echo "$DSB_METRICS"|cut -f1
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'connectivity\t\t0\t0\tok\n\n'
+            '2\n'
+            '{"run": "run1", "conf": "pg_main", "type": "postgresql", '
+            '"stage": "dump", "db": "foo", "start": 10.500000, '
+            '"wall_seconds": 1.500000, "cpu_seconds": 1.50, '
+            '"bytes_in": 4000, "bytes_out": 1000, "ratio": 0.2500, '
+            '"status": "ok"}\n'
+            'dsb_stage_wall_seconds{conf="pg_main",type="postgresql",'
+            'stage="dump",db="foo"} 1.500000\n'
+            'dsb_stage_cpu_seconds{conf="pg_main",type="postgresql",'
+            'stage="dump",db="foo"} 1.50\n'
+            'dsb_stage_bytes_in{conf="pg_main",type="postgresql",'
+            'stage="dump",db="foo"} 4000\n'
+            'dsb_stage_bytes_out{conf="pg_main",type="postgresql",'
+            'stage="dump",db="foo"} 1000\n'
+            'dsb_stage_compression_ratio{conf="pg_main",type="postgresql",'
+            'stage="dump",db="foo"} 0.2500\n'
+            'dsb_stage_success{conf="pg_main",type="postgresql",'
+            'stage="dump",db="foo"} 1\n'
+            'dsb_last_run_timestamp_seconds{conf="pg_main",'
+            'type="postgresql"} 12.000\n'
+            'pg_main.jsonl\npg_main.prom\n'
+            'fix_perms\n\n', ret)
+
+    def test_verify(self):
+        TEST = u'''
+BACKUP_TYPE=mysql;BACKUP_EXT=sql;COMP=xz;VERIFY_BACKUPS=1;VERIFY_JOBS=2
+set_compressor
+fake_dump() {{
+    echo "CREATE TABLE t (a int);" > "${{2}}"
+    if [ x"${{1}}" != "xbad" ];then echo "-- Dump completed" >> "${{2}}";fi
+}}
+for DB in good bad;do
+    do_db_backup_ "${{DB}}" fake_dump 2>/dev/null
+done
+wait_for_verifications > verify.log 2>&1
+sed -e "s|$(get_backupdir)/||" verify.log
+echo "failure:${{DSB_BACKUP_IN_FAILURE}}"
+for DB in good bad;do
+    cut -f2 "$(get_backupdir)/${{DB}}/.dsb/verify"
+done
+echo "${{DSB_METRICS}}"|cut -f1,2,8|sort
+cleanup_rundir
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertTrue('Verified good/dumps/good_' in ret)
+        self.assertTrue('Verification of bad/dumps/bad_' in ret)
+        self.assertTrue('failure:y\nok\nfailure\n' in ret)
+        self.assertTrue(
+            'verify\tbad\tfailure\n'
+            'verify\tgood\tok\n' in ret)
+
+    def test_redis_stream(self):
+        TEST = u'''
+REDIS_PATH="{dir}/redis";mkdir -p "$REDIS_PATH";echo rdb > "$REDIS_PATH/dump.rdb"
+PIPED_BACKUP_COMPRESSION=1
+redis_dumpall "" "{dir}/nothere.tar"|tar tf -
+ls "{dir}/nothere.tar" 2>/dev/null
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual('./\n./dump.rdb\n', ret)
+
+    def test_redis_bgsave(self):
+        TEST = u'''
+REDIS_PATH="{dir}/redis";mkdir -p "$REDIS_PATH";echo rdb > "$REDIS_PATH/dump.rdb"
+echo aof > "$REDIS_PATH/appendonly.aof"
+REDIS_BACKUP_MODE=bgsave;REDIS_POLL_INTERVAL=0;PIPED_BACKUP_COMPRESSION=1
+HOST=localhost;PASSWORD=secret
+redis_set_connection_vars
+REDIS_CLI=fake_cli
+fake_cli() {{
+    case "${{*}}" in
+        *LASTSAVE) if [ -e "{dir}/saved" ];then echo 2;else echo 1;fi;;
+        *BGSAVE*) echo "$REDISCLI_AUTH ${{*}}" > "{dir}/saved"
+                  echo "Background saving scheduled";;
+        *INFO*) printf "rdb_bgsave_in_progress:0\r\nrdb_last_save_time:%s\r\n" "$(fake_cli LASTSAVE)"
+                printf "rdb_last_bgsave_status:${{STATUS:-ok}}\r\n";;
+        *CONFIG*) echo "${{5}}";;
+        *"--rdb -") echo streamed;;
+    esac
+}}
+redis_dumpall "" "{dir}/nothere.rdb"
+cat "{dir}/saved"
+REDIS_BACKUP_MODE=rdb
+redis_dumpall "" "{dir}/nothere.rdb"
+ls "{dir}/nothere.rdb" 2>/dev/null
+# a failing BGSAVE never changes LASTSAVE
+REDIS_BACKUP_MODE=bgsave;STATUS=err
+fake_cli() {{
+    case "${{*}}" in
+        *LASTSAVE) echo 1;;
+        *BGSAVE*) echo "Background saving ${{REPLY}}";;
+        *INFO*) printf "rdb_bgsave_in_progress:0\r\nrdb_last_save_time:1\r\n"
+                printf "rdb_last_bgsave_status:${{STATUS}}\r\n";;
+    esac
+}}
+REPLY=started
+( redis_dumpall "" "{dir}/nothere.rdb" ) 2>&1|grep -o "redis BGSAVE.*"
+REPLY=scheduled;REDIS_BGSAVE_TIMEOUT=0
+( redis_dumpall "" "{dir}/nothere.rdb" ) 2>&1|grep -o "redis BGSAVE.*"
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'rdb\nsecret -h localhost BGSAVE SCHEDULE\nstreamed\n'
+            'redis BGSAVE did not succeed\n'
+            'redis BGSAVE did not finish in 0s\n', ret)
+
+    def test_slapd_per_suffix(self):
+        TEST = u'''
+BACKUP_TYPE=slapd;BACKUP_EXT=ldif;COMP=xz;SLAPD_PER_SUFFIX=1;PARALLEL_JOBS=1
+DBNAMES=all;DBEXCLUDE="dc=old,dc=org";SLAPD_CONF=/nonexistent
+mkdir -p "{dir}/ldap/example" "{dir}/ldap/old"
+nproc() {{ echo 8; }}
+slapcat() {{
+    case "${{*}}" in
+        "-n 0") cat << EOF
+dn: olcDatabase={{-1}}frontend,cn=config
+olcDatabase: {{-1}}frontend
+
+dn: olcDatabase={{0}}config,cn=config
+olcDatabase: {{0}}config
+
+dn: olcDatabase={{1}}mdb,cn=config
+olcDatabase: {{1}}mdb
+olcDbDirectory: {dir}/ldap/exam
+ ple
+olcSuffix: dc=example,dc=com
+
+dn: olcDatabase={{2}}monitor,cn=config
+olcSuffix: cn=monitor
+
+dn: olcDatabase={{3}}mdb,cn=config
+olcSuffix: dc=old,dc=org
+olcDbDirectory: {dir}/ldap/old
+EOF
+        ;;
+        "-b dc=example,dc=com") printf "dn: dc=example,dc=com\ndc: example\n";;
+        *) return 1;;
+    esac
+}}
+slapd_databases
+ALL_DBNAMES="$(slapd_get_all_databases)"
+slapd_set_vars
+echo "dbs:${{DBNAMES}} jobs:${{PARALLEL_JOBS}}"
+set_compressor
+for db in ${{DBNAMES}};do
+    do_db_backup_ "${{db}}" slapd_dump 2>/dev/null
+    echo "${{db}}:${{LAST_BACKUP_STATUS:-ok}}"
+done
+xz -dc "$(get_backupdir)/dc=example,dc=com/dumps/"*.ldif.xz
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertEqual(
+            'cn=config\t-\n'
+            'dc=example,dc=com\t{0}/ldap/example\n'
+            'dc=old,dc=org\t{0}/ldap/old\n'
+            'dbs: cn=config dc=example,dc=com jobs:2\n'
+            'cn=config:failure\n'
+            'dc=example,dc=com:ok\n'
+            'dn: dc=example,dc=com\n'
+            'dc: example\n'.format(self.dir), ret)
+
+    def test_es_repository(self):
+        TEST = u'''
+BACKUP_TYPE=es;ES_SNAPSHOT_MODE=repository;ES_REPOSITORY=dsb;ES_POLL_INTERVAL=0
+BACKUP_EXT=snapshot;PIPED_BACKUP_COMPRESSION=1;COMP=xz
+curl_es() {{
+    case "${{1}}" in
+        *wait_for_completion=false) echo "PUT ${{1}} ${{4}}" >&2;echo '{{"accepted":true}}';;
+        _snapshot/dsb/_all) echo '{{"snapshots": [
+            {{"snapshot": "foo_2002-01-08_01-02-03", "state": "SUCCESS"}},
+            {{"snapshot": "foo_2002-01-09_01-02-03", "state": "SUCCESS"}},
+            {{"snapshot": "foo_2002-01-10_01-02-03", "state": "SUCCESS"}},
+            {{"snapshot": "slm-nightly", "state": "SUCCESS"}},
+            {{"snapshot": "bar_2002-01-10_01-02-03", "state": "IN_PROGRESS"}}]}}';;
+        _snapshot/dsb/*) if [ x"${{2}}" = "x-XDELETE" ];then echo "DELETE ${{1}}" >&2;
+                         else echo '{{"snapshots": [{{"snapshot": "x", "state": "SUCCESS"}}]}}';fi;;
+    esac
+}}
+es_dump foo "$(get_backupdir)/foo/dumps/foo_2002-01-10_01-02-03.snapshot" 2>&1|tr -d " \\n"
+echo
+create_db_directories foo
+touch "$(get_backupdir)/foo/dumps/foo_2002-01-10_01-02-03.snapshot.xz"
+printf "foo_2002-01-08_01-02-03\nfoo_2002-01-09_01-02-03\nfoo_2002-01-07_01-02-03\n"\
+    >> "$(get_backupdir)/foo/.dsb/es_snapshots"
+es_prune 2>&1|grep ^DELETE
+cat "$(get_backupdir)/foo/.dsb/es_snapshots"
+# nothing is deleted without any dump
+echo foo_2002-01-08_01-02-03 >> "$(get_backupdir)/foo/.dsb/es_snapshots"
+rm -f "$(get_backupdir)/foo/dumps/"*
+es_prune 2>&1|grep -o "^DELETE\|No dump in"
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            'PUT_snapshot/dsb/foo_2002-01-10_01-02-03?wait_for_completion=false'
+            '{"indices":"foo","ignore_unavailable":true,'
+            '"include_global_state":false}'
+            '{"snapshot":"x","state":"SUCCESS"}\n'
+            'DELETE _snapshot/dsb/foo_2002-01-08_01-02-03,foo_2002-01-09_01-02-03\n'
+            'foo_2002-01-10_01-02-03\n'
+            'No dump in\n',
+            ret)
+
     def test_createdirs(self):
         TEST = '''
 create_db_directories "WITH QUOTES ET utf8 éà"
@@ -363,6 +820,7 @@ FDATE="${{DATE}}_01-02-03";dofic
                 ret
             )
         )
+        self.assertTrue('Pruned 2 orphaned dumps' in ret)
 
     def test_cleanup_orphans_2(self):
         common = u'''
@@ -399,6 +857,394 @@ FDATE="${{DATE}}_01-02-03";dofic
             )
         )
 
+    def test_dedup_store(self):
+        TEST = u'''
+DB=foo;YEAR=2002;MNUM="01";W="2";DEDUP_STORE=1;BACKUP_EXT=sql;COMP=xz
+for DOM in 08 09 10;do
+    DATE="$YEAR-$MNUM-$DOM";DOY="0$DOM";FDATE="${{DATE}}_01-02-03"
+    create_db_directories "${{DB}}"
+    fn="$(get_backupdir)/${{DB}}/dumps/${{DB}}_${{DATE}}.sql"
+    echo same > "${{fn}}.xz"
+    dedup_into_store "$(get_backupdir)/${{DB}}" "${{fn}}.xz"
+    link_into_dirs "${{DB}}" "${{fn}}"
+done
+echo objects:$(ls "$(get_backupdir)/${{DB}}/.dsb/store"|wc -l)
+rm -f "$(get_backupdir)/${{DB}}/"{{daily,weekly,monthly,lastsnapshots}}/*_0{{8,9}}*
+do_cleanup_orphans 2>&1
+echo dumps:$(ls "$(get_backupdir)/${{DB}}/dumps")
+rm -f "$(get_backupdir)/${{DB}}/"{{daily,weekly,monthly,lastsnapshots}}/*
+do_cleanup_orphans 2>&1
+echo left:$(find "$(get_backupdir)/${{DB}}/.dsb/store" "$(get_backupdir)/${{DB}}/dumps" -type f|wc -l)
+'''
+        ret = self.exec_script(TEST)
+        self.assertTrue('objects:1\n' in ret)
+        self.assertTrue('dumps:foo_2002-01-10.sql.xz\n' in ret)
+        self.assertTrue('Pruned 2 orphaned dumps (0.0 B reclaimed)' in ret)
+        self.assertTrue(re.search('Pruning .*/foo/.dsb/store/', ret))
+        self.assertTrue('left:0\n' in ret)
+
+    def test_dedup_postgresql(self):
+        TEST = u'''
+BACKUP_EXT=sql;COMP=xz;DEDUP_STORE=1;DBNAMES=foo
+set_compressor
+# like pg_dump -Fc, the archive header holds its creation time
+custom_dump() {{ printf "PGDMP\\001\\016\\000%s\\ndata\\n" "${{FDATE}}" > "${{2}}"; }}
+plain_dump() {{ echo data > "${{2}}"; }}
+for FDATE in 2002-01-09_01-02-03 2002-01-10_01-02-03;do
+    do_db_backup_ custom custom_dump 2>&1|grep -o "Unchanged dump"
+    do_db_backup_ plain plain_dump 2>&1|grep -o "Unchanged dump"
+done
+echo custom:$(ls "$(get_backupdir)/custom/.dsb/store"|wc -l)
+echo plain:$(ls "$(get_backupdir)/plain/.dsb/store"|wc -l)
+PSQL=/bin/sh;PG_DUMP=/bin/sh;PG_DUMPALL=/bin/sh
+for OPT in "--create -Fc -Z0" "--create --format=d" "--create -Fp" "--create";do
+    echo "${{OPT}}:$(postgresql_set_vars 2>&1|grep -c "only plain dumps")"
+done
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertEqual(
+            'Unchanged dump\n'
+            'custom:2\n'
+            'plain:1\n'
+            '--create -Fc -Z0:1\n'
+            '--create --format=d:1\n'
+            '--create -Fp:0\n'
+            '--create:0\n', ret)
+
+    def test_verify_tree(self):
+        TEST = u'''
+BACKUP_EXT=sql;COMP=xz;CHECKSUM=sha256;VERIFY_TREE_DAYS=30;VERIFY_JOBS=2
+set_compressor
+fake_dump() {{ echo "dump of ${{1}}" > "${{2}}"; }}
+do_db_backup_ foo fake_dump 2>/dev/null
+PIPED_BACKUP_COMPRESSION=1
+fake_dump() {{ echo "dump of ${{1}}"; }}
+do_db_backup_ bar fake_dump 2>/dev/null
+PIPED_BACKUP_COMPRESSION=""
+for DB in foo bar;do
+    f="$(ls "$(get_backupdir)/${{DB}}/dumps/"*)"
+    if [ x"$(cut -f3 "$(get_backupdir)/${{DB}}/.dsb/checksums")" = "x$(sha256sum < "${{f}}"|cut -d" " -f1)" ];then
+        echo "${{DB}}:recorded"
+    fi
+done
+do_verify_tree 2>&1
+echo status:$?
+echo corrupted >> "$(ls "$(get_backupdir)/foo/dumps/"*)"
+rm -f "$(get_backupdir)/bar/dumps/"*
+printf "daily\tx\tgone.sql.xz\t-\t0\txz\t-\n" >> "$(get_backupdir)/bar/.dsb/index"
+do_verify_tree > audit.log 2>&1
+echo status:$?
+sed -e "s|$(get_backupdir)/||" audit.log
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertTrue('foo:recorded\nbar:recorded\n' in ret)
+        self.assertTrue(
+            'Re-hashed 0 dumps of 2 databases\n'
+            '[db_smart_backup]  0 corrupted dumps, 0 chrono files not linked'
+            ' to any dump, 0 index entries pointing nowhere, 0 new checksums\n'
+            'status:0\n' in ret)
+        self.assertTrue(re.search('Checksum mismatch: foo/dumps/foo_', ret))
+        self.assertTrue(re.search(
+            'Not linked to any dump: bar/daily/bar_', ret))
+        self.assertTrue(
+            'Rotation index entry pointing nowhere: bar/daily/gone.sql.xz'
+            in ret)
+        self.assertTrue(
+            'Re-hashed 1 dumps of 2 databases\n'
+            '[db_smart_backup]  1 corrupted dumps, 4 chrono files not linked'
+            ' to any dump, 1 index entries pointing nowhere, 0 new checksums\n'
+            in ret)
+
+    def test_s3_offload(self):
+        s3 = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        s3.objects, s3.uploads, s3.deleted, s3.auth = {}, {}, {}, []
+        # refused while streamed and when completed after the dump
+        s3.fail_parts = [3, 3]
+        thread = threading.Thread(target=s3.serve_forever)
+        thread.daemon = True
+        thread.start()
+        TEST = u'''
+BACKUP_EXT=sql;COMP=xz;PIPED_BACKUP_COMPRESSION=1;S3_PART_SIZE=1000;S3_JOBS=2
+S3_URL="http://127.0.0.1:%s/bucket/prefix";S3_ACCESS_KEY=ak;S3_SECRET_KEY=sk
+S3_REGION=us-east-1;S3_BUFFER_DIR="{dir}"
+set_compressor
+head -c 10000 /dev/urandom > random
+fake_dump() {{ head -c "${{SIZE}}" "{dir}/random"; }}
+SIZE=3500;do_db_backup_ foo fake_dump 2>&1|grep Offload
+ls "$(get_backupdir)/foo/.dsb/offload"
+offload_sync 2>&1|tail -n 1
+SIZE=100;do_db_backup_ "bar baz" fake_dump 2>&1|grep -o "Offloaded to.*bucket/prefix/.*"
+cp "$(get_backupdir)/foo/dumps/"* foo.copy
+cp "$(get_backupdir)/bar baz/dumps/"* bar.copy
+rm -f "$(get_backupdir)/foo/"{{dumps,daily,weekly,monthly,lastsnapshots}}/*
+offload_sync 2>&1|tail -n 1
+echo manifest:$(cat "$(get_backupdir)/foo/.dsb/offload/manifest")
+ls "{dir}"|grep -c dsb_s3
+# failed dumps are never offloaded
+failing_dump() {{ head -c "${{SIZE}}" "{dir}/random"; return 1; }}
+for SIZE in 3500 100;do
+    FDATE="failed${{SIZE}}";do_db_backup_ foo failing_dump > /dev/null 2>&1
+done
+ls "$(get_backupdir)/foo/.dsb/offload"
+echo manifest:$(cat "$(get_backupdir)/foo/.dsb/offload/manifest")
+# with DEDUP_STORE, a swept dumps/ name is still linked from the chrono dirs
+DEDUP_STORE=1;SIZE=100
+for FDATE in d1 d2;do
+    do_db_backup_ dedup fake_dump > /dev/null 2>&1
+done
+do_cleanup_orphans > /dev/null 2>&1
+echo dedup:$(ls "$(get_backupdir)/dedup/dumps")
+offload_sync 2>&1|tail -n 1
+echo manifest:$(cut -f1 "$(get_backupdir)/dedup/.dsb/offload/manifest")
+# the credentials are not on the command line
+curl() {{ echo "args: ${{*}}";cat; }}
+s3_curl GET key
+''' % s3.server_address[1]
+        try:
+            ret = self.exec_script(TEST, no_compress=False)
+        finally:
+            s3.shutdown()
+        self.assertTrue(re.search(
+            'Offload of foo_.sql.xz failed, it will be resumed.*\n'
+            'foo_.sql.xz.upload\n', ret))
+        self.assertTrue(
+            'Resumed 1 uploads, deleted 0 remote dumps, 0 failures\n' in ret)
+        self.assertTrue(
+            'Offloaded to http://127.0.0.1:{0}/bucket/prefix/postgresql/'
+            'localhost/bar%20baz/dumps/bar%20baz_.sql.xz'.format(
+                s3.server_address[1]) in ret)
+        self.assertTrue(
+            'Resumed 0 uploads, deleted 1 remote dumps, 0 failures\n'
+            'manifest:\n0\n' in ret)
+        prefix = '/bucket/prefix/postgresql/localhost/'
+        with open(J(self.dir, 'foo.copy')) as fic:
+            self.assertEqual(
+                s3.deleted[prefix + 'foo/dumps/foo_.sql.xz'], fic.read())
+        with open(J(self.dir, 'bar.copy')) as fic:
+            self.assertEqual(
+                s3.objects[prefix + 'bar baz/dumps/bar baz_.sql.xz'],
+                fic.read())
+        self.assertEqual([], s3.uploads.keys())
+        self.assertFalse([k for k in s3.objects if 'failed' in k])
+        self.assertTrue(
+            'manifest:\n0\nmanifest\nmanifest:\ndedup:dedup_d2.sql.xz\n'
+            '[db_smart_backup]  Resumed 0 uploads, deleted 0 remote dumps,'
+            ' 0 failures\nmanifest:dedup_d1.sql.xz dedup_d2.sql.xz\nargs: ' in ret, ret)
+        self.assertTrue(ret.endswith(' -K - -H x-amz-content-sha256: '
+                                     'UNSIGNED-PAYLOAD -X GET http://127.0.0.1:'
+                                     '{0}/bucket/prefix/key\n'
+                                     'user = "ak:sk"\n'.format(
+                                         s3.server_address[1])), ret)
+        self.assertTrue(s3.auth[0].startswith('AWS4-HMAC-SHA256 '))
+
+    def test_diff_backups(self):
+        TEST = u'''
+BACKUP_EXT=sql;COMP=zstd;PIPED_BACKUP_COMPRESSION=1;DIFF_BACKUPS=1;DIFF_FULL_EVERY=3
+set_compressor
+seq 1 50000 > base
+fake_dump() {{
+    if [ "x${{PIPED_BACKUP_COMPRESSION}}" = "x1" ];then
+        sed -e "s/^${{DOM}}000$/changed/" "{dir}/base"
+    else
+        sed -e "s/^${{DOM}}000$/changed/" "{dir}/base" > "${{2}}"
+    fi
+}}
+for DOM in 08 09 10 11;do
+    YEAR=2002;MNUM="${{DOM}}";W="${{DOM}}";DOY="0${{DOM}}"
+    DATE="2002-01-${{DOM}}";FDATE="${{DATE}}_01-02-03"
+    do_db_backup_ foo fake_dump 2>&1|grep -o "Differential dump against .*"
+done
+cd "$(get_backupdir)/foo"
+cut -f1,2 .dsb/chain
+ls .dsb/bases
+for DOM in 08 09 10 11;do
+    decompress_stream "daily/foo_2002_0${{DOM}}_2002-01-${{DOM}}.sql.zst" > out
+    PIPED_BACKUP_COMPRESSION=1 fake_dump | cmp -s - out && echo "${{DOM}}:restored"
+done
+if [ "$(file_size dumps/foo_2002-01-09_01-02-03.sql.zst)" -lt 100 ];then echo small;fi
+rm -f {{daily,weekly,monthly,lastsnapshots}}/*[-_]08[._]*
+do_cleanup_orphans > /dev/null 2>&1
+echo left:$(ls dumps) / $(ls .dsb/bases)
+rm -f {{daily,weekly,monthly,lastsnapshots}}/*[-_]{{09,10}}[._]*
+do_cleanup_orphans 2>&1|grep -o "Pruned [0-9]* orphaned dumps"
+echo left:$(ls dumps) / $(ls .dsb/bases)
+cut -f1,2 .dsb/chain
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertEqual(
+            'Differential dump against foo_2002-01-08_01-02-03.sql.zst\n'
+            'Differential dump against foo_2002-01-08_01-02-03.sql.zst\n'
+            'foo_2002-01-08_01-02-03.sql.zst\t-\n'
+            'foo_2002-01-09_01-02-03.sql.zst\tfoo_2002-01-08_01-02-03.sql.zst\n'
+            'foo_2002-01-10_01-02-03.sql.zst\tfoo_2002-01-08_01-02-03.sql.zst\n'
+            'foo_2002-01-11_01-02-03.sql.zst\t-\n'
+            'foo_2002-01-08_01-02-03.sql.zst\n'
+            'foo_2002-01-11_01-02-03.sql.zst\n'
+            '08:restored\n09:restored\n10:restored\n11:restored\n'
+            'small\n'
+            'left:foo_2002-01-08_01-02-03.sql.zst'
+            ' foo_2002-01-09_01-02-03.sql.zst'
+            ' foo_2002-01-10_01-02-03.sql.zst'
+            ' foo_2002-01-11_01-02-03.sql.zst /'
+            ' foo_2002-01-08_01-02-03.sql.zst'
+            ' foo_2002-01-11_01-02-03.sql.zst\n'
+            'Pruned 3 orphaned dumps\n'
+            'left:foo_2002-01-11_01-02-03.sql.zst /'
+            ' foo_2002-01-11_01-02-03.sql.zst\n'
+            'foo_2002-01-11_01-02-03.sql.zst\t-\n', ret)
+
+    def test_daemon(self):
+        TEST = u'''
+STARTUP_CACHE="{dir}/cache";STARTUP_CACHE_TTL=3600
+DAEMON_INTERVAL=1;DAEMON_JITTER=0;DAEMON_REFRESH=100
+set_dates
+if [ "${{FDATE}}" = "${{DATE}}_${{FDATE#*_}}" ] && [ "${{YEAR}}-${{MNUM}}-${{DOM}}" = "${{DATE}}" ];then
+    if [ "${{DSB_NOW}}" -gt "0" ] && [ "${{FULL_FDATE#${{FDATE}}.}}" != "${{FULL_FDATE}}" ];then
+        echo dates:ok
+    fi
+fi
+startup_cache_load
+cut -f1 cache|tr "\\n" " ";echo
+sed -i -e "s/^hostname\\t.*/hostname\\tcached.example/" cache
+startup_cache_load
+echo "hostname:${{DSB_HOSTNAME}}"
+STARTUP_CACHE_TTL=0
+startup_cache_load
+echo "hostname:${{DSB_HOSTNAME}}"
+mkdir -p "$(get_backupdir)"
+exec 3>> "$(get_backupdir)/.dsb_lock"
+flock 3
+( backup_lock -n ) || echo lock:busy
+exec 3>&-
+( backup_lock -n ) && echo lock:free
+do_backup() {{
+    DSB_BACKUP_STARTED="y"
+    echo "backup ${{FDATE}}" >> "{dir}/cycles"
+    if [ "$(wc -l < "{dir}/cycles")" -ge "2" ];then
+        kill -TERM "${{DAEMON_PID}}"
+    fi
+}}
+do_prune() {{
+    echo "prune" >> "{dir}/cycles"
+}}
+( DAEMON_PID="${{BASHPID}}"; do_trap; do_daemon ) > daemon.log 2>&1
+cut -d" " -f1 cycles
+grep -o "Cycle 1 took.*" daemon.log|sed -e "s/[0-9]s/Ns/g"
+ls "$(get_logsdir)"|wc -l
+'''
+        ret = self.exec_script(TEST)
+        self.assertTrue('dates:ok\n' in ret)
+        self.assertTrue('stamp hostname nproc \n' in ret)
+        self.assertTrue('hostname:cached.example\n' in ret)
+        self.assertFalse('hostname:cached.example\nhostname:cached' in ret)
+        self.assertTrue('lock:busy\nlock:free\n' in ret)
+        self.assertTrue(
+            'backup\nprune\nbackup\nprune\n'
+            'Cycle 1 took Ns (status: 0), next one in Ns\n'
+            '2\n' in ret)
+
+    def test_seekable_backups(self):
+        TEST = u'''
+YEAR=2002;MNUM=01;W=1;DOY=001;DATE=2002-01-01;FDATE="${{DATE}}_01-02-03"
+BACKUP_EXT=sql;COMP=xz;PIPED_BACKUP_COMPRESSION=1
+SEEKABLE_BACKUPS=1;SEEKABLE_FRAME_SIZE=4000
+set_compressor
+for table in a b c;do
+    echo "-- Table structure for table \\`${{table}}\\`"
+    echo "CREATE TABLE ${{table}} (i int);"
+    echo "-- Dumping data for table \\`${{table}}\\`"
+    seq 1 1000|sed -e "s/^/INSERT INTO ${{table}} VALUES (/;s/$/);/"
+done > "{dir}/dump.sql"
+fake_dump() {{ cat "{dir}/dump.sql"; }}
+do_db_backup_ foo fake_dump > /dev/null 2>&1
+cd "$(get_backupdir)/foo"
+dump="daily/foo_2002_001_2002-01-01.sql.xz"
+decompress_stream "${{dump}}"|cmp -s - "{dir}/dump.sql" && echo sql:restored
+do_extract "${{dump}}"
+frames="$(grep -c "^F" .dsb/toc/foo_2002-01-01_01-02-03.sql.xz)"
+if [ "${{frames}}" -gt "10" ];then echo frames:many;fi
+do_extract "${{dump}}" b > b.sql
+sed -n -e "/table .b./,/table .c./p" "{dir}/dump.sql"|sed -e "\\$d"|cmp -s - b.sql && echo b:extracted
+( do_extract "${{dump}}" d ) 2>&1|grep -o "No d in .*"
+mkdir -p "{dir}/es/indices/idx1" "{dir}/es/indices/idx2"
+seq 1 3000 > "{dir}/es/indices/idx1/data"
+seq 1 5000 > "{dir}/es/indices/idx2/data"
+tar_dump() {{ tar cf - -C "{dir}/es" .; }}
+COMP=zstd;set_compressor
+do_db_backup_ bar tar_dump tar > /dev/null 2>&1
+dump="$(get_backupdir)/bar/dumps/bar_2002-01-01_01-02-03.tar.zst"
+do_extract "${{dump}}"|cut -f1,2|grep idx2
+do_extract "${{dump}}" ./indices/idx2/|tar -xOf - ./indices/idx2/data|cmp -s - "{dir}/es/indices/idx2/data"\\
+    && echo idx2:extracted
+rm -f {{daily,weekly,monthly,lastsnapshots}}/*
+do_cleanup_orphans > /dev/null 2>&1
+ls .dsb/toc|wc -l
+ls "$(get_backupdir)/bar/.dsb/toc"
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertEqual(
+            'sql:restored\n'
+            'table\ta\t27980\n'
+            'table\tb\t27980\n'
+            'table\tc\t27980\n'
+            'frames:many\n'
+            'b:extracted\n'
+            'No d in daily/foo_2002_001_2002-01-01.sql.xz\n'
+            'member\t./indices/idx2/\n'
+            'member\t./indices/idx2/data\n'
+            'idx2:extracted\n'
+            '0\n'
+            'bar_2002-01-01_01-02-03.tar.zst\n', ret)
+
+    def test_piped_failure(self):
+        TEST = u'''
+DB=foo;YEAR=2002;MNUM="01";W="2";DOM=08;DOY=008;DATE=2002-01-08;FDATE="${{DATE}}_01-02-03"
+BACKUP_EXT=sql;COMP=xz;PIPED_BACKUP_COMPRESSION=1
+set_compressor
+fake_dump() {{ echo partial; return 1; }}
+do_db_backup_ "${{DB}}" fake_dump > out 2>&1
+grep -o "Backup of foo failed" out
+echo "status:${{LAST_BACKUP_STATUS}}"
+ls "$(get_backupdir)/${{DB}}/daily"|wc -l
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertEqual(
+            'Backup of foo failed\n'
+            'status:failure\n'
+            '0\n', ret)
+
+    def test_skip_unchanged(self):
+        TEST = u'''
+DB=foo;YEAR=2002;MNUM="01";W="2";BACKUP_EXT=sql;COMP=xz;SKIP_UNCHANGED=1
+set_compressor
+postgresql_fingerprint() {{ echo "fp${{FP}}"; }}
+fake_dump() {{ echo dumped; echo "${{DOM}}" > "${{2}}"; }}
+for DOM in 08 09 10;do
+    DATE="$YEAR-$MNUM-$DOM";DOY="0$DOM";FDATE="${{DATE}}_01-02-03"
+    if [ x"${{DOM}}" = "x10" ];then FP=2;fi
+    do_db_backup_ "${{DB}}" fake_dump 2>&1
+done
+echo dumps:$(ls "$(get_backupdir)/${{DB}}/dumps")
+d="$(get_backupdir)/${{DB}}/daily"
+if [ "$d/foo_2002_008_2002-01-08.sql.xz" -ef "$d/foo_2002_009_2002-01-09.sql.xz" ];then
+    echo reused
+fi
+# a failed dump is never reused
+PIPED_BACKUP_COMPRESSION=1;FP=3
+failing_dump() {{ echo partial; return 1; }}
+DOM=11;DATE="$YEAR-$MNUM-$DOM";DOY="0$DOM";FDATE="${{DATE}}_01-02-03"
+do_db_backup_ "${{DB}}" failing_dump > /dev/null 2>&1
+DOM=12;DATE="$YEAR-$MNUM-$DOM";DOY="0$DOM";FDATE="${{DATE}}_01-02-03"
+do_db_backup_ "${{DB}}" fake_dump 2>&1|grep -c "did not change"
+'''
+        ret = self.exec_script(TEST, no_compress=False)
+        self.assertEqual(ret.count('dumped'), 2)
+        self.assertTrue('did not change, reusing' in ret)
+        self.assertTrue(
+            'dumps:foo_2002-01-08_01-02-03.sql.xz'
+            ' foo_2002-01-10_01-02-03.sql.xz\n' in ret)
+        self.assertTrue('reused\n0\n' in ret)
+
     def test_rotate(self):
         rotatec = u'''
 BACKUPDIR="$outputDir/pgbackups"
@@ -467,7 +1313,7 @@ MNUM="03";DOM="01";DATE="$YEAR-$MNUM-$DOM";FDATE="${{DATE}}_01-01-01";DOY="60"
                       'dumps', 'lastsnapshots']:
                 cmd = (
                     u"find '{0}/pgbackups/postgresql/localhost/{1}/{2}' "
-                    u"-type f 2>/dev/null"
+                    u"-type f ! -path '*/.dsb/*' 2>/dev/null"
                     u"|wc -l".format(self.dir, i, j))
                 ret = self.exec_script(cmd)
                 counter = counters.get(j)
@@ -488,7 +1334,7 @@ MNUM="03";DOM="01";DATE="$YEAR-$MNUM-$DOM";FDATE="${{DATE}}_01-01-01";DOY="60"
                       'dumps', 'lastsnapshots']:
                 cmd = (
                     u"find '{0}/pgbackups/postgresql/localhost/{1}/{2}' "
-                    u"-type f 2>/dev/null"
+                    u"-type f ! -path '*/.dsb/*' 2>/dev/null"
                     u"|wc -l".format(self.dir, i, j))
                 ret = self.exec_script(cmd)
                 counter = counters.get(j)
@@ -597,7 +1443,6 @@ cyan_log "foo"
 yellow_log "foo"
 log "foo"
 deactivate_IO_redirection
-sanitize_log
 cat -e "$DSB_LOGFILE"
 '''
         ret = self.exec_script(TEST)
@@ -608,6 +1453,120 @@ cat -e "$DSB_LOGFILE"
              '[db_smart_backup] foo$']
         )
 
+    def test_log_direct(self):
+        TEST = u'''
+mkdir -p "{dir}/logs"
+for i in 1 2 3 4 5;do touch "{dir}/logs/db_smart_backup_2002-01-0${{i}}.log";done
+DSB_LOG_DIRECT=1
+{{
+    log "a ${{YELLOW}}b${{NORMAL}}"
+    cyan_log "c"
+    rotate_dir "{dir}/logs" 2
+}} 8>"{dir}/tty" 7>"{dir}/plain"
+cat -v "{dir}/plain"
+grep -c "Unlinking" "{dir}/tty"
+ls "{dir}/logs"
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            '[db_smart_backup] a b\n'
+            'c\n'
+            '[db_smart_backup]         * Unlinking db_smart_backup_2002-01-03.log\n'
+            '[db_smart_backup]         * Unlinking db_smart_backup_2002-01-02.log\n'
+            '[db_smart_backup]         * Unlinking db_smart_backup_2002-01-01.log\n'
+            '[db_smart_backup]        Unlinked 3 files\n'
+            '0\n'
+            'db_smart_backup_2002-01-04.log\n'
+            'db_smart_backup_2002-01-05.log\n', ret)
+
+    def test_parallel_jobs(self):
+        TEST = u'''
+do_db_backup() {{
+    db="$1"
+    LAST_BACKUP_STATUS=""
+    echo "dumped $db"
+    if [ x"$db" = "xb" ];then LAST_BACKUP_STATUS="failure";fi
+}}
+BACKUP_DB_NAMES="a b c d e"
+PARALLEL_JOBS=3
+do_backup 2>&1
+echo "failure:${{DSB_BACKUP_IN_FAILURE}}"
+cleanup_rundir
+'''
+        ret = self.exec_script(TEST)
+        for i in ['a', 'b', 'c', 'd', 'e']:
+            self.assertTrue('dumped {0}\n'.format(i) in ret, i)
+        self.assertTrue(
+            'do_hook Postdbbackup: b  command output' in ret)
+        self.assertTrue(
+            'do_hook Postdbbackup: a(failure)  command output' in ret)
+        self.assertTrue('failure:y' in ret)
+
+    def test_run_dbsmartbackups(self):
+        TEST = u'''
+mkdir -p "{dir}/bin" "{dir}/confs" "{dir}/locks"
+cat > "{dir}/bin/db_smart_backup.sh" << 'EOF'
+#!/usr/bin/env bash
+kind="$(basename "${{1}}" .conf)"
+echo "start ${{kind}}" >> "${{ORDER}}"
+sleep 1
+echo "end ${{kind}}" >> "${{ORDER}}"
+[ x"${{kind}}" != "xmysql" ]
+EOF
+cat > "{dir}/bin/ps" << 'EOF'
+#!/usr/bin/env bash
+echo "${{FAKE_PID}} /usr/sbin/mysqld"
+echo "${{FAKE_PID}} /usr/bin/redis-server *:6379"
+echo "${{FAKE_PID}} /usr/sbin/slapd -h ldapi:///"
+EOF
+cp "{dir}/bin/ps" "{dir}/bin/mysql";cp "{dir}/bin/ps" "{dir}/bin/redis-server"
+chmod +x "{dir}/bin/"*
+touch "{dir}/confs/mysql.conf" "{dir}/confs/redis.conf" "{dir}/confs/slapd.conf"
+export PATH="{dir}/bin:${{PATH}}" FAKE_PID="$$" LOCK_DIR="{dir}/locks"
+export DB_SMARTBACKUPS_CONFS="{dir}/confs" PG_CONFS="{dir}/confs/none"
+run() {{
+    ORDER="{dir}/order.${{1#--jobs=}}" "{cwd}/run_dbsmartbackups.sh" "$@"\\
+        | grep "^RUN_DB_SMARTBACKUPS: [a-z0-9]"|sed -e "s/ *[0-9]*s$//;s/  */ /g"
+    echo "ret:${{PIPESTATUS[0]}}"
+}}
+run --jobs=1
+cat "{dir}/order.1"|tr "\\n" ","
+echo
+run --jobs=3 > /dev/null
+head -n 3 "{dir}/order.3"|cut -d" " -f1|tr "\\n" ","
+echo
+# an instance still being backed up by another run is skipped
+flock "{dir}/locks/redis.lock" sleep 5 &
+sleep 0.2
+run --jobs=3|grep redis
+kill "$!"
+'''
+        ret = self.exec_script(TEST, source=False)
+        self.assertEqual(
+            'RUN_DB_SMARTBACKUPS: mysql failure\n'
+            'RUN_DB_SMARTBACKUPS: redis ok\n'
+            'RUN_DB_SMARTBACKUPS: slapd ok\n'
+            'RUN_DB_SMARTBACKUPS: 2 ok, 1 failed, 0 skipped (already running)\n'
+            'ret:1\n'
+            'start mysql,end mysql,start redis,end redis,start slapd,end slapd,\n'
+            'start,start,start,\n'
+            'RUN_DB_SMARTBACKUPS: redis skipped\n', ret)
+        # each postgresql cluster is backed up apart from the others
+        TEST = u'''
+HOST=/var/run/postgresql;PGHOST="${{HOST}}"
+PORT="";get_backupdir
+PORT=5432;get_backupdir
+PORT=5433;get_backupdir
+HOST=db.example.com;get_backupdir
+'''
+        ret = self.exec_script(TEST)
+        self.assertEqual(
+            '{0}/postgresql/localhost\n'
+            '{0}/postgresql/localhost\n'
+            '{0}/postgresql/localhost_5433\n'
+            '{0}/postgresql/db.example.com_5433\n'.format(
+                self.opts['TOP_BACKUPDIR']), ret)
+
     def test_sort4(self):
         TEST = u'''
 # monthly